@@ -0,0 +1,291 @@
+import json
+import math
+import numbers
+
+from operator import add
+
+import sketches
+
+def sample_rate(select):
+    """
+    Returns the fraction of tweets a count samples, written as select: {agg:
+    'count', field: '*', sample: 0.01}, or None if it counts all of them.
+    """
+    rate = select.get('sample')
+    if select['agg'] != 'count' or not rate or not 0 < rate < 1:
+        return None
+    return float(rate)
+
+def is_number(v):
+    return isinstance(v, numbers.Real) and not isinstance(v, bool)
+
+class Aggregate(object):
+    # the accumulator of no tweets; must be immutable, as it is shared
+    zero = None
+    # whether the aggregate reads select['field']
+    needs_field = False
+
+    def __init__(self, select, read):
+        """
+        The aggregate of a select clause, split into mergeable parts like an
+        Aggregator: zero, seqOp folding a tweet into a partial accumulator,
+        combOp merging two partials and finish turning the final one into the
+        result. read(field) returns a function extracting a field from a
+        (parsed or projected) tweet, or None if it is missing.
+
+        Aggregates are equal if their select clauses are, so that the
+        aggregate calls of identical queries on the same dataset are computed
+        once (see wrapper.make_hashkey).
+        """
+        self.select = select
+        field = select.get('field', '*')
+        if field == '*':
+            if self.needs_field:
+                raise Exception("{} needs a field, not *".format(select['agg']))
+            self.get = None
+        else:
+            self.get = read(field)
+        self.key = (type(self).__name__, json.dumps(select, sort_keys=True))
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.key == self.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def value(self, tweet):
+        return self.get(tweet) if self.get is not None else None
+
+    def seqOp(self, acc, tweet):
+        raise NotImplementedError()
+
+    def combOp(self, a, b):
+        raise NotImplementedError()
+
+    def finish(self, acc):
+        return acc
+
+class Count(Aggregate):
+    zero = 0
+
+    def seqOp(self, acc, tweet):
+        return acc + 1
+
+    def combOp(self, a, b):
+        return a + b
+
+class SampledCount(Count):
+
+    def __init__(self, select, read):
+        """
+        Count of the tweets in a hash sample of the given rate (see
+        sketches.sampled), finished into an estimate of the full count.
+        """
+        Count.__init__(self, select, read)
+        self.rate = sample_rate(select)
+        self.get_id = read('id')
+
+    def seqOp(self, acc, tweet):
+        v = self.get_id(tweet)
+        if v is not None and sketches.sampled(v, self.rate):
+            return acc + 1
+        return acc
+
+    def finish(self, acc):
+        return sketches.sample_estimate(acc, self.rate)
+
+class Extremum(Aggregate):
+    # accumulator: None until the first accepted value, then op of all of them
+    needs_field = True
+    op = None
+
+    def accepts(self, v):
+        return v is not None
+
+    def seqOp(self, acc, tweet):
+        v = self.value(tweet)
+        if not self.accepts(v):
+            return acc
+        return v if acc is None else self.op(acc, v)
+
+    def combOp(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return self.op(a, b)
+
+class Sum(Extremum):
+    op = staticmethod(add)
+
+    def accepts(self, v):
+        # like avg, only numbers: not strings, which would be concatenated or
+        # fail to add up with numbers
+        return is_number(v)
+
+class Min(Extremum):
+    op = staticmethod(min)
+
+class Max(Extremum):
+    op = staticmethod(max)
+
+class Avg(Aggregate):
+    # accumulator: (sum, count) of the numeric values
+    zero = (0, 0)
+    needs_field = True
+
+    def seqOp(self, acc, tweet):
+        v = self.value(tweet)
+        if not is_number(v):
+            return acc
+        return (acc[0] + v, acc[1] + 1)
+
+    def combOp(self, a, b):
+        return (a[0] + b[0], a[1] + b[1])
+
+    def finish(self, acc):
+        return acc[0] / float(acc[1]) if acc[1] else None
+
+class Variance(Aggregate):
+    # accumulator: (count, mean, sum of squared deviations from the mean) of
+    # the numeric values, which merge without loss of precision (Chan et al.)
+    zero = (0, 0.0, 0.0)
+    needs_field = True
+
+    def seqOp(self, acc, tweet):
+        v = self.value(tweet)
+        if not is_number(v):
+            return acc
+        n, mean, m2 = acc
+        n += 1
+        delta = v - mean
+        mean += delta / float(n)
+        return (n, mean, m2 + delta * (v - mean))
+
+    def combOp(self, a, b):
+        if not a[0]:
+            return b
+        if not b[0]:
+            return a
+        n = a[0] + b[0]
+        delta = b[1] - a[1]
+        mean = a[1] + delta * b[0] / float(n)
+        return (n, mean, a[2] + b[2] + delta * delta * a[0] * b[0] / float(n))
+
+    def finish(self, acc):
+        # sample variance
+        return acc[2] / (acc[0] - 1) if acc[0] > 1 else None
+
+class Stddev(Variance):
+
+    def finish(self, acc):
+        variance = Variance.finish(self, acc)
+        return math.sqrt(variance) if variance is not None else None
+
+class SketchAggregate(Aggregate):
+    # accumulator: None until the first value, then a mergeable sketch, which
+    # seqOp updates in place and combOp never modifies
+    needs_field = True
+
+    def sketch(self):
+        raise NotImplementedError()
+
+    def accepts(self, v):
+        return v is not None
+
+    def update(self, acc, v):
+        acc.add(v)
+
+    def seqOp(self, acc, tweet):
+        v = self.value(tweet)
+        if not self.accepts(v):
+            return acc
+        if acc is None:
+            acc = self.sketch()
+        self.update(acc, v)
+        return acc
+
+    def combOp(self, a, b):
+        return sketches.merge(a, b)
+
+class CountDistinct(SketchAggregate):
+
+    def __init__(self, select, read):
+        SketchAggregate.__init__(self, select, read)
+        self.precision = int(select.get('precision', sketches.HLL_PRECISION))
+
+    def sketch(self):
+        return sketches.HyperLogLog(self.precision)
+
+    def finish(self, acc):
+        return acc.estimate() if acc is not None else 0
+
+class TopK(SketchAggregate):
+
+    def __init__(self, select, read):
+        SketchAggregate.__init__(self, select, read)
+        self.k = min(int(select.get('k', 10)), sketches.MAX_TOP_K)
+        self.capacity = int(select.get('capacity') or max(10 * self.k, 100))
+        self.split = bool(select.get('split'))
+
+    def sketch(self):
+        return sketches.SpaceSaving(self.capacity)
+
+    def update(self, acc, v):
+        for item in sketches.items(v, self.split):
+            acc.add(item)
+
+    def finish(self, acc):
+        return acc.top(self.k) if acc is not None else []
+
+class Percentiles(SketchAggregate):
+
+    def __init__(self, select, read):
+        """
+        Percentiles of the numeric values of a field, written as select: {agg:
+        'percentiles', field: 'retweet_count', percentiles: [50, 90, 99]}, and
+        returned as [percentile, value] pairs (None values if there are no
+        numbers). accuracy sets the relative error of the values.
+        """
+        SketchAggregate.__init__(self, select, read)
+        self.percentiles = [float(p) for p in select.get('percentiles', [50, 90, 99])]
+        if not all(0 <= p <= 100 for p in self.percentiles):
+            raise Exception("Percentiles must be between 0 and 100")
+        self.accuracy = float(select.get('accuracy', sketches.QUANTILE_ACCURACY))
+
+    def sketch(self):
+        return sketches.QuantileSketch(self.accuracy)
+
+    def accepts(self, v):
+        return is_number(v)
+
+    def finish(self, acc):
+        return [[p, acc.quantile(p / 100) if acc is not None else None]
+                for p in self.percentiles]
+
+AGGREGATES = {
+    'count': Count,
+    'sum': Sum,
+    'min': Min,
+    'max': Max,
+    'avg': Avg,
+    'variance': Variance,
+    'stddev': Stddev,
+    'percentiles': Percentiles,
+    'count_distinct': CountDistinct,
+    'top_k': TopK,
+}
+
+def create(select, read):
+    """
+    Returns the Aggregate of a select clause. See Aggregate for read.
+    """
+    agg = select['agg']
+    if agg == 'count' and sample_rate(select) is not None:
+        return SampledCount(select, read)
+    if agg not in AGGREGATES:
+        raise Exception("Unsupported aggregator in select: {}".format( agg ))
+    return AGGREGATES[agg](select, read)
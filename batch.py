@@ -0,0 +1,199 @@
+import itertools
+import numbers
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import aggregates
+import fused
+import multimatch
+import queryparser
+
+# Number of rows materialized into column arrays at a time.
+BATCH_SIZE = 4096
+
+class Columns(object):
+
+    def __init__(self, rows, projection):
+        """
+        Column arrays for one batch of projected rows. Each column is built on
+        first use and then shared by all queries that reference the field.
+        """
+        self.rows = rows
+        self.projection = projection
+        self._cache = {}
+
+    def _get(self, kind, field, build):
+        key = (kind, field)
+        if key not in self._cache:
+            self._cache[key] = build(field)
+        return self._cache[key]
+
+    def values(self, field):
+        def build(field):
+            index = self.projection.index(field)
+            col = np.empty(len(self.rows), dtype=object)
+            for j, row in enumerate(self.rows):
+                col[j] = row[index]
+            return col
+        return self._get("values", field, build)
+
+    def present(self, field):
+        def build(field):
+            return np.array([v is not queryparser.Missing
+                             for v in self.values(field)], dtype=bool)
+        return self._get("present", field, build)
+
+    def strings(self, field):
+        """
+        Returns (mask of string values, unicode array with '' elsewhere).
+        """
+        def build(field):
+            vals = self.values(field)
+            is_str = np.array([isinstance(v, basestring) for v in vals], dtype=bool)
+            texts = np.array([v if s else u'' for v, s in itertools.izip(vals, is_str)],
+                             dtype=np.unicode_)
+            return is_str, texts
+        return self._get("strings", field, build)
+
+    def numbers(self, field):
+        """
+        Returns (mask of numeric values, numeric array with 0 elsewhere).
+        """
+        def build(field):
+            vals = self.values(field)
+            is_num = np.array([isinstance(v, numbers.Real) and not isinstance(v, bool)
+                               for v in vals], dtype=bool)
+            nums = [v if n else 0 for v, n in itertools.izip(vals, is_num)]
+            exact = all(isinstance(v, (int, long)) and -2**63 <= v < 2**63 for v in nums)
+            return is_num, np.array(nums, dtype=np.int64 if exact else np.float64)
+        return self._get("numbers", field, build)
+
+def predicate_mask(cols, f):
+    """
+    Evaluates the predicate f (see SimpleQuery.predicate) over a batch and
+    returns a boolean mask. _contains, _eq and _neq run as array operations;
+    anything else falls back to calling f on each row. _and and _or combine
+    the masks of their children.
+    """
+    if f.predicate[0] in queryparser.OPERATORS:
+        masks = [predicate_mask(cols, g) for g in f.children]
+        if f.predicate[0] == '_and':
+            return reduce(np.logical_and, masks, np.ones(len(cols.rows), dtype=bool))
+        return reduce(np.logical_or, masks, np.zeros(len(cols.rows), dtype=bool))
+    field, modifier, value = f.predicate
+    if modifier == '_contains' and isinstance(value, basestring):
+        is_str, texts = cols.strings(field)
+        mask = is_str & (np.char.find(texts, value) >= 0)
+        # e.g. lists of hashtags: membership test on the remaining rows
+        for j in np.flatnonzero(cols.present(field) & ~is_str):
+            mask[j] = f(cols.rows[j])
+        return mask
+    elif modifier in ('_eq', '_neq'):
+        eq = cols.values(field) == value
+        if isinstance(eq, np.ndarray) and eq.shape == (len(cols.rows),):
+            eq = eq.astype(bool)
+            present = cols.present(field)
+            return present & eq if modifier == '_eq' else present & ~eq
+    return np.array([f(row) for row in cols.rows], dtype=bool)
+
+def aggregate_mask(cols, select, aggregator, mask):
+    """
+    Aggregates the rows selected by mask into a partial accumulator of the same
+    form that aggregator.seqOp produces, so it can be merged with combOp.
+    count, sum, min, max, avg, variance and stddev over numeric values run as
+    array operations, and only min and max also fold other values; other
+    aggregates (e.g. sketches) are folded row by row.
+    """
+    agg = select['agg']
+    if agg == 'count' and aggregates.sample_rate(select) is None:
+        return int(np.count_nonzero(mask))
+    acc = aggregator.zero
+    if agg in ('sum', 'min', 'max', 'avg', 'variance', 'stddev'):
+        is_num, nums = cols.numbers(select['field'])
+        selected = nums[mask & is_num]
+        if len(selected):
+            if agg == 'avg':
+                acc = (selected.sum().item(), len(selected))
+            elif agg in ('variance', 'stddev'):
+                mean = selected.mean()
+                m2 = ((selected - mean) ** 2).sum()
+                acc = (len(selected), mean.item(), m2.item())
+            else:
+                acc = getattr(selected, agg)().item()
+        if agg != 'min' and agg != 'max':
+            # the other rows are skipped by seqOp anyway
+            return acc
+        mask = mask & ~is_num
+    for j in np.flatnonzero(mask):
+        acc = aggregator.seqOp(acc, cols.rows[j])
+    return acc
+
+class BatchPlan(fused.FusedPlan):
+
+    def __init__(self, queries, prefilter=None, projection=None, stats=None,
+                 batch_size=BATCH_SIZE):
+        """
+        Like FusedPlan, but instead of testing every row against every query in
+        the interpreter, each partition is cut into batches of projected rows,
+        the referenced fields are materialized into NumPy column arrays, and
+        predicates and aggregates are evaluated over whole arrays, producing
+        one boolean mask per query and batch.
+
+        Requires numpy and a projection; if none is given, the projection onto
+        the fields of the queries is used. With stats, the predicates are
+        measured on a sample of the rows as in FusedPlan; masks evaluate every
+        predicate anyway, so their order does not matter here.
+        """
+        if np is None:
+            raise ImportError("Batch evaluation requires numpy")
+        if projection is None:
+            projection = queryparser.Projection.from_queries(queries)
+        if projection is None:
+            raise ValueError("Batch evaluation needs a projection of the queries")
+        super(BatchPlan, self).__init__(queries, prefilter, projection, stats)
+        self.batch_size = batch_size
+
+    def scanner(self, context=None):
+        # Bind to local variables to prevent Spark from trying to pickle self.
+        projection = self.projection
+        parse = projection.parser()
+        prefilter = self.prefilter
+        predicates = self.predicates
+        aggregators = self.aggregators
+        selects = [q.select for q in self.queries]
+        batch_size = self.batch_size
+        zero = self.zero()
+        measure = multimatch.measurer(predicates, context, self.stats)
+        every = self.stats.sample_every if measure is not None else 0
+
+        def scan(iterator):
+            total = [0]
+            seen = 0
+            def rows():
+                for line in iterator:
+                    total[0] += 1
+                    if prefilter is not None and not prefilter(line):
+                        continue
+                    yield parse(line)
+
+            acc = list(zero[1])
+            it = rows()
+            while True:
+                batch = list(itertools.islice(it, batch_size))
+                if not batch:
+                    break
+                if measure is not None:
+                    # the same rows as the sampling of multimatch.compile_tasks
+                    for row in batch[(every - 1 - seen) % every::every]:
+                        measure(row)
+                    seen += len(batch)
+                cols = Columns(batch, projection)
+                for i, f in enumerate(predicates):
+                    mask = predicate_mask(cols, f)
+                    partial = aggregate_mask(cols, selects[i], aggregators[i], mask)
+                    acc[i] = aggregators[i].combOp(acc[i], partial)
+            yield (total[0], acc)
+        return scan
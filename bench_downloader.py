@@ -0,0 +1,73 @@
+#!/usr/bin/env python2
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import synthetic
+import tweetdownloader
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline TweetDownloader benchmark on a synthetic stream")
+    parser.add_argument(
+        "-s", "--seconds",
+        type=float,
+        help="how long to run, default=5",
+        default=5)
+    parser.add_argument(
+        "-w", "--window",
+        type=int,
+        help="the window size (in ms) of each file, default=1000",
+        default=1000)
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        help="rotate files at this size",
+        default=None)
+    parser.add_argument(
+        "--compress",
+        choices=["gzip"],
+        default=None)
+    parser.add_argument(
+        "--buffer-size",
+        type=int,
+        default=100000)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000)
+    args = parser.parse_args()
+
+    destpath = tempfile.mkdtemp() + "/"
+    try:
+        td = tweetdownloader.TweetDownloader(
+            destpath, None, None, None, None,
+            window=args.window,
+            max_bytes=args.max_bytes,
+            compress=args.compress,
+            buffer_size=args.buffer_size,
+            batch_size=args.batch_size,
+            stream=synthetic.SyntheticStream)
+        start = time.time()
+        td.start()
+        time.sleep(args.seconds)
+        td.stop()
+        td.join()
+        elapsed = time.time() - start
+
+        size = sum(os.path.getsize(os.path.join(destpath, f))
+                   for f in os.listdir(destpath))
+        print("received:      %d" % td.received)
+        print("written:       %d (%.0f tweets/s)" % (td.written, td.written / elapsed))
+        print("dropped:       %d" % td.dropped)
+        print("backpressured: %d" % td.backpressured)
+        print("files:         %d" % td.files)
+        print("bytes on disk: %d" % size)
+    finally:
+        shutil.rmtree(destpath)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python2
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import multimatch
+import queryparser
+import scheduler
+import synthetic
+import tokenindex
+
+# Everything the scheduler can run a batch with: the wrapper classes, the
+# single-pass plans, and "auto" for whatever the optimizer picks.
+STRATEGIES = ("plain", "scan", "subquery", "aggregate", "fused", "batch", "auto")
+# Scheduler options: (prefilter, projection, index)
+VARIANTS = {
+    "none": (False, False, False),
+    "prefilter": (True, False, False),
+    "projection": (False, True, False),
+    "both": (True, True, False),
+    "indexed": (True, True, True),
+}
+# Aggregates of the generated queries, in turn.
+SELECTS = [
+    {'agg': 'count', 'field': '*'},
+    {'agg': 'sum', 'field': 'retweet_count'},
+    {'agg': 'max', 'field': 'user.followers_count'},
+    {'agg': 'avg', 'field': 'retweet_count'},
+]
+# Number of lines of the first file on which selectivities are measured.
+SAMPLE_LINES = 1000
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of all strategies on synthetic tweets")
+    parser.add_argument(
+        "-d", "--data-dir",
+        help="where to generate the input files, default=./benchdata/",
+        default="./benchdata/")
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument(
+        "--tweets",
+        type=int,
+        help="tweets per file, default=20000",
+        default=20000)
+    parser.add_argument(
+        "--vocabulary",
+        type=int,
+        help="number of distinct words, default=1000",
+        default=1000)
+    parser.add_argument(
+        "--skew",
+        type=float,
+        help="Zipf exponent of word frequencies (0 is uniform), default=1.0",
+        default=1.0)
+    parser.add_argument(
+        "--length",
+        type=int,
+        help="maximum number of words per tweet, default=12",
+        default=12)
+    parser.add_argument(
+        "--fields",
+        nargs="*",
+        choices=synthetic.FIELDS,
+        help="optional tweet fields to generate, default=all",
+        default=list(synthetic.FIELDS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "-s", "--strategies",
+        nargs="+",
+        choices=STRATEGIES,
+        default=list(STRATEGIES))
+    parser.add_argument(
+        "--variants",
+        nargs="+",
+        choices=sorted(VARIANTS),
+        help="prefilter/projection/index settings to run each strategy with",
+        default=["none"])
+    parser.add_argument(
+        "-n", "--num-queries",
+        nargs="+",
+        type=int,
+        default=[1, 4, 16])
+    parser.add_argument(
+        "--selectivities",
+        nargs="+",
+        type=float,
+        help="target fractions of tweets matched by each query",
+        default=[0.01, 0.1, 0.5])
+    parser.add_argument(
+        "-r", "--repetitions",
+        type=int,
+        default=3)
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        help="untimed runs before each configuration, default=1",
+        default=1)
+    parser.add_argument(
+        "--backend",
+        choices=["spark", "local"],
+        help="run on Spark or on the in-process backend (see localrdd.py), "
+             "default=spark",
+        default="spark")
+    parser.add_argument(
+        "--master",
+        help="Spark master, unless run through spark-submit, default=local[*]",
+        default="local[*]")
+    parser.add_argument(
+        "-o", "--output",
+        help="where to write the results, default=benchmark.json",
+        default="benchmark.json")
+    parser.add_argument(
+        "-b", "--baseline",
+        help="results of an earlier run to compare against",
+        default=None)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="relative slowdown that counts as a regression, default=0.2",
+        default=0.2)
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        help="absolute slowdown below which nothing counts as a regression, "
+             "default=0.05",
+        default=0.05)
+    args = parser.parse_args()
+
+    data = {
+        "files": args.files,
+        "tweets": args.tweets,
+        "vocabulary": args.vocabulary,
+        "skew": args.skew,
+        "length": args.length,
+        "fields": sorted(args.fields),
+        "seed": args.seed,
+    }
+    paths = generate(args.data_dir, data)
+
+    # only read when the gateway is launched, i.e. outside spark-submit
+    os.environ.setdefault(
+        "PYSPARK_SUBMIT_ARGS", "--master %s pyspark-shell" % args.master)
+    bench = Benchmark(args.data_dir, paths, args.backend)
+    try:
+        index = None
+        if any(VARIANTS[v][2] for v in args.variants):
+            index = bench.build_indexes()
+            print("INDEX: %(terms)d terms, %(bytes)d bytes (%(ratio).1f%% of "
+                  "the input) built in %(seconds).3fs" % dict(
+                      index, ratio=100 * index["ratio"]))
+        results = bench.run_grid(
+            args.strategies, args.variants, args.num_queries,
+            args.selectivities, args.repetitions, args.warmup)
+        report = {
+            "started": bench.started,
+            "environment": bench.environment(),
+            "backend": args.backend,
+            "data": data,
+            "job_overhead": bench.job_overhead,
+            "index": index,
+            "results": results,
+        }
+    finally:
+        bench.stop()
+
+    print_results(results)
+    code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("data") != data:
+            print("WARNING: the baseline was run on different data: %s" % baseline.get("data"))
+        if baseline.get("backend", "spark") != args.backend:
+            print("WARNING: the baseline was run on the %s backend" % baseline.get("backend", "spark"))
+        report["baseline"] = args.baseline
+        report["regressions"] = compare(
+            baseline, results, args.threshold, args.min_seconds)
+        for r in report["regressions"]:
+            if r["change"] is None:
+                change = "results no longer correct"
+            else:
+                change = "%(baseline).3fs -> %(median).3fs (%(change)+.0f%%)" % r
+            print("REGRESSION: %s/%s, %d queries at %s: %s" % (
+                r["strategy"], r["variant"], r["queries"], r["selectivity"], change))
+        if report["regressions"]:
+            code = 1
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("Results written to %s" % args.output)
+    sys.exit(code)
+
+def generate(directory, data):
+    """
+    Generates the input files described by data (see main) into directory,
+    unless the files there were generated with the same parameters already.
+    Returns their paths.
+    """
+    manifest = os.path.join(directory, "params.json")
+    paths = [os.path.join(directory, "tweets-%d.txt" % k) for k in xrange(data["files"])]
+    try:
+        with open(manifest) as f:
+            if json.load(f) == data and all(os.path.exists(p) for p in paths):
+                return paths
+    except (IOError, ValueError):
+        pass
+    print("Generating %d files of %d tweets in %s" % (data["files"], data["tweets"], directory))
+    paths = synthetic.write_files(
+        directory, data["files"], data["tweets"], data["seed"],
+        vocabulary=synthetic.vocabulary(data["vocabulary"]),
+        length=data["length"], skew=data["skew"], fields=data["fields"])
+    with open(manifest, "w") as f:
+        json.dump(data, f)
+    return paths
+
+def read_lines(path, limit=None):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if limit is not None and len(lines) >= limit:
+                break
+            lines.append(line.rstrip("\n"))
+    return lines
+
+def make_queries(n, selectivity, rates):
+    """
+    Returns n queries, each matching about the given fraction of tweets: one
+    _contains test on the text per query, with the words whose pass rates
+    (word => rate) are closest to selectivity, and aggregates from SELECTS in
+    turn. Also returns the mean pass rate of the chosen words.
+    """
+    words = sorted(rates, key=lambda w: (abs(rates[w] - selectivity), w))
+    chosen = [words[i % len(words)] for i in xrange(n)]
+    queries = [queryparser.SimpleQuery(
+                   "bench-%d" % i, SELECTS[i % len(SELECTS)],
+                   {'text': {'_contains': w}})
+               for i, w in enumerate(chosen)]
+    return queries, sum(rates[w] for w in chosen) / float(n)
+
+def reference(paths, queries):
+    """
+    Evaluates the queries on the input files in plain Python. Returns the
+    (total, values) result of each file and of all files together, the shapes
+    the scheduler returns for plans and wrapper trees respectively.
+    """
+    predicates = [q.predicate() for q in queries]
+    aggregators = [q.aggregator() for q in queries]
+    per_file = []
+    everything = (0, [a.zero for a in aggregators])
+    for path in paths:
+        total = 0
+        accs = [a.zero for a in aggregators]
+        for line in read_lines(path):
+            tweet = queryparser.parse_input(line)
+            total += 1
+            for i, (f, a) in enumerate(zip(predicates, aggregators)):
+                if f(tweet):
+                    accs[i] = a.seqOp(accs[i], tweet)
+        per_file.append((total, [a.finish(acc) for a, acc in zip(aggregators, accs)]))
+        everything = (everything[0] + total, [
+            a.combOp(x, y) for a, x, y in zip(aggregators, everything[1], accs)])
+    whole = (everything[0], [a.finish(acc) for a, acc in zip(aggregators, everything[1])])
+    return per_file, [whole]
+
+def same(a, b):
+    """
+    Compares results, allowing for rounding in floats (e.g. averages merged in
+    a different order).
+    """
+    if isinstance(a, float) or isinstance(b, float):
+        return a is not None and b is not None and abs(a - b) <= 1e-9 * max(1, abs(a), abs(b))
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return a == b
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+class Benchmark(object):
+
+    def __init__(self, data_dir, paths, backend="spark"):
+        """
+        Runs queries against the input files through the same code path as
+        FlexibleStreamingScheduler.process, with every strategy, measuring the
+        time and the number of Spark jobs of each run. The scheduler is never
+        started: it only provides the SparkContext and the run loop body.
+        With the local backend, everything runs on its localrdd.LocalContext
+        instead.
+        """
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.started = time.time()
+        self.rates = self.word_rates(self.paths[0])
+        # with test queries, the scheduler does not connect to the registry;
+        # the queries of each configuration are passed to run() instead
+        self.scheduler = scheduler.FlexibleStreamingScheduler(
+            data_dir, test_queries=make_queries(1, 0.1, self.rates)[0],
+            mode="auto", local_max_bytes=0 if backend == "local" else None)
+        self.sc = self.scheduler.sc if backend == "spark" else self.scheduler.local
+        self.serial = 0
+        self.job_overhead = self.measure_job_overhead()
+
+    def stop(self):
+        # also the (never started) watcher and the temporary pools file
+        self.scheduler.stop()
+
+    def environment(self):
+        return {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "spark": self.sc.version,
+            "master": self.sc.master,
+            "parallelism": self.sc.defaultParallelism,
+        }
+
+    def build_indexes(self):
+        """
+        Builds the sidecar indexes of the input files (see tokenindex) from
+        scratch. Returns the build time, the size of the indexes in bytes and
+        relative to the input, and their number of terms.
+        """
+        seconds = 0.0
+        nbytes = terms = 0
+        for path in self.paths:
+            start = time.time()
+            index = tokenindex.TokenIndex.build(path)
+            sidecar = tokenindex.sidecar(path, self.scheduler.index_dir)
+            index.save(sidecar)
+            seconds += time.time() - start
+            nbytes += os.path.getsize(sidecar)
+            terms += len(index.postings)
+        input_bytes = sum(os.path.getsize(p) for p in self.paths)
+        return {
+            "seconds": seconds,
+            "bytes": nbytes,
+            "input_bytes": input_bytes,
+            "ratio": nbytes / float(input_bytes) if input_bytes else 0.0,
+            "terms": terms,
+        }
+
+    def word_rates(self, path):
+        """
+        Returns word => fraction of the first lines of path whose text
+        contains it, as the _contains queries test it.
+        """
+        texts = [queryparser.parse_input(line).get('text', '')
+                 for line in read_lines(path, SAMPLE_LINES)]
+        vocabulary = set()
+        for text in texts:
+            vocabulary.update(text.split(' '))
+        return dict((w, sum(1 for t in texts if w in t) / float(len(texts)))
+                    for w in vocabulary)
+
+    def timed(self, function):
+        """
+        Calls function in its own job group. Returns its result, the wall time
+        and the number of Spark jobs it ran.
+        """
+        group = "benchmark-%d" % self.serial
+        self.serial += 1
+        self.sc.setJobGroup(group, "benchmark")
+        start = time.time()
+        try:
+            result = function()
+        finally:
+            seconds = time.time() - start
+            self.sc.setLocalProperty("spark.jobGroup.id", None)
+        jobs = len(self.sc.statusTracker().getJobIdsForGroup(group))
+        return result, seconds, jobs
+
+    def measure_job_overhead(self, repetitions=5):
+        """
+        Returns the median time of a job doing nothing on one partition per
+        core: the fixed cost of every Spark job.
+        """
+        p = self.sc.defaultParallelism
+        rdd = self.sc.parallelize(range(p), p)
+        return median([self.timed(rdd.count)[1] for _ in xrange(repetitions)])
+
+    def measure_stages(self, queries):
+        """
+        Returns the time to read the input, and the extra time to parse every
+        line and to test it against all where clauses at once (a shared scan),
+        each measured as its own pass.
+        """
+        source = ",".join(self.paths)
+        parse = queryparser.parse_input
+        evaluate_any = multimatch.compile_tasks([q.predicate() for q in queries])[1]
+        read = self.timed(self.sc.textFile(source).count)[1]
+        parsed = self.timed(self.sc.textFile(source).map(parse).count)[1]
+        filtered = self.timed(
+            self.sc.textFile(source).map(parse).filter(evaluate_any).count)[1]
+        return {
+            "read": read,
+            "parse": max(0.0, parsed - read),
+            "filter": max(0.0, filtered - parsed),
+        }
+
+    def run_once(self, strategy, queries):
+        s = self.scheduler
+        if strategy == "auto":
+            chosen = s.strategy(self.paths, queries)
+        else:
+            chosen = strategy
+        try:
+            results = s.run(chosen, self.paths, queries, context=self.sc)
+        finally:
+            s.cache_manager.end_file()
+            s.stats.update()
+        return chosen, results
+
+    def run_config(self, strategy, variant, queries, expected, repetitions, warmup):
+        """
+        Runs the queries with one strategy and variant. Returns the wall time
+        and number of jobs of each timed repetition, the strategies actually
+        run, whether all results matched the expected ones, and the error that
+        stopped the runs (or None).
+        """
+        s = self.scheduler
+        s.prefilter, s.projection, s.index = VARIANTS[variant]
+        # compile again with the new options
+        s.compiled = None
+        seconds = []
+        jobs = []
+        chosen = []
+        correct = True
+        try:
+            for i in xrange(warmup + repetitions):
+                (strategy_run, results), t, n = self.timed(
+                    lambda: self.run_once(strategy, queries))
+                if strategy == "auto":
+                    s.optimizer.observe(strategy_run, t)
+                correct = correct and any(same(results, e) for e in expected)
+                if i >= warmup:
+                    seconds.append(t)
+                    jobs.append(n)
+                    chosen.append(strategy_run)
+        except Exception as e:
+            return seconds, jobs, chosen, False, "%s: %s" % (type(e).__name__, e)
+        return seconds, jobs, chosen, correct, None
+
+    def run_grid(self, strategies, variants, counts, selectivities, repetitions, warmup):
+        """
+        Runs every strategy and variant for every number of queries and target
+        selectivity. Returns one result dict per configuration.
+
+        The breakdown of each median time is an estimate: read, parse and
+        filter are the costs of a single shared scan (see measure_stages),
+        overhead is the fixed cost of the jobs the strategy ran, and aggregate
+        is the rest, which includes the extra scans of strategies that do not
+        share them.
+        """
+        results = []
+        for n in counts:
+            for selectivity in selectivities:
+                queries, measured = make_queries(n, selectivity, self.rates)
+                expected = reference(self.paths, queries)
+                stages = self.measure_stages(queries)
+                for variant in variants:
+                    for strategy in strategies:
+                        seconds, jobs, chosen, correct, error = self.run_config(
+                            strategy, variant, queries, expected,
+                            repetitions, warmup)
+                        result = {
+                            "strategy": strategy,
+                            "variant": variant,
+                            "queries": n,
+                            "selectivity": selectivity,
+                            "measured_selectivity": measured,
+                            "seconds": seconds,
+                            "median": None,
+                            "jobs": jobs,
+                            "chosen": chosen,
+                            "correct": correct,
+                            "error": error,
+                            "breakdown": None,
+                        }
+                        results.append(result)
+                        if error is not None:
+                            print("%s/%s, %d queries at %s: FAILED, %s" % (
+                                strategy, variant, n, selectivity, error))
+                            continue
+                        m = median(seconds)
+                        breakdown = dict(stages)
+                        breakdown["overhead"] = self.job_overhead * median(jobs)
+                        breakdown["aggregate"] = max(0.0, m - sum(breakdown.values()))
+                        result["median"] = m
+                        result["breakdown"] = breakdown
+                        print("%s/%s, %d queries at %s: %.3fs, %s jobs%s" % (
+                            strategy, variant, n, selectivity, m, median(jobs),
+                            "" if correct else ", WRONG RESULTS"))
+        return results
+
+def result_key(r):
+    return (r["strategy"], r["variant"], r["queries"], r["selectivity"])
+
+def compare(baseline, results, threshold=0.2, min_seconds=0.05):
+    """
+    Returns the configurations of results whose median time grew by more than
+    threshold (relative) and min_seconds (absolute) over the same
+    configuration in the baseline report, and those that no longer give
+    correct results.
+    """
+    before = dict((result_key(r), r) for r in baseline["results"])
+    regressions = []
+    for r in results:
+        b = before.get(result_key(r))
+        if b is None:
+            continue
+        if r["median"] is None or b["median"] is None:
+            slower = False
+        else:
+            slower = (r["median"] > b["median"] * (1 + threshold) and
+                      r["median"] - b["median"] > min_seconds)
+        if slower or (b["correct"] and not r["correct"]):
+            regressions.append({
+                "strategy": r["strategy"],
+                "variant": r["variant"],
+                "queries": r["queries"],
+                "selectivity": r["selectivity"],
+                "baseline": b["median"],
+                "median": r["median"],
+                "change": (100.0 * (r["median"] - b["median"]) / (b["median"] or 1)
+                           if slower else None),
+                "correct": r["correct"],
+            })
+    return regressions
+
+def print_results(results):
+    print("%-10s %-10s %7s %11s %8s %6s  %s" % (
+        "strategy", "variant", "queries", "selectivity", "median", "jobs",
+        "read/parse/filter/aggregate/overhead"))
+    for r in results:
+        b = r["breakdown"]
+        if b is None:
+            print("%-10s %-10s %7d %11s  FAILED: %s" % (
+                r["strategy"], r["variant"], r["queries"], r["selectivity"], r["error"]))
+            continue
+        print("%-10s %-10s %7d %11s %8.3f %6s  %.3f/%.3f/%.3f/%.3f/%.3f%s" % (
+            r["strategy"], r["variant"], r["queries"], r["selectivity"],
+            r["median"], median(r["jobs"]), b["read"], b["parse"], b["filter"],
+            b["aggregate"], b["overhead"], "" if r["correct"] else "  WRONG"))
+
+if __name__ == "__main__":
+    main()
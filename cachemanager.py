@@ -0,0 +1,137 @@
+import collections
+import threading
+
+import pyspark
+
+class CacheManager(object):
+
+    def __init__(self, context, level="MEMORY_ONLY", budget=None):
+        """
+        Owns the RDDs that wrapper trees cache: megaresults (see
+        ScanSharingWrapper.__getmegaresult__) and explicit cache() or persist()
+        calls. Instead of caching forever, each persisted RDD lives until the
+        evaluation of the current file ends:
+
+            manager = CacheManager(sc, "MEMORY_AND_DISK_SER", budget=1 << 30)
+            lines = AggregateWrapper(sc.textFile(f), cache_manager=manager)
+            ...
+            manager.end_file()    # unpersists, returns the cache report
+
+        RDDs that later files still need (e.g. for windowed or backfill
+        queries) can be kept with retain(), until release().
+
+        level is the StorageLevel (or its name) used for every RDD. If budget
+        (in bytes) is given, persisting an RDD while the managed RDDs use more
+        memory than that evicts those with the lowest expected reuse (the
+        number of queries that read them) per byte first.
+        """
+        if isinstance(level, basestring):
+            level = getattr(pyspark.StorageLevel, level)
+        self.context = context
+        self.level = level
+        self.budget = budget
+        # rdd id => entry, in persist order
+        self.entries = collections.OrderedDict()
+        self.retained = set()
+        self.evicted = 0
+        # wrapper trees persist megaresults from several threads
+        self.lock = threading.RLock()
+
+    def persist(self, rdd, label=None, reuse=1):
+        """
+        Persists rdd at the configured level, to be read by about reuse
+        queries, and returns it.
+        """
+        with self.lock:
+            if rdd.id() not in self.entries:
+                self.evict(rdd.id())
+                rdd.persist(self.level)
+                self.entries[rdd.id()] = {
+                    "rdd": rdd,
+                    "label": label,
+                    "reuse": reuse,
+                }
+            else:
+                self.entries[rdd.id()]["reuse"] += reuse
+        return rdd
+
+    def retain(self, rdd):
+        """
+        Keeps rdd persisted past end_file(), until release().
+        """
+        self.retained.add(rdd.id())
+
+    def release(self, rdd):
+        with self.lock:
+            self.retained.discard(rdd.id())
+            self._unpersist(rdd.id())
+
+    def storage(self):
+        """
+        Returns rdd id => (memory bytes, disk bytes) of all cached RDDs of the
+        context, or an empty dict if Spark does not report them.
+        """
+        try:
+            infos = self.context._jsc.sc().getRDDStorageInfo()
+        except AttributeError:
+            return {}
+        return dict((info.id(), (info.memSize(), info.diskSize())) for info in infos)
+
+    def evict(self, keep=None):
+        """
+        Unpersists managed RDDs (except keep and retained ones) until their
+        memory use is within the budget.
+        """
+        if self.budget is None:
+            return
+        storage = self.storage()
+        used = sum(storage.get(i, (0, 0))[0] for i in self.entries)
+        if used <= self.budget:
+            return
+        def value(i):
+            memory = storage.get(i, (0, 0))[0]
+            return self.entries[i]["reuse"] / float(memory or 1)
+        candidates = [i for i in self.entries
+                      if i != keep and i not in self.retained]
+        for i in sorted(candidates, key=value):
+            if used <= self.budget:
+                break
+            used -= storage.get(i, (0, 0))[0]
+            self._unpersist(i)
+            self.evicted += 1
+
+    def report(self):
+        """
+        Returns one dict per managed RDD with its label, expected reuse and
+        cached memory and disk bytes.
+        """
+        storage = self.storage()
+        report = []
+        for i, entry in self.entries.items():
+            memory, disk = storage.get(i, (0, 0))
+            report.append({
+                "id": i,
+                "label": entry["label"],
+                "reuse": entry["reuse"],
+                "memory": memory,
+                "disk": disk,
+                "retained": i in self.retained,
+            })
+        return report
+
+    def end_file(self):
+        """
+        Ends the evaluation of a file: unpersists all managed RDDs that are not
+        retained, and returns the cache report taken just before.
+        """
+        with self.lock:
+            report = self.report()
+            for i in list(self.entries):
+                if i not in self.retained:
+                    self._unpersist(i)
+        return report
+
+    def _unpersist(self, i):
+        entry = self.entries.pop(i, None)
+        if entry is not None:
+            entry["rdd"].unpersist()
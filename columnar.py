@@ -0,0 +1,45 @@
+import array
+import itertools
+
+def encode(values):
+    """
+    Returns a compact (kind, data) form of a column of values: booleans, ints
+    and floats are packed into typed arrays, anything else stays a list.
+    """
+    if all(type(v) is bool for v in values):
+        return ("bool", array.array("b", values))
+    if all(type(v) is int for v in values):
+        return ("int", array.array("l", values))
+    if all(type(v) is float for v in values):
+        return ("float", array.array("d", values))
+    return ("list", values)
+
+def compact(columns):
+    """
+    Returns a compact form of a list of equally long columns (e.g. the outputs
+    of several functions over the rows of one partition). Each column is
+    encoded (see encode), and a column equal to an earlier one is stored as a
+    reference to it.
+    """
+    out = []
+    for values in columns:
+        encoded = encode(values)
+        for j, other in enumerate(out):
+            if other == encoded and (encoded[0] != "list" or all(
+                    type(a) is type(b) for a, b in itertools.izip(other[1], values))):
+                out.append(("same", j))
+                break
+        else:
+            out.append(encoded)
+    return out
+
+def column(compacted, k):
+    """
+    Returns an iterator over the values of column k of a compacted partition.
+    """
+    kind, data = compacted[k]
+    if kind == "same":
+        return column(compacted, data)
+    if kind == "bool":
+        return itertools.imap(bool, data)
+    return iter(data)
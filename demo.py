@@ -25,6 +25,76 @@ def main():
         type=int,
         help="the window size (in ms) for reading input data, default=10000",
         default=10000)
+    parser.add_argument(
+        "-m", "--mode",
+        choices=scheduler.MODES,
+        help="how queries are executed on each file, default=wrapper",
+        default="wrapper")
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="skip parsing lines that cannot match any query")
+    parser.add_argument(
+        "--projection",
+        action="store_true",
+        help="parse only the fields read by the queries")
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="index each new file in the background, and backfill new "
+             "queries over the indexed files, reading only the lines that may "
+             "match")
+    parser.add_argument(
+        "--max-batch-files",
+        type=int,
+        help="the most backlogged files to process in one batch, default=8",
+        default=8)
+    parser.add_argument(
+        "--stats",
+        help="file to keep predicate statistics in across restarts",
+        default=None)
+    parser.add_argument(
+        "--trace",
+        help="directory to write a trace of each batch to",
+        default=None)
+    parser.add_argument(
+        "--trace-rows",
+        action="store_true",
+        help="also count the rows in and out of each traced step (slower)")
+    parser.add_argument(
+        "--storage-level",
+        help="the Spark storage level of cached results, default=MEMORY_ONLY",
+        default="MEMORY_ONLY")
+    parser.add_argument(
+        "--cache-budget",
+        type=int,
+        help="the most bytes of memory cached results may use, default=unlimited",
+        default=None)
+    parser.add_argument(
+        "--local-max-bytes",
+        type=int,
+        help="run batches of at most this many bytes in-process instead of on "
+             "Spark, default=never",
+        default=None)
+    parser.add_argument(
+        "--local-max-backlog",
+        type=int,
+        help="the most files that may be waiting for a batch to still run "
+             "in-process, default=2",
+        default=2)
+    parser.add_argument(
+        "--local-processes",
+        type=int,
+        help="the number of worker processes of the in-process backend "
+             "(0 or 1 runs its jobs in the driver), default=number of CPUs",
+        default=None)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="the number of threads submitting independent jobs of a batch "
+             "at once, into Spark FAIR scheduler pools by query priority "
+             "(1 to submit them one after another), default=4",
+        default=4)
     parser.add_argument('--no-firehose', dest='firehose', action='store_false')
     parser.set_defaults(firehose=True)
 
@@ -58,7 +128,21 @@ def main():
         print("* Running in static mode, not downloading tweets")
 
     print("* Starting scheduler")
-    fss = scheduler.FlexibleStreamingScheduler(args.watch_dir)
+    fss = scheduler.FlexibleStreamingScheduler(args.watch_dir, mode=args.mode,
+        prefilter=args.prefilter,
+        projection=args.projection,
+        index=args.index,
+        max_batch_files=args.max_batch_files,
+        stats_file=args.stats,
+        trace_dir=args.trace,
+        trace_rows=args.trace_rows,
+        storage_level=args.storage_level,
+        cache_budget=args.cache_budget,
+        local_max_bytes=args.local_max_bytes,
+        local_max_backlog=args.local_max_backlog,
+        local_processes=args.local_processes,
+        concurrency=args.concurrency,
+        target_latency=args.window / 1000.0)
     stop_list.append(fss)
     fss.start()
 
@@ -1,4 +1,12 @@
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import os
+import select
+import struct
+import sys
 import threading
 import time
 
@@ -6,15 +14,16 @@ import safethread
 
 class DirWatcher(safethread.SafeThread):
 
-    def __init__(self, dirname, callback, interval=1):
+    def __init__(self, dirname, callback, interval=1, ignore=()):
         super(DirWatcher, self).__init__(name="DirWatcher")
         self.dirname = dirname
         self.callback = callback
         self.interval = interval
+        self.ignore = set(ignore)
         self.old_files = set()
 
     def action(self):
-        cur_files = set(os.listdir(self.dirname))
+        cur_files = set(os.listdir(self.dirname)) - self.ignore
         if cur_files != self.old_files:
             changes = {
                 'added': list(cur_files - self.old_files),
@@ -23,3 +32,181 @@ class DirWatcher(safethread.SafeThread):
             self.callback(changes)
             self.old_files = cur_files
         time.sleep(self.interval)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class InotifyDirWatcher(safethread.SafeThread):
+
+    def __init__(self, dirname, callback, ignore=()):
+        """
+        Like DirWatcher, but instead of listing the directory every interval,
+        blocks on inotify events and calls back as soon as a file has been
+        written and closed (IN_CLOSE_WRITE) or renamed into the directory
+        (IN_MOVED_TO, e.g. TweetDownloader rotating its tmp file). Files that
+        already exist are reported once when the watcher starts.
+
+        Linux only; see create() for a watcher that falls back to polling.
+        """
+        super(InotifyDirWatcher, self).__init__(name="DirWatcher")
+        self.dirname = dirname
+        self.callback = callback
+        self.ignore = set(ignore)
+
+        self.libc = _libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+        path = os.path.abspath(dirname)
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        if self.libc.inotify_add_watch(self.fd, path, mask) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e), dirname)
+        # Written to by stop() to wake the blocking select in action().
+        self.wake_r, self.wake_w = os.pipe()
+        # guards closing the descriptors against a concurrent stop()
+        self.lock = threading.Lock()
+        self.listed = False
+        # files of the initial listing whose first event is still to come
+        self.unconfirmed = set()
+
+    def action(self):
+        if not self.listed:
+            self.listed = True
+            existing = [f for f in os.listdir(self.dirname) if f not in self.ignore]
+            # files created between adding the watch and listing the
+            # directory also have an event queued: skip it (see unconfirmed)
+            self.unconfirmed = set(existing)
+            if existing:
+                self.callback({'added': existing, 'removed': []})
+
+        try:
+            ready, _, _ = select.select([self.fd, self.wake_r], [], [])
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if self.fd not in ready:
+            return
+
+        buf = os.read(self.fd, 64 * 1024)
+        changes = {'added': [], 'removed': []}
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip("\0")
+            offset += length
+            if not name or name in self.ignore:
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if name in self.unconfirmed:
+                    self.unconfirmed.discard(name)
+                    continue
+                changes['added'].append(name)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                self.unconfirmed.discard(name)
+                changes['removed'].append(name)
+        if changes['added'] or changes['removed']:
+            self.callback(changes)
+
+    def run(self, *args, **kwargs):
+        try:
+            super(InotifyDirWatcher, self).run(*args, **kwargs)
+        finally:
+            # the numbers of closed descriptors may be reused by other files
+            # at once, so stop() must not write to them afterwards
+            with self.lock:
+                for fd in (self.fd, self.wake_r, self.wake_w):
+                    os.close(fd)
+                self.fd = self.wake_r = self.wake_w = None
+
+    def stop(self):
+        super(InotifyDirWatcher, self).stop()
+        with self.lock:
+            if self.wake_w is not None:
+                os.write(self.wake_w, "x")
+
+def create(dirname, callback, interval=1, ignore=()):
+    """
+    Returns an InotifyDirWatcher where inotify is available, and a polling
+    DirWatcher otherwise.
+    """
+    if _libc() is not None:
+        try:
+            return InotifyDirWatcher(dirname, callback, ignore)
+        except OSError as e:
+            print("WARNING: inotify unavailable (%s), polling %s" % (e, dirname))
+    return DirWatcher(dirname, callback, interval, ignore)
+
+class FileQueue(object):
+
+    def __init__(self):
+        """
+        Hands new input files from a watcher thread to the scheduler. get()
+        blocks in select() on a pipe instead of sleeping in a loop, so the
+        consumer wakes up as soon as a file arrives, stays idle otherwise, and
+        can still be interrupted (e.g. by KeyboardInterrupt).
+        """
+        self.items = collections.deque()  # is thread-safe
+        self.closed = False
+        self.wake_r, self.wake_w = os.pipe()
+        flags = fcntl.fcntl(self.wake_w, fcntl.F_GETFL)
+        fcntl.fcntl(self.wake_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def put(self, item):
+        self.items.append(item)
+        self._wake()
+
+    def get(self, block=True):
+        """
+        Removes and returns all queued items. If block is set, waits until
+        there is at least one, or until the queue is closed.
+        """
+        while block and not self.items and not self.closed:
+            try:
+                select.select([self.wake_r], [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            os.read(self.wake_r, 4096)
+        items = []
+        while self.items:
+            items.append(self.items.popleft())
+        return items
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, "x")
+        except OSError as e:
+            # pipe is full, so the consumer has a wake-up pending anyway
+            if e.errno != errno.EAGAIN:
+                raise
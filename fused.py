@@ -0,0 +1,140 @@
+import multimatch
+import queryparser
+
+class FusedPlan(object):
+
+    def __init__(self, queries, prefilter=None, projection=None, stats=None):
+        """
+        Compiles a list of SimpleQuery objects into a single pass over the
+        input. Instead of one Spark job per query (or per shared stage), each
+        partition parses every line once, tests every where clause and folds
+        the matching tweets into a vector of partial aggregates:
+
+            plan = FusedPlan(queries)
+            total, values = plan.run(sc.textFile(filename))
+
+        The per-partition vectors are combined with a single treeAggregate, so
+        the number of Spark jobs per file does not grow with the number of
+        queries.
+
+        If a prefilter (see queryparser.make_prefilter) is given, lines that it
+        rejects are counted but never parsed. If a projection (see
+        queryparser.Projection) is given, lines are parsed into projected rows.
+
+        If a stats.PredicateStats is given, each pass measures the predicates
+        on a sample of the rows (see multimatch.compile_tasks) and evaluates
+        the children of _and and _or in the order of the latest statistics.
+        """
+        self.queries = queries
+        self.prefilter = prefilter
+        self.projection = projection
+        self.stats = stats
+        self.predicates = [q.predicate(projection) for q in queries]
+        self.aggregators = [q.aggregator(projection) for q in queries]
+
+    def zero(self):
+        return (0, [a.zero for a in self.aggregators])
+
+    def partials(self, lines):
+        """
+        Runs the fused pass over an RDD of raw lines and returns the combined
+        (total, accumulators) pair, before the aggregates are finished.
+        """
+        scan = self.scanner(getattr(lines, "context", None))
+        combine = self.combiner()
+        zero = self.zero()
+        return lines.mapPartitions(scan).treeAggregate(zero, combine, combine)
+
+    def partials_by_input(self, inputs):
+        """
+        Like partials, but for several RDDs of raw lines (e.g. one per input
+        file) at once. The inputs are scanned as one union in a single Spark
+        job, and one (total, accumulators) pair is returned per input.
+        """
+        context = inputs[0].context
+        scan = self.scanner(context)
+        combine = self.combiner()
+        zero = self.zero()
+        n = len(inputs)
+
+        # The partitions of a union are those of its inputs, in order.
+        owner = []
+        for k, rdd in enumerate(inputs):
+            owner.extend([k] * rdd.getNumPartitions())
+
+        def scan_input(index, iterator):
+            for pair in scan(iterator):
+                yield (owner[index], pair)
+
+        def seqOp(acc, tagged):
+            k, pair = tagged
+            acc = list(acc)
+            acc[k] = combine(acc[k], pair)
+            return acc
+
+        def combOp(a, b):
+            return [combine(a[k], b[k]) for k in xrange(n)]
+
+        return context.union(inputs).mapPartitionsWithIndex(
+            scan_input).treeAggregate([zero] * n, seqOp, combOp)
+
+    def scanner(self, context=None):
+        """
+        Returns the function folding an iterator of raw lines (one partition)
+        into a single (total, accumulators) pair.
+        """
+        # Bind to local variables to prevent Spark from trying to pickle self.
+        aggregators = self.aggregators
+        evaluate_all, _ = multimatch.compile_tasks(
+            self.ordered_predicates(), context, self.stats)
+        if self.projection is not None:
+            parse = self.projection.parser()
+        else:
+            parse = queryparser.parse_input
+        prefilter = self.prefilter
+        zero = self.zero()
+
+        def scan(iterator):
+            total = 0
+            acc = list(zero[1])
+            for line in iterator:
+                total += 1
+                if prefilter is not None and not prefilter(line):
+                    continue
+                tweet = parse(line)
+                for i, matched in enumerate(evaluate_all(tweet)):
+                    if matched:
+                        acc[i] = aggregators[i].seqOp(acc[i], tweet)
+            yield (total, acc)
+        return scan
+
+    def ordered_predicates(self):
+        """
+        Returns the predicates of the queries, compiled again with the latest
+        statistics if there are any.
+        """
+        if self.stats is None:
+            return self.predicates
+        return [q.predicate(self.projection, self.stats) for q in self.queries]
+
+    def combiner(self):
+        """
+        Returns the function merging two (total, accumulators) pairs.
+        """
+        aggregators = self.aggregators
+        n = len(aggregators)
+
+        def combine(a, b):
+            return (a[0] + b[0],
+                    [aggregators[i].combOp(a[1][i], b[1][i]) for i in xrange(n)])
+        return combine
+
+    def finish(self, partials):
+        """
+        Turns a (total, accumulators) pair into (total, values).
+        """
+        total, acc = partials
+        return total, [a.finish(acc[i]) for i, a in enumerate(self.aggregators)]
+
+    def run(self, lines):
+        return self.finish(self.partials(lines))
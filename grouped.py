@@ -0,0 +1,147 @@
+import heapq
+import json
+
+import multimatch
+import queryparser
+
+def group_key(v):
+    """
+    Turns a field value into a hashable group key. Absent fields group under
+    None, lists and objects under their JSON encoding.
+    """
+    if v is queryparser.Missing:
+        return None
+    if isinstance(v, (list, dict)):
+        return json.dumps(v, sort_keys=True)
+    return v
+
+def rank(group):
+    # largest values first, groups without a value (e.g. avg of nothing) last;
+    # ties are broken by key so that results do not depend on partitioning
+    key, value = group
+    if isinstance(value, dict):
+        # sampled counts
+        value = value['value']
+    return (value is not None, value, key)
+
+def top_groups(groups, n):
+    """
+    Returns the [key, value] pairs of the n groups with the largest values
+    (all groups if n is None), largest first.
+    """
+    if n is None:
+        return sorted(groups, key=rank, reverse=True)
+    return heapq.nlargest(n, groups, key=rank)
+
+class GroupedPlan(object):
+
+    def __init__(self, queries, prefilter=None, projection=None, stats=None):
+        """
+        Compiles a list of grouped SimpleQuery objects (see
+        SimpleQuery.group_field) into a single pass over the input with a
+        single shuffle, however many queries and group fields there are:
+
+            plan = GroupedPlan(queries)
+            values = plan.run(sc.textFile(filename))
+            # values[i] == [[group, value], ...] for queries[i]
+
+        Each partition parses every line once, tests every where clause and
+        folds matching tweets into one partial aggregate per (query index,
+        group) key, so only one record per key and partition is shuffled. A
+        single reduceByKey merges the partials. Since all records of a key end
+        up in the same partition, the top groups of each query (see
+        SimpleQuery.top) are picked per partition before anything is collected.
+
+        prefilter, projection and stats are as in fused.FusedPlan.
+        """
+        self.queries = queries
+        self.prefilter = prefilter
+        self.projection = projection
+        self.stats = stats
+        self.predicates = [q.predicate(projection) for q in queries]
+        self.aggregators = [q.aggregator(projection) for q in queries]
+        self.getters = [queryparser.make_getter(q.group_field(), projection)
+                        for q in queries]
+        self.tops = [q.top() for q in queries]
+
+    def scanner(self, context=None):
+        """
+        Returns the function turning an iterator of raw lines (one partition)
+        into ((query index, group), partial aggregate) records.
+        """
+        # Bind to local variables to prevent Spark from trying to pickle self.
+        aggregators = self.aggregators
+        getters = self.getters
+        predicates = self.predicates
+        if self.stats is not None:
+            predicates = [q.predicate(self.projection, self.stats)
+                          for q in self.queries]
+        evaluate_all, _ = multimatch.compile_tasks(predicates, context, self.stats)
+        if self.projection is not None:
+            parse = self.projection.parser()
+        else:
+            parse = queryparser.parse_input
+        prefilter = self.prefilter
+
+        def scan(iterator):
+            partials = {}
+            for line in iterator:
+                if prefilter is not None and not prefilter(line):
+                    continue
+                tweet = parse(line)
+                for i, matched in enumerate(evaluate_all(tweet)):
+                    if matched:
+                        key = (i, group_key(getters[i](tweet)))
+                        acc = partials.get(key, aggregators[i].zero)
+                        partials[key] = aggregators[i].seqOp(acc, tweet)
+            return partials.iteritems()
+        return scan
+
+    def run(self, lines):
+        return self.run_by_input([lines])[0]
+
+    def run_by_input(self, inputs):
+        """
+        Like run, but for several RDDs of raw lines (e.g. one per input file)
+        at once, still in a single pass and shuffle. Returns one list of
+        grouped values per input.
+        """
+        context = inputs[0].context
+        scan = self.scanner(context)
+        aggregators = self.aggregators
+        tops = self.tops
+        n = len(self.queries)
+
+        # The partitions of a union are those of its inputs, in order.
+        owner = []
+        for k, rdd in enumerate(inputs):
+            owner.extend([k] * rdd.getNumPartitions())
+
+        # All partials of a key belong to the same query. The merge function
+        # is not passed the key, so the query index travels with the value.
+        def scan_input(index, iterator):
+            for (i, group), acc in scan(iterator):
+                yield ((owner[index], i, group), (i, acc))
+
+        def merge(a, b):
+            return (a[0], aggregators[a[0]].combOp(a[1], b[1]))
+
+        def top_by_partition(iterator):
+            groups = {}
+            for (k, i, group), (_, acc) in iterator:
+                groups.setdefault((k, i), []).append(
+                    [group, aggregators[i].finish(acc)])
+            for (k, i), values in groups.iteritems():
+                yield ((k, i), top_groups(values, tops[i]))
+
+        source = inputs[0] if len(inputs) == 1 else context.union(inputs)
+        tops_by_partition = source.mapPartitionsWithIndex(scan_input).reduceByKey(
+            merge).mapPartitions(top_by_partition).collect()
+
+        results = [[[] for _ in xrange(n)] for _ in inputs]
+        for (k, i), values in tops_by_partition:
+            results[k][i].extend(values)
+        for values in results:
+            for i in xrange(n):
+                values[i] = top_groups(values[i], tops[i])
+        return results
@@ -0,0 +1,536 @@
+import collections
+import copy
+import gzip
+import itertools
+import multiprocessing
+import operator
+import os
+import pickle
+import threading
+import weakref
+
+try:
+    import cloudpickle
+except ImportError:
+    try:
+        from pyspark import cloudpickle
+    except ImportError:
+        # Without it, closures cannot be shipped to worker processes and
+        # every job runs in the driver.
+        cloudpickle = None
+
+# Default size of the chunks text files are split into.
+CHUNK_BYTES = 4 * 1024 * 1024
+
+# Accumulators deserialized by the task running in this (worker) process.
+_task_accumulators = {}
+
+JobInfo = collections.namedtuple("JobInfo", ["jobId", "stageIds", "status"])
+
+class LocalBroadcast(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def unpersist(self, blocking=False):
+        pass
+
+    def destroy(self):
+        pass
+
+class NumberParam(object):
+    """
+    AccumulatorParam of accumulators of plain numbers.
+    """
+
+    def zero(self, value):
+        return type(value)()
+
+    def addInPlace(self, a, b):
+        return a + b
+
+def _restore_accumulator(aid, zero, param):
+    accumulator = LocalAccumulator(aid, zero, param)
+    _task_accumulators[aid] = accumulator
+    return accumulator
+
+class LocalAccumulator(object):
+
+    def __init__(self, aid, value, param):
+        """
+        Accumulator of a LocalContext. In a worker process, the copy of the
+        accumulator shipped with a task starts from zero and its value is sent
+        back with the task's result, to be added to the driver's.
+        """
+        self.aid = aid
+        self.param = param
+        self._value = value
+
+    def __reduce__(self):
+        return (_restore_accumulator,
+                (self.aid, self.param.zero(self._value), self.param))
+
+    @property
+    def value(self):
+        return self._value
+
+    def add(self, term):
+        self._value = self.param.addInPlace(self._value, term)
+
+    def __iadd__(self, term):
+        self.add(term)
+        return self
+
+class LocalStatusTracker(object):
+
+    def __init__(self, context):
+        self.context = context
+
+    def getJobIdsForGroup(self, jobGroup=None):
+        return list(self.context._groups.get(jobGroup, ()))
+
+    def getJobInfo(self, jobId):
+        return self.context._jobs.get(jobId)
+
+def read_lines(path, start=0, end=None):
+    """
+    Yields the lines (without line breaks) of a file that start at byte start
+    or later, up to and including the line containing byte end - 1. Chunks
+    [0, a), [a, b), ... of a file thus yield all its lines exactly once.
+    """
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rb")
+    else:
+        f = open(path, "rb")
+    with f:
+        if start > 0:
+            # a line starting right at start is kept, since the byte
+            # before it is its predecessor's line break
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            if line.endswith("\n"):
+                line = line[:-1]
+                if line.endswith("\r"):
+                    line = line[:-1]
+            yield line.decode("utf-8")
+
+def _iterate(source, func):
+    kind, data = source[0], source[1:]
+    if kind == "lines":
+        iterator = read_lines(*data)
+    else:
+        iterator = iter(data[0])
+    if func is not None:
+        iterator = func(iterator)
+    return iterator
+
+def _execute(payload):
+    """
+    Runs one task in a worker process: (source, func, action) as pickled by
+    LocalContext.run. Returns the result and the accumulator updates.
+    """
+    _task_accumulators.clear()
+    source, func, action = pickle.loads(payload)
+    result = action(_iterate(source, func))
+    updates = dict((aid, a._value) for aid, a in _task_accumulators.items())
+    _task_accumulators.clear()
+    return result, updates
+
+def _pipe(inner, func, index):
+    if inner is None:
+        return lambda iterator: func(index, iterator)
+    return lambda iterator: func(index, inner(iterator))
+
+class LocalContext(object):
+
+    def __init__(self, processes=None, chunk_bytes=CHUNK_BYTES):
+        """
+        Stand-in for a SparkContext that runs jobs in this process and a
+        local process pool, without any scheduling or JVM round trips:
+
+            lines = LocalContext().textFile("tweets.txt")
+            print AggregateWrapper(lines).filter(f).count().__eval__()
+
+        It implements the part of the RDD API that the wrappers, plans and the
+        scheduler use. Text files are split into chunks of chunk_bytes, one
+        partition each. Jobs with several partitions to read from files run on
+        a pool of processes (the number of CPUs by default) if cloudpickle is
+        available to ship their functions; all other jobs, e.g. on cached data
+        that would have to be shipped to the workers, run in the driver. Any
+        job whose functions cannot be pickled runs in the driver as well.
+        With processes=0 or 1, every job runs in the driver.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.chunk_bytes = chunk_bytes
+        # at least one partition, or parallelize() would drop all its data
+        self.defaultParallelism = max(1, processes)
+        self.master = "local[%d]" % self.defaultParallelism
+        self.version = "local"
+        self._pool = None
+        self._ids = itertools.count(1)
+        self._accumulators = weakref.WeakValueDictionary()
+        self._local = threading.local()
+        # job group => job ids, job id => JobInfo
+        self._groups = collections.defaultdict(list)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _new_id(self):
+        # negative, so that they never collide with those of Spark RDDs
+        # managed alongside (see cachemanager.CacheManager)
+        with self._lock:
+            return -next(self._ids)
+
+    def _properties(self):
+        if not hasattr(self._local, "properties"):
+            self._local.properties = {}
+        return self._local.properties
+
+    def setJobGroup(self, groupId, description, interruptOnCancel=False):
+        self.setLocalProperty("spark.jobGroup.id", groupId)
+        self.setLocalProperty("spark.job.description", description)
+
+    def setLocalProperty(self, key, value):
+        if value is None:
+            self._properties().pop(key, None)
+        else:
+            self._properties()[key] = value
+
+    def getLocalProperty(self, key):
+        return self._properties().get(key)
+
+    def statusTracker(self):
+        return LocalStatusTracker(self)
+
+    def textFile(self, name, minPartitions=None, use_unicode=True):
+        """
+        Returns an RDD of the lines of a file, a directory of files or a
+        comma-separated list of both.
+        """
+        paths = []
+        for path in name.split(","):
+            if os.path.isdir(path):
+                paths.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                             if not f.startswith((".", "_")))
+            else:
+                paths.append(path)
+        sources = []
+        for path in paths:
+            size = os.path.getsize(path)
+            if path.endswith(".gz") or size <= self.chunk_bytes:
+                sources.append(("lines", path, 0, None))
+                continue
+            chunks = (size + self.chunk_bytes - 1) // self.chunk_bytes
+            for k in xrange(chunks):
+                sources.append(("lines", path, k * self.chunk_bytes,
+                                min(size, (k + 1) * self.chunk_bytes)))
+        return SourceRDD(self, sources)
+
+    def parallelize(self, c, numSlices=None):
+        data = list(c)
+        n = max(1, numSlices or self.defaultParallelism)
+        sources = [("data", data[i * len(data) // n:(i + 1) * len(data) // n])
+                   for i in xrange(n)]
+        return SourceRDD(self, sources)
+
+    def union(self, rdds):
+        return UnionRDD(self, rdds)
+
+    def broadcast(self, value):
+        return LocalBroadcast(value)
+
+    def accumulator(self, value, accum_param=None):
+        if accum_param is None:
+            accum_param = NumberParam()
+        aid = self._new_id()
+        accumulator = LocalAccumulator(aid, value, accum_param)
+        self._accumulators[aid] = accumulator
+        return accumulator
+
+    def run(self, tasks, action):
+        """
+        Runs a job: applies action to the iterator of each (source, func)
+        task, and returns the results in order.
+        """
+        with self._lock:
+            job = len(self._jobs)
+            self._jobs[job] = JobInfo(job, [job], "RUNNING")
+            group = self.getLocalProperty("spark.jobGroup.id")
+            if group is not None:
+                self._groups[group].append(job)
+
+        payloads = None
+        pool = None
+        if len(tasks) > 1 and any(source[0] == "lines" for source, _ in tasks):
+            pool = self._get_pool()
+        if pool is not None:
+            try:
+                payloads = [cloudpickle.dumps((source, func, action), 2)
+                            for source, func in tasks]
+            except Exception:
+                payloads = None
+
+        if payloads is None:
+            results = [action(_iterate(source, func)) for source, func in tasks]
+        else:
+            results = []
+            for result, updates in pool.map(_execute, payloads, chunksize=1):
+                for aid, update in updates.items():
+                    accumulator = self._accumulators.get(aid)
+                    if accumulator is not None:
+                        accumulator.add(update)
+                results.append(result)
+        self._jobs[job] = JobInfo(job, [job], "SUCCEEDED")
+        return results
+
+    def _get_pool(self):
+        if cloudpickle is None or self.processes <= 1:
+            return None
+        with self._lock:
+            if self._pool is None:
+                try:
+                    self._pool = multiprocessing.Pool(self.processes)
+                except (OSError, ImportError) as e:
+                    print("WARNING: no process pool (%s), running jobs serially" % e)
+                    self.processes = 1
+            return self._pool
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class LocalRDD(object):
+
+    def __init__(self, context):
+        """
+        Base of the RDDs of a LocalContext. Transformations are lazy: each RDD
+        describes its partitions as (source, func) tasks, where source is a
+        chunk of a file or a list of items and func the pipeline of narrow
+        transformations applied to it. Actions run those tasks as one job.
+        """
+        self.context = context
+        self._id = context._new_id()
+        self.is_cached = False
+        # partitions, once computed, if cached
+        self._data = None
+
+    def id(self):
+        return self._id
+
+    def getNumPartitions(self):
+        raise NotImplementedError()
+
+    def _compute_tasks(self):
+        raise NotImplementedError()
+
+    def _tasks(self):
+        if not self.is_cached:
+            return self._compute_tasks()
+        if self._data is None:
+            self._data = self.context.run(self._compute_tasks(), list)
+        return [(("data", part), None) for part in self._data]
+
+    def cache(self):
+        return self.persist()
+
+    def persist(self, storageLevel=None):
+        self.is_cached = True
+        return self
+
+    def unpersist(self, blocking=False):
+        self.is_cached = False
+        self._data = None
+        return self
+
+    # Transformations
+
+    def mapPartitionsWithIndex(self, f, preservesPartitioning=False):
+        return PipelinedRDD(self, f)
+
+    def mapPartitions(self, f, preservesPartitioning=False):
+        return PipelinedRDD(self, lambda _, iterator: f(iterator))
+
+    def map(self, f, preservesPartitioning=False):
+        return PipelinedRDD(self, lambda _, iterator: itertools.imap(f, iterator))
+
+    def flatMap(self, f, preservesPartitioning=False):
+        return PipelinedRDD(self, lambda _, iterator: itertools.chain.from_iterable(
+            itertools.imap(f, iterator)))
+
+    def filter(self, f):
+        return PipelinedRDD(self, lambda _, iterator: itertools.ifilter(f, iterator))
+
+    def keys(self):
+        return self.map(lambda (k, v): k)
+
+    def values(self):
+        return self.map(lambda (k, v): v)
+
+    def mapValues(self, f):
+        return self.map(lambda (k, v): (k, f(v)))
+
+    def union(self, other):
+        return UnionRDD(self.context, [self, other])
+
+    def combineByKey(self, createCombiner, mergeValue, mergeCombiners,
+                     numPartitions=None):
+        return ShuffledRDD(self, createCombiner, mergeValue, mergeCombiners,
+                           numPartitions)
+
+    def reduceByKey(self, func, numPartitions=None):
+        return self.combineByKey(lambda v: v, func, func, numPartitions)
+
+    def aggregateByKey(self, zeroValue, seqFunc, combFunc, numPartitions=None):
+        return self.combineByKey(
+            lambda v: seqFunc(copy.deepcopy(zeroValue), v), seqFunc, combFunc,
+            numPartitions)
+
+    # Actions
+
+    def collect(self):
+        return list(itertools.chain.from_iterable(self.context.run(self._tasks(), list)))
+
+    def count(self):
+        return sum(self.context.run(self._tasks(), lambda it: sum(1 for _ in it)))
+
+    def take(self, num):
+        # partition by partition, in the driver, until there are enough
+        items = []
+        for source, func in self._tasks():
+            if len(items) >= num:
+                break
+            items.extend(itertools.islice(_iterate(source, func), num - len(items)))
+        return items
+
+    def first(self):
+        items = self.take(1)
+        if not items:
+            raise ValueError("RDD is empty")
+        return items[0]
+
+    def reduce(self, f):
+        def partial(iterator):
+            for first in iterator:
+                return [reduce(f, iterator, first)]
+            return []
+        values = list(itertools.chain.from_iterable(
+            self.context.run(self._tasks(), partial)))
+        if not values:
+            raise ValueError("Can not reduce() empty RDD")
+        return reduce(f, values)
+
+    def fold(self, zeroValue, op):
+        def partial(iterator):
+            return reduce(op, iterator, copy.deepcopy(zeroValue))
+        return reduce(op, self.context.run(self._tasks(), partial),
+                      copy.deepcopy(zeroValue))
+
+    def aggregate(self, zeroValue, seqOp, combOp):
+        def partial(iterator):
+            return reduce(seqOp, iterator, copy.deepcopy(zeroValue))
+        return reduce(combOp, self.context.run(self._tasks(), partial),
+                      copy.deepcopy(zeroValue))
+
+    def treeAggregate(self, zeroValue, seqOp, combOp, depth=2):
+        return self.aggregate(zeroValue, seqOp, combOp)
+
+    def sum(self):
+        return self.fold(0, operator.add)
+
+class SourceRDD(LocalRDD):
+
+    def __init__(self, context, sources):
+        super(SourceRDD, self).__init__(context)
+        self.sources = sources
+
+    def getNumPartitions(self):
+        return len(self.sources)
+
+    def _compute_tasks(self):
+        return [(source, None) for source in self.sources]
+
+class PipelinedRDD(LocalRDD):
+
+    def __init__(self, parent, func):
+        super(PipelinedRDD, self).__init__(parent.context)
+        self.parent = parent
+        self.func = func
+
+    def getNumPartitions(self):
+        return self.parent.getNumPartitions()
+
+    def _compute_tasks(self):
+        # bind only the functions, not self, into the pickled pipeline
+        func = self.func
+        return [(source, _pipe(inner, func, index))
+                for index, (source, inner) in enumerate(self.parent._tasks())]
+
+class UnionRDD(LocalRDD):
+
+    def __init__(self, context, rdds):
+        super(UnionRDD, self).__init__(context)
+        self.rdds = list(rdds)
+
+    def getNumPartitions(self):
+        return sum(rdd.getNumPartitions() for rdd in self.rdds)
+
+    def _compute_tasks(self):
+        return [task for rdd in self.rdds for task in rdd._tasks()]
+
+class ShuffledRDD(LocalRDD):
+
+    def __init__(self, parent, createCombiner, mergeValue, mergeCombiners,
+                 numPartitions=None):
+        """
+        Result of combineByKey: each task of the parent combines the values of
+        its partition by key, and the driver merges the combiners and hashes
+        the keys into numPartitions partitions. The shuffle runs once, by the
+        first action that needs it.
+        """
+        super(ShuffledRDD, self).__init__(parent.context)
+        self.parent = parent
+        self.createCombiner = createCombiner
+        self.mergeValue = mergeValue
+        self.mergeCombiners = mergeCombiners
+        self.numPartitions = numPartitions
+        self._shuffled = None
+
+    def getNumPartitions(self):
+        return self.numPartitions or self.parent.getNumPartitions()
+
+    def _compute_tasks(self):
+        if self._shuffled is None:
+            createCombiner = self.createCombiner
+            mergeValue = self.mergeValue
+            def combine(iterator):
+                combiners = {}
+                for k, v in iterator:
+                    if k in combiners:
+                        combiners[k] = mergeValue(combiners[k], v)
+                    else:
+                        combiners[k] = createCombiner(v)
+                return combiners.items()
+
+            tasks = self.parent._tasks()
+            merged = {}
+            for items in self.context.run(tasks, combine):
+                for k, c in items:
+                    if k in merged:
+                        merged[k] = self.mergeCombiners(merged[k], c)
+                    else:
+                        merged[k] = c
+            n = max(1, self.getNumPartitions())
+            partitions = [[] for _ in xrange(n)]
+            for k, c in merged.iteritems():
+                partitions[hash(k) % n].append((k, c))
+            self._shuffled = partitions
+        return [(("data", part), None) for part in self._shuffled]
@@ -0,0 +1,67 @@
+import os
+
+class MicroBatcher(object):
+
+    def __init__(self, max_files=8, max_bytes=64 * 1024 * 1024,
+                 target_latency=10.0, smoothing=0.3):
+        """
+        Decides how many pending input files to process together. When the
+        scheduler falls behind, coalescing the backlog into one read saves the
+        job-launch overhead of every file but the first.
+
+        The batch is sized from the observed processing time per byte (an
+        exponentially weighted average with the given smoothing) so that one
+        batch is expected to take about target_latency seconds, and is capped by
+        max_files and max_bytes. Until a rate has been observed, and whenever
+        only one file is pending, files are processed one at a time.
+        """
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.seconds_per_byte = None
+
+    def budget(self):
+        """
+        Returns the number of bytes the next batch may hold.
+        """
+        if self.seconds_per_byte is None:
+            return 0
+        if self.seconds_per_byte == 0:
+            return self.max_bytes
+        return min(self.max_bytes, self.target_latency / self.seconds_per_byte)
+
+    def take(self, pending, size=os.path.getsize):
+        """
+        Pops the next batch of file names off the left of the pending deque. The
+        first file is always taken, further ones while they fit the budget.
+        """
+        batch = [pending.popleft()]
+        total = self._size(size, batch[0])
+        budget = self.budget()
+        while pending and len(batch) < self.max_files:
+            nbytes = self._size(size, pending[0])
+            if total + nbytes > budget:
+                break
+            batch.append(pending.popleft())
+            total += nbytes
+        return batch
+
+    def observe(self, nbytes, seconds):
+        """
+        Records the time it took to process a batch of nbytes.
+        """
+        if nbytes <= 0:
+            return
+        rate = seconds / float(nbytes)
+        if self.seconds_per_byte is None:
+            self.seconds_per_byte = rate
+        else:
+            self.seconds_per_byte += self.smoothing * (rate - self.seconds_per_byte)
+
+    def _size(self, size, name):
+        try:
+            return size(name)
+        except OSError:
+            # vanished or unreadable; let processing report the error
+            return 0
@@ -0,0 +1,226 @@
+import collections
+import time
+
+class AhoCorasick(object):
+
+    def __init__(self, patterns):
+        """
+        Multi-pattern substring matcher. Builds an Aho-Corasick automaton over
+        the given patterns so that a single pass over a string reports every
+        pattern that occurs in it:
+
+            m = AhoCorasick(['happy', 'sad'])
+            m.search('happy and sad')   # => set([0, 1])
+            m.search_any('so sad')      # => True
+
+        Pattern ids are positions in the patterns list. The cost of a search
+        grows with the length of the text, not with the number of patterns.
+        """
+        self.patterns = list(patterns)
+
+        # goto[state] maps a character to the next state, fail[state] is the
+        # state to fall back to on a mismatch, and out[state] is the set of
+        # pattern ids that end in that state (including via fail links).
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [frozenset()]
+
+        ends = collections.defaultdict(set)
+        for pid, pattern in enumerate(self.patterns):
+            if not pattern:
+                raise ValueError("Cannot match an empty pattern")
+            state = 0
+            for ch in pattern:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(frozenset())
+                state = nxt
+            ends[state].add(pid)
+
+        # Breadth-first pass to compute fail links and merge outputs.
+        queue = collections.deque()
+        queue.extend(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            self.out[state] = frozenset(ends[state]) | self.out[self.fail[state]]
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+
+    def search(self, text):
+        """
+        Returns the set of ids of all patterns that occur in text.
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        total = len(self.patterns)
+        found = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+                if len(found) == total:
+                    break
+        return found
+
+    def search_any(self, text):
+        """
+        Returns True as soon as any pattern occurs in text.
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                return True
+        return False
+
+def compile_tasks(tasks, context=None, stats=None):
+    """
+    Compiles a list of per-item tasks (as recorded by ScanSharingWrapper) into
+    two functions over an item:
+
+        evaluate_all(item)  # => [task(item) for task in tasks]
+        evaluate_any(item)  # => any(task(item) for task in tasks)
+
+    Leaf predicates compiled from where clauses (see
+    queryparser.compile_predicate) carry a predicate attribute of the form
+    (field, modifier, value) and a getter attribute reading that field from an
+    item. All '_contains' tasks on the same field are answered by a single
+    AhoCorasick pass over that field; other tasks are called as usual.
+
+    If a SparkContext is given, the automata are broadcast so that they are
+    shipped to each executor once per query set instead of once per task.
+
+    If a stats.PredicateStats is given, evaluate_any tries the remaining tasks
+    cheapest and most likely to pass first. With a SparkContext, both functions
+    also evaluate and time every task on a sample of the items, counting into
+    an accumulator tracked by stats.
+    """
+    groups = collections.OrderedDict()
+    getters = {}
+    for i, task in enumerate(tasks):
+        spec = getattr(task, "predicate", None)
+        if (spec and spec[1] == "_contains" and isinstance(spec[2], basestring)
+                and hasattr(task, "getter")):
+            groups.setdefault(spec[0], []).append((i, spec[2]))
+            getters.setdefault(spec[0], task.getter)
+
+    # A single pattern is better served by the builtin substring search.
+    groups = dict((f, e) for f, e in groups.items() if len(e) > 1)
+    shared = set(i for entries in groups.values() for i, _ in entries)
+    plain = [(i, task) for i, task in enumerate(tasks) if i not in shared]
+
+    # field => (automaton, pattern id => list of task indices)
+    matchers = {}
+    for field, entries in groups.items():
+        patterns = []
+        owners = []
+        for i, value in entries:
+            if value in patterns:
+                owners[patterns.index(value)].append(i)
+            else:
+                patterns.append(value)
+                owners.append([i])
+        matchers[field] = (AhoCorasick(patterns), owners)
+
+    # The getters are closures and travel with the tasks; only the automata are
+    # broadcast.
+    fields = [(field, getters[field], [(i, tasks[i]) for i, _ in groups[field]])
+              for field in matchers]
+    if context is not None and matchers:
+        shipped = context.broadcast(matchers)
+        get_matchers = lambda: shipped.value
+    else:
+        get_matchers = lambda: matchers
+
+    # Only short-circuiting benefits from ordering.
+    ordered = plain
+    if stats is not None:
+        ordered = sorted(plain, key=lambda (i, task): stats.rank_any(task))
+
+    n = len(tasks)
+
+    def evaluate_all(item):
+        result = [False] * n
+        for i, task in plain:
+            result[i] = task(item)
+        matchers = get_matchers()
+        for field, get, members in fields:
+            text = get(item)
+            if isinstance(text, basestring):
+                automaton, owners = matchers[field]
+                for pid in automaton.search(text):
+                    for i in owners[pid]:
+                        result[i] = True
+            else:
+                # not a string (e.g. a list or a missing field): no shortcut
+                for i, task in members:
+                    result[i] = task(item)
+        return result
+
+    def evaluate_any(item):
+        for i, task in ordered:
+            if task(item):
+                return True
+        matchers = get_matchers()
+        for field, get, members in fields:
+            text = get(item)
+            if isinstance(text, basestring):
+                if matchers[field][0].search_any(text):
+                    return True
+            elif any(task(item) for _, task in members):
+                return True
+        return False
+
+    measure = measurer(tasks, context, stats)
+    if measure is None:
+        return evaluate_all, evaluate_any
+    every = stats.sample_every
+
+    def sampled(evaluate):
+        # a copy of the counter is deserialized with each Spark task
+        seen = [0]
+        def f(item):
+            seen[0] += 1
+            if seen[0] % every == 0:
+                measure(item)
+            return evaluate(item)
+        return f
+
+    return sampled(evaluate_all), sampled(evaluate_any)
+
+def measurer(tasks, context, stats):
+    """
+    Returns a function evaluating and timing every task that stats can key on
+    an item, counting into an accumulator tracked by stats, or None if there
+    is no context, no stats or nothing to measure.
+    """
+    if stats is None or context is None:
+        return None
+    measured = [task for task in tasks if stats.key(task) is not None]
+    if not measured:
+        return None
+    accumulator = stats.accumulator(context, [stats.key(t) for t in measured])
+
+    def measure(item):
+        counts = [0.0] * (3 * len(measured))
+        for j, task in enumerate(measured):
+            t = time.time()
+            passed = task(item)
+            counts[3 * j] = 1
+            counts[3 * j + 1] = 1 if passed else 0
+            counts[3 * j + 2] = time.time() - t
+        accumulator.add(counts)
+    return measure
@@ -0,0 +1,154 @@
+import gzip
+import os
+import time
+
+import batch
+import fused
+import multimatch
+import queryparser
+
+# Strategies the optimizer chooses from: the wrapper classes of wrapper.py and
+# the single-pass plans.
+STRATEGIES = ("aggregate", "subquery", "scan", "plain", "fused", "batch")
+
+# Number of lines read from the head of each file to estimate costs.
+SAMPLE_LINES = 500
+
+class Sample(object):
+
+    def __init__(self, filename, queries, size=SAMPLE_LINES):
+        """
+        Measures the queries on the first lines of an input file: selectivity
+        of each query and of their union, and the time per row spent parsing,
+        running each predicate, the shared (union) filter, and the fused and
+        batch passes. Also estimates the number of rows from the file size.
+        """
+        opener = gzip.open if filename.endswith('.gz') else open
+        lines = []
+        with opener(filename) as f:
+            for _ in xrange(size):
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line.rstrip('\n'))
+            consumed = f.fileobj.tell() if hasattr(f, 'fileobj') else f.tell()
+        self.lines = len(lines)
+        n = max(self.lines, 1)
+        self.bytes_per_row = consumed / float(n) if consumed else 1.0
+
+        t = time.time()
+        tweets = [queryparser.parse_input(l) for l in lines]
+        self.parse = (time.time() - t) / n
+
+        predicates = [q.predicate() for q in queries]
+        self.selectivity = []
+        self.predicate = []
+        for f in predicates:
+            t = time.time()
+            matches = sum(1 for tw in tweets if f(tw))
+            self.predicate.append((time.time() - t) / n)
+            self.selectivity.append(matches / float(n))
+
+        _, evaluate_any = multimatch.compile_tasks(predicates)
+        t = time.time()
+        self.union = sum(1 for tw in tweets if evaluate_any(tw)) / float(n)
+        self.shared_filter = (time.time() - t) / n
+        self.fused = self._time(fused.FusedPlan(queries), lines)
+        self.batch = None
+        if batch.np is not None and queryparser.Projection.from_queries(queries):
+            self.batch = self._time(batch.BatchPlan(queries), lines)
+
+    def _time(self, plan, lines):
+        t = time.time()
+        list(plan.scanner()(iter(lines)))
+        return (time.time() - t) / max(len(lines), 1)
+
+class Optimizer(object):
+
+    def __init__(self, job_overhead=0.1, read_cost=2e-6, cache_cost=2e-6,
+                 smoothing=0.3):
+        """
+        Picks the cheapest way to run a set of queries over a file, from the
+        wrapper strategies of wrapper.py and the fused and batch plans.
+
+        Costs (in seconds) are estimated from a Sample of the file with a
+        simple model: a fixed overhead per Spark job, plus per-row costs of
+        reading, parsing, filtering and caching, multiplied by how many times
+        each strategy does them. Because cache() is lazy, a shared megaresult
+        costs no extra job, but is only worth its caching cost when the union
+        filter drops rows that the queries would otherwise refilter.
+
+        After each evaluation, observe() compares the actual time to the
+        estimate and keeps a per-strategy correction factor (exponentially
+        weighted with the given smoothing), so estimates follow the cluster.
+        """
+        self.job_overhead = job_overhead
+        self.read_cost = read_cost
+        self.cache_cost = cache_cost
+        self.smoothing = smoothing
+        self.correction = dict((s, 1.0) for s in STRATEGIES)
+        self.last = None
+
+    def estimate(self, sample, queries, nbytes):
+        """
+        Returns a dict of strategy => estimated seconds for nbytes of input
+        that looks like the sample. Infeasible strategies are left out.
+        """
+        n = nbytes / sample.bytes_per_row
+        q = len(queries)
+        J, R, K, P = self.job_overhead, self.read_cost, self.cache_cost, sample.parse
+        each = sum(sample.predicate)
+        u = sample.union
+
+        costs = {}
+        # One job per query and for the total, each rereading and reparsing.
+        costs["plain"] = J * (q + 1) + n * R * (q + 1) + n * q * P + n * each
+        # Parses are not deduplicated, so the shared map runs q parses per row
+        # and caches q parsed copies; the queries then filter the cache.
+        costs["scan"] = (J * (q + 1) + 2 * n * R + n * q * (P + K) +
+                         n * each)
+        # One parse and one shared filter over the file, caching the union;
+        # each query refilters only the cached union.
+        costs["subquery"] = (J * (q + 1) + 2 * n * R + n * P +
+                             n * sample.shared_filter + n * u * K + n * u * each)
+        # Same plan, with count rewritten into aggregate.
+        costs["aggregate"] = costs["subquery"]
+        costs["fused"] = J + n * R + n * sample.fused
+        if sample.batch is not None:
+            costs["batch"] = J + n * R + n * sample.batch
+
+        for s in costs:
+            costs[s] *= self.correction[s]
+        return costs
+
+    def choose(self, filename, queries, nbytes=None):
+        """
+        Samples the file and returns the strategy with the lowest estimated
+        cost for nbytes of input (the size of the file by default).
+        """
+        if nbytes is None:
+            nbytes = os.path.getsize(filename)
+        sample = Sample(filename, queries)
+        costs = self.estimate(sample, queries, nbytes)
+        # ties go to the first strategy, in the order of STRATEGIES
+        strategy = min((s for s in STRATEGIES if s in costs), key=costs.get)
+        self.last = (strategy, costs[strategy])
+        print("PLAN: %s (estimated %.3fs; %s; selectivity %s, union %.3f)" % (
+            strategy, costs[strategy],
+            ", ".join("%s %.3fs" % (s, costs[s]) for s in STRATEGIES if s in costs),
+            ["%.3f" % x for x in sample.selectivity], sample.union))
+        return strategy
+
+    def observe(self, strategy, seconds):
+        """
+        Records the actual time of the last chosen plan.
+        """
+        if self.last is None or self.last[0] != strategy:
+            return
+        estimated = self.last[1]
+        self.last = None
+        print("PLAN: %s took %.3fs (estimated %.3fs)" % (strategy, seconds, estimated))
+        if estimated <= 0:
+            return
+        ratio = seconds / (estimated / self.correction[strategy])
+        self.correction[strategy] += self.smoothing * (ratio - self.correction[strategy])
@@ -0,0 +1,157 @@
+import collections
+import os
+import re
+
+# TweetDownloader names its files tweets-<window start in ms>-<number>.txt
+FILE_TIME = re.compile(r'-(\d{13})(?:-\d+)?\.')
+
+def file_timestamp(filename):
+    """
+    Returns the time (in ms) of the data in an input file: the window start
+    encoded in the file name if there is one, its modification time otherwise.
+    """
+    m = FILE_TIME.search(os.path.basename(filename))
+    if m:
+        return int(m.group(1))
+    return int(os.path.getmtime(filename) * 1000)
+
+def _sub(a, b):
+    return a - b
+
+def _sub_pair(a, b):
+    return (a[0] - b[0], a[1] - b[1])
+
+# Aggregates whose partials can be subtracted when a pane expires. The others
+# are re-merged from the remaining panes. A sum partial is None if the pane holds
+# no numbers, which the window keeps apart from a sum of 0 (see Window.expire).
+INVERSES = {
+    'count': _sub,
+    'sum': _sub,
+    'avg': _sub_pair,
+}
+
+class Window(object):
+
+    def __init__(self, aggregator, length, inverse=None):
+        """
+        Sliding window state of one query: a sequence of panes, each holding the
+        partial aggregate of one input file, covering the last length ms.
+
+        Adding a pane and reading the window result never rescan the data. If
+        the aggregate has an inverse (count, sum, avg), a running total is kept
+        and expired panes are subtracted from it. Otherwise (min, max, ...) the
+        panes are kept on two stacks so that expired panes are dropped without
+        re-merging the whole window: the front stack stores suffix aggregates,
+        which makes both operations constant time amortized.
+        """
+        self.aggregator = aggregator
+        self.length = length
+        self.inverse = inverse
+        self.latest = None
+
+        # inverse mode: all panes, their running total and how many of them
+        # hold values (a partial other than None)
+        self.panes = collections.deque()
+        self.total = aggregator.zero
+        self.contributing = 0
+
+        # two-stack mode: [(timestamp, partial, suffix aggregate)] and
+        # [(timestamp, partial)] with the aggregate of the latter
+        self.front = []
+        self.back = []
+        self.back_total = aggregator.zero
+
+    def add(self, timestamp, partial):
+        combOp = self.aggregator.combOp
+        self.latest = timestamp if self.latest is None else max(self.latest, timestamp)
+        if self.inverse is not None:
+            self.panes.append((timestamp, partial))
+            self.total = combOp(self.total, partial)
+            if partial is not None:
+                self.contributing += 1
+        else:
+            self.back.append((timestamp, partial))
+            self.back_total = combOp(self.back_total, partial)
+        self.expire()
+
+    def expire(self):
+        """
+        Drops panes that are older than the window, relative to the newest pane.
+        Once no remaining pane holds values, the running total is reset to the
+        zero of the aggregate: subtracting the last sum would leave 0 where a
+        sum of no values finishes to None.
+        """
+        horizon = self.latest - self.length
+        if self.inverse is not None:
+            while self.panes and self.panes[0][0] <= horizon:
+                _, partial = self.panes.popleft()
+                if partial is None:
+                    continue
+                self.contributing -= 1
+                if self.contributing:
+                    self.total = self.inverse(self.total, partial)
+                else:
+                    self.total = self.aggregator.zero
+            return
+
+        combOp = self.aggregator.combOp
+        while True:
+            if not self.front:
+                if not self.back or self.back[0][0] > horizon:
+                    return
+                suffix = self.aggregator.zero
+                while self.back:
+                    timestamp, partial = self.back.pop()
+                    suffix = combOp(partial, suffix)
+                    self.front.append((timestamp, partial, suffix))
+                self.back_total = self.aggregator.zero
+            if self.front[-1][0] > horizon:
+                return
+            self.front.pop()
+
+    def partial(self):
+        if self.inverse is not None:
+            return self.total
+        if self.front:
+            return self.aggregator.combOp(self.front[-1][2], self.back_total)
+        return self.back_total
+
+    def value(self):
+        return self.aggregator.finish(self.partial())
+
+    def __len__(self):
+        return len(self.panes) + len(self.front) + len(self.back)
+
+class PaneStore(object):
+
+    def __init__(self):
+        """
+        Window state of all windowed queries, keyed by query fingerprint (see
+        queryparser.SimpleQuery.fingerprint), so that identical queries share
+        one window whichever of them is evaluated.
+        """
+        self.windows = {}
+
+    def update(self, query, timestamp, partial):
+        """
+        Adds the partial aggregate of one input file as a new pane of the
+        query's window and returns the current window result.
+        """
+        key = query.fingerprint()
+        window = self.windows.get(key)
+        if window is None:
+            # new query, or the query changed: start over
+            window = Window(query.aggregator(), query.window(),
+                            INVERSES.get(query.select['agg']))
+            self.windows[key] = window
+        window.add(timestamp, partial)
+        return window.value()
+
+    def retain(self, queries):
+        """
+        Forgets the state of queries that are no longer active.
+        """
+        keys = set(q.fingerprint() for q in queries)
+        for key in self.windows.keys():
+            if key not in keys:
+                del self.windows[key]
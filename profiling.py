@@ -1,11 +1,14 @@
 import argparse
 import collections
+import json
 import os
 import time
 
 import pyspark
 
+import batch
 import dirwatcher
+import fused
 from queryparser import SimpleQuery
 import wrapper
 
@@ -36,6 +39,12 @@ def main():
         type=int,
         help="number of queries to start with",
         default=1)
+    parser.add_argument(
+        "-m", "--mode",
+        choices=["fused", "batch"],
+        help="run all queries as one fused pass, row-at-a-time or in NumPy batches "
+             "(ignores --wrapper)",
+        default=None)
     parser.add_argument('--sample', dest='sample', action='store_true')
     parser.set_defaults(sample=False)
     args = parser.parse_args()
@@ -71,15 +80,16 @@ def main():
 
     alltimers = []
     for i in range( args.start ,args.num_queries+1):
-        timers = fts.run(queries[:i], test_wrapper, data_source = source, repetitions = args.repetitions)
+        timers = fts.run(queries[:i], test_wrapper, data_source = source, repetitions = args.repetitions, mode = args.mode)
         alltimers.append(timers)
         print( str(i) + '>>>>>>>' )
         print( timers )
 
 
-    print( 'RESULTS >>>>>>>', args.wrapper )
+    label = args.mode or args.wrapper
+    print( 'RESULTS >>>>>>>', label )
     for i, timers in enumerate(alltimers):
-        print(args.start + i, args.wrapper, len(timers), sum(timers)/len(timers), timers )
+        print(args.start + i, label, len(timers), sum(timers)/len(timers), timers )
 
     print( 'DONE >>>>>>>' )
 
@@ -89,7 +99,7 @@ class FlexibleTestScheduler():
     def __init__(self):
         self.sc = pyspark.SparkContext(appName="FlexibleStreaming")
 
-    def run(self, queries, test_wrapper, data_source = './largedata', repetitions = 5):
+    def run(self, queries, test_wrapper, data_source = './largedata', repetitions = 5, mode = None):
 
         # INITIALIZE
         timers = []
@@ -105,21 +115,25 @@ class FlexibleTestScheduler():
             start = time.time()
 
             # reading the entire watch-dir
-            if test_wrapper is None:
-                lines = self.sc.textFile( data_source )
+            if mode is not None:
+                plan = {'fused': fused.FusedPlan, 'batch': batch.BatchPlan}[mode]
+                total, counts = plan(queries).run(self.sc.textFile( data_source ))
             else:
-                lines = test_wrapper(self.sc.textFile( data_source ))
-            #     no minimum line param in case of empty file
+                if test_wrapper is None:
+                    lines = self.sc.textFile( data_source )
+                else:
+                    lines = test_wrapper(self.sc.textFile( data_source ))
+                #     no minimum line param in case of empty file
 
-            total = lines.count()
+                total = lines.count()
 
-            results = [q.apply(lines) for q in queries]
+                results = [q.apply(lines) for q in queries]
 
-            if test_wrapper is None:
-                counts = results
-            else:
-                total = total.__eval__()
-                counts = [rdd.__eval__() for rdd in results]
+                if test_wrapper is None:
+                    counts = results
+                else:
+                    total = total.__eval__()
+                    counts = [rdd.__eval__() for rdd in results]
 
             # STOP TIMER
             end = time.time()
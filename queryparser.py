@@ -1,7 +1,37 @@
+import collections
 import json
-import time
+import re
 
-from pymongo import MongoClient
+import aggregates
+import sketches
+
+# An aggregate split into its parts: the zero value, the function folding a
+# tweet into the accumulator, the function merging two accumulators and the
+# function turning the final accumulator into the result.
+Aggregator = collections.namedtuple(
+    'Aggregator', ['zero', 'seqOp', 'combOp', 'finish'])
+
+# Priorities of queries, lowest first.
+PRIORITIES = ('low', 'normal', 'high')
+
+class Finished(object):
+
+    def __init__(self, result, finish):
+        """
+        The result of an aggregate evaluated through a wrapper tree, and the
+        function turning it into the value of the query: like the wrapper of a
+        count, it is computed by __eval__().
+        """
+        self.result = result
+        self.finish = finish
+
+    def __eval__(self):
+        return self.finish(self.result.__eval__())
+
+def finished(result, finish):
+    if hasattr(result, '__eval__'):
+        return Finished(result, finish)
+    return finish(result)
 
 class Query():
     # Super-simple query class, to be expanded
@@ -18,56 +48,184 @@ class Query():
 
 class SimpleQuery():
 
-    def __init__(self, _id, select, where):
+    def __init__(self, _id, select, where, from_=None, group_by=None,
+                 priority=None):
       self._id = _id
       self.select = select
       self.where = where
+      self.from_ = from_
+      self.group_by = group_by
+      self.priority = priority
+      self._fingerprint = None
 
-    # this is very ugly, there's a much nicer way. fix it
-    def filter(self, rdd):
-        if "_and" in self.where:
-            pass #for now. we'll make this work recursively later
-        elif "_or" in self.where:
-            pass #for now, we'll make this work recursively later
-        else:
-            field = self.where.keys()[0]
-            field_filter = self.where[field]
-            modifier = field_filter.keys()[0]
-            value = field_filter[modifier]
+    def pool(self):
+        """
+        Returns the priority of this query, one of PRIORITIES ('normal' unless
+        written as priority: 'high' or 'low'), which is also the name of the
+        Spark scheduler pool its jobs run in: higher priority pools get a
+        larger share of the cluster while several jobs run at once.
+        """
+        if self.priority in PRIORITIES:
+            return self.priority
+        return 'normal'
 
-            def f(tweet):
-                if not field in tweet:
-                    return False
-                if modifier == '_contains':
-                    return value in tweet[field]
-                elif modifier == '_eq':
-                    return value == tweet[field]
-                elif modifier == '_neq':
-                    return value != tweet[field]
-                else:
-                    raise Exception("Unsupported modifier in filter: {}".format( modifier ))
-            return rdd.filter(f)
-
-    def aggregate(self, rdd):
-        field = self.select['field']
-        agg = self.select['agg']
-        if agg == 'count':
-            return rdd.count()
-        elif agg == 'max':
-            return rdd.reduce(max)
-        elif agg == 'min':
-            return rdd.reduce(min)
-        elif agg == 'sum':
-            return rdd.reduce(sum)
-        elif agg == 'avg':
-            n = rdd.reduce(sum)
-            d = rdd.aggregate(0, lambda acc, _: acc + 1, sum)
-            return n / float(d)
+    def group_field(self):
+        """
+        Returns the (possibly dotted) field this query groups by, or None. A
+        grouped query is written as group_by: {field: 'lang'}, optionally with
+        top: N to keep only the N groups with the largest values.
+        """
+        if not isinstance(self.group_by, dict):
+            return None
+        return self.group_by.get('field') or None
+
+    def top(self):
+        """
+        Returns the number of groups a grouped query keeps, or None for all.
+        """
+        if self.group_field() is None:
+            return None
+        return self.group_by.get('top') or None
+
+    def sample_rate(self):
+        return aggregates.sample_rate(self.select)
+
+    def window(self):
+        """
+        Returns the length (in ms) of the sliding window this query runs over,
+        or None if it runs on each input file separately. A window over the last
+        N ms is written as from: {start: -N, end: 0}. Grouped queries always run
+        on each input file separately.
+        """
+        if not isinstance(self.from_, dict) or self.group_field() is not None:
+            return None
+        start = self.from_.get('start', 0)
+        end = self.from_.get('end', 0)
+        if start >= 0 or end > 0 or end <= start:
+            return None
+        return end - start
+
+    def normalized(self):
+        """
+        Returns the where clause as a normalized predicate tree (see normalize).
+        """
+        return normalize(self.where)
+
+    def fingerprint(self):
+        """
+        Returns a canonical string identifying what this query computes, from
+        its normalized select, where, window and group_by clauses: queries with
+        the same fingerprint have the same results, whatever their ids and
+        however their clauses are written (see dedupe).
+        """
+        if self._fingerprint is None:
+            select = dict((k, literal(v)) for k, v in self.select.iteritems())
+            group = None
+            if self.group_field() is not None:
+                group = (self.group_field(), self.top())
+            self._fingerprint = json.dumps(
+                [select, self.normalized(), self.window(), group],
+                sort_keys=True)
+        return self._fingerprint
+
+    def conjuncts(self):
+        """
+        Returns the list of normalized predicates that all have to hold for a
+        tweet to match this query.
+        """
+        node = self.normalized()
+        if node[0] == '_and':
+            return list(node[1])
+        return [node]
+
+    def fields(self):
+        """
+        Returns the set of (possibly dotted) tweet fields this query reads.
+        """
+        fields = predicate_fields(self.normalized())
+        if self.select['field'] != '*':
+            fields.add(self.select['field'])
+        if self.group_field() is not None:
+            fields.add(self.group_field())
+        if self.sample_rate() is not None:
+            fields.add('id')
+        return fields
+
+    def predicate(self, projection=None, stats=None):
+        """
+        Returns the where clause compiled into a function on (parsed or
+        projected) tweets. See compile_predicate.
+        """
+        return compile_predicate(self.normalized(), projection, stats)
+
+    def filter(self, rdd, projection=None):
+        return rdd.filter(self.predicate(projection))
+
+    def aggregate(self, rdd, projection=None):
+        """
+        Evaluates the aggregate of this query on rdd in a single aggregate
+        call, which AggregateWrapper computes in one pass with the aggregates
+        of the other queries on rdd.
+        """
+        a = self.aggregator(projection)
+        return finished(rdd.aggregate(a.zero, a.seqOp, a.combOp), a.finish)
+
+    def aggregator(self, projection=None):
+        """
+        Returns the aggregate of this query as an Aggregator (see
+        aggregates.py), so that it can also be evaluated as part of a larger
+        pass over the data (see fused.FusedPlan) instead of as its own Spark
+        job.
+        """
+        def read(field):
+            get = make_getter(field, projection)
+            def extract(tweet):
+                v = get(tweet)
+                return None if v is Missing else v
+            return extract
+
+        a = aggregates.create(self.select, read)
+        return Aggregator(a.zero, a.seqOp, a.combOp, a.finish)
+
+    def literals(self):
+        """
+        Returns the set of strings of which at least one must occur verbatim in
+        the raw JSON line of any tweet matching this query, or None if the
+        query can only be decided on the parsed tweet (e.g. _neq).
+        """
+        return predicate_literals(self.normalized())
+
+    def apply(self, source, prefilter=None, projection=None, shared=(),
+              stats=None):
+        """
+        Evaluates the query through a wrapper tree. shared is a list of
+        conjuncts of this query that other queries have as well (see
+        shared_conjuncts): they are applied first, each as a filter whose
+        result is cached, so that queries sharing them scan the cached subset.
+        Only the remaining conjuncts are applied per query.
+        """
+        if prefilter is not None:
+            source = source.filter(prefilter)
+        if projection is None:
+            rdd = source.map(parse_input)
         else:
-            raise Exception("Unsupported aggregator in select: {}".format( agg ))
+            # One cached projected dataset per file, shared by all queries
+            # through the wrapper tree.
+            rdd = source.map(projection.parser()).cache()
+        for node in shared:
+            rdd = rdd.filter(compile_predicate(node, projection)).cache()
 
-    def apply(self, source):
-        return self.aggregate(self.filter(source.map(parse_input)))
+        keys = set(node_key(node) for node in shared)
+        residual = [c for c in self.conjuncts() if node_key(c) not in keys]
+        if residual:
+            node = combine('_and', residual)
+            rdd = rdd.filter(compile_predicate(node, projection, stats))
+        if self.sample_rate() is not None:
+            # only the sample reaches the aggregate; the filter is the same
+            # for all queries sampling at this rate
+            sample = ('id', '_sample', self.sample_rate())
+            rdd = rdd.filter(compile_predicate(sample, projection))
+        return self.aggregate(rdd, projection)
 
 # Here's what a query could look like:
 #
@@ -76,24 +234,315 @@ class SimpleQuery():
 # WHERE "#test" IN hashtags AND location LIKE "%USA%"
 # GROUP BY user.name
 
+# Characters that JSON encoders may escape. A literal containing one of them is
+# not guaranteed to appear verbatim in the raw line.
+RAW_UNSAFE = set('"\\/')
+
+def is_raw_literal(value):
+    return (isinstance(value, basestring) and len(value) > 0 and
+            all(' ' <= c <= '~' and c not in RAW_UNSAFE for c in value))
+
+def make_prefilter(queries):
+    """
+    Returns a function on raw input lines that is False only for lines that no
+    query can match, so that they can be dropped before json.loads. Returns
+    None if some query needs every line to be parsed.
+    """
+    literals = set()
+    for q in queries:
+        l = q.literals()
+        if l is None:
+            return None
+        literals |= l
+    if not literals:
+        return None
+    pattern = re.compile('|'.join(re.escape(str(l)) for l in sorted(literals)))
+
+    def prefilter(line):
+        return pattern.search(line) is not None
+    return prefilter
+
+# Boolean operators of where clauses, whose value is a list of where clauses.
+OPERATORS = ('_and', '_or')
+
+def node_key(node):
+    """
+    Returns a canonical string for a normalized predicate tree.
+    """
+    return json.dumps(node, sort_keys=True)
+
+# The normalized trees that match every tweet and none.
+TRUE = ('_and', ())
+FALSE = ('_or', ())
+
+def literal(value):
+    """
+    Returns the canonical form of a literal of a clause: byte strings are
+    decoded, integral floats become ints, and lists and dicts are canonical
+    recursively, so that literals that compare equal are written the same.
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, list):
+        return [literal(v) for v in value]
+    if isinstance(value, dict):
+        return dict((literal(k), literal(v)) for k, v in value.iteritems())
+    return value
+
+def combine(op, children):
+    """
+    Returns the normalized tree of op ('_and' or '_or') over normalized
+    children: nested trees of the same operator are flattened, duplicates
+    dropped and children sorted, so that equivalent clauses compare equal. A
+    single child is returned as is, and a child deciding the result (FALSE in
+    an _and, TRUE in an _or) replaces the whole tree.
+    """
+    absorbing = FALSE if op == '_and' else TRUE
+    flat = {}
+    for child in children:
+        if child == absorbing:
+            return absorbing
+        if child[0] == op:
+            for c in child[1]:
+                flat[node_key(c)] = c
+        else:
+            flat[node_key(child)] = child
+    if len(flat) == 1:
+        return flat.values()[0]
+    return (op, tuple(flat[k] for k in sorted(flat)))
+
+def normalize(where):
+    """
+    Turns a where clause into a normalized predicate tree. Leaves are
+    (field, modifier, value) tuples, inner nodes ('_and', children) or
+    ('_or', children). Several fields or modifiers in one clause, e.g.
+    {lang: {_eq: 'en'}, text: {_contains: 'a'}}, are a conjunction. An empty
+    clause is the empty conjunction, which matches every tweet.
+    """
+    nodes = []
+    for key in sorted(where):
+        if key in OPERATORS:
+            nodes.append(combine(key, [normalize(w) for w in where[key]]))
+        else:
+            for modifier in sorted(where[key]):
+                nodes.append((key, modifier, literal(where[key][modifier])))
+    if not nodes:
+        return TRUE
+    return combine('_and', nodes)
+
+def predicate_fields(node):
+    if node[0] in OPERATORS:
+        fields = set()
+        for child in node[1]:
+            fields |= predicate_fields(child)
+        return fields
+    return set([node[0]])
+
+def predicate_literals(node):
+    """
+    Returns the set of strings of which at least one occurs verbatim in the
+    raw line of any tweet matching the predicate tree, or None.
+    """
+    if node[0] == '_or':
+        literals = set()
+        for child in node[1]:
+            l = predicate_literals(child)
+            if l is None:
+                return None
+            literals |= l
+        return literals
+    if node[0] == '_and':
+        # any one conjunct must match; the fewer and longer literals the
+        # better
+        candidates = [l for l in map(predicate_literals, node[1]) if l is not None]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda l: (len(l), -min(map(len, l))))
+    field, modifier, value = node
+    if modifier not in ('_contains', '_eq') or not is_raw_literal(value):
+        return None
+    return set([value])
+
+def compile_predicate(node, projection=None, stats=None):
+    """
+    Compiles a normalized predicate tree into a function on parsed tweets (or
+    projected rows, if a Projection is given). The function carries the tree
+    as its predicate attribute; leaves also carry a getter for their field
+    and inner nodes the compiled children. Wrappers recognize predicates by
+    their tree, so separately compiled copies count as the same filter.
+
+    If a stats.PredicateStats is given, the children of an _and are tried most
+    selective first and those of an _or most likely to pass first.
+    """
+    if node[0] in OPERATORS:
+        op, children = node
+        fs = [compile_predicate(c, projection, stats) for c in children]
+        if stats is not None:
+            fs = stats.order_all(fs) if op == '_and' else stats.order_any(fs)
+        if op == '_and':
+            def f(tweet):
+                for g in fs:
+                    if not g(tweet):
+                        return False
+                return True
+        else:
+            def f(tweet):
+                for g in fs:
+                    if g(tweet):
+                        return True
+                return False
+        f.predicate = node
+        f.fingerprint = node_key(node)
+        f.children = fs
+        return f
+
+    field, modifier, value = node
+    get = make_getter(field, projection)
+
+    def f(tweet):
+        v = get(tweet)
+        if v is Missing:
+            return False
+        if modifier == '_contains':
+            return value in v
+        elif modifier == '_eq':
+            return value == v
+        elif modifier == '_neq':
+            return value != v
+        elif modifier == '_sample':
+            return sketches.sampled(v, value)
+        else:
+            raise Exception("Unsupported modifier in filter: {}".format( modifier ))
+    # lets ScanSharingWrapper answer many _contains filters in one pass
+    f.predicate = node
+    f.fingerprint = node_key(node)
+    f.getter = get
+    return f
+
+def dedupe(queries):
+    """
+    Returns the distinct queries by fingerprint (the first of each with the
+    highest priority), and for each query the index of the distinct one
+    computing its results, so that queries asked several times are evaluated
+    once and their results fanned out to all of them.
+    """
+    distinct = []
+    positions = {}
+    index = []
+    for q in queries:
+        key = q.fingerprint()
+        if key not in positions:
+            positions[key] = len(distinct)
+            distinct.append(q)
+        elif (PRIORITIES.index(q.pool()) >
+              PRIORITIES.index(distinct[positions[key]].pool())):
+            distinct[positions[key]] = q
+        index.append(positions[key])
+    return distinct, index
+
+def shared_conjuncts(queries, min_queries=2):
+    """
+    Returns, for each query, the list of its conjuncts that at least
+    min_queries of the queries have, to be hoisted into shared filters (see
+    SimpleQuery.apply). Conjuncts are listed most shared first, in the same
+    order for every query, so that queries with the same shared conjuncts
+    build the same chain of filters.
+    """
+    counts = collections.Counter()
+    for q in queries:
+        counts.update(set(node_key(c) for c in q.conjuncts()))
+    result = []
+    for q in queries:
+        shared = dict((node_key(c), c) for c in q.conjuncts()
+                      if counts[node_key(c)] >= min_queries)
+        order = sorted(shared, key=lambda k: (-counts[k], k))
+        result.append([shared[k] for k in order])
+    return result
+
+class Missing(object):
+    """
+    Marker for a field that is absent from a tweet. The class itself is used as
+    the value, since classes keep their identity when pickled for executors.
+    """
+
+def make_getter(field, projection=None):
+    """
+    Returns a function reading a (possibly dotted, e.g. 'user.name') field from
+    a parsed tweet, or from a projected row if a Projection is given. Absent
+    fields read as Missing.
+    """
+    if projection is not None:
+        index = projection.index(field)
+        return lambda row: row[index]
+    if '.' not in field:
+        return lambda tweet: tweet.get(field, Missing)
+    path = field.split('.')
+    def get(tweet):
+        for key in path:
+            if not isinstance(tweet, dict) or key not in tweet:
+                return Missing
+            tweet = tweet[key]
+        return tweet
+    return get
+
+class Projection(object):
 
-def get_active_queries():
-    # not very efficient to connect every time, but eh...
-    mc = MongoClient('localhost',3001)
-    db = mc.meteor
+    def __init__(self, fields):
+        """
+        A compact representation of tweets that only keeps the given fields.
+        Each line is parsed into a tuple with one slot per field (Missing for
+        absent fields), instead of a dict holding the whole tweet:
 
-    return [ SimpleQuery( q['_id'], q['select'], q['where'] ) for q in db.queries.find({}) ]
+            p = Projection(['lang', 'text'])
+            p.parser()('{"text": "hi", "user": {...}}')  # => (Missing, u'hi')
 
+        Predicates and aggregators compiled with the projection read the slots
+        by index.
+        """
+        self.fields = tuple(sorted(fields))
+        self._index = dict((f, i) for i, f in enumerate(self.fields))
+        self._parser = None
 
-def write_results_to_mongodb( queries, values ):
-  mc = MongoClient('localhost',3001)
-  db = mc.meteor
+    @classmethod
+    def from_queries(cls, queries):
+        """
+        Returns the projection onto all fields read by the queries, or None if
+        some query needs whole tweets.
+        """
+        fields = set()
+        for q in queries:
+            f = q.fields()
+            if f is None:
+                return None
+            fields |= f
+        return cls(fields)
 
-  t = time.time()
+    def index(self, field):
+        return self._index[field]
 
-  for i,q in enumerate(queries):
-      db.results.insert( { 'query_id': q._id, 'time': t, 'values': [ values[i] ] } )
-      print('>>> value inserted into mongodb for {}: {}'.format(q._id, values[i]))
+    def parser(self):
+        """
+        Returns the function turning a raw line into a projected row. The same
+        function object is returned on every call, so that wrappers recognize
+        the parse step as common to all queries.
+        """
+        if self._parser is None:
+            getters = tuple(make_getter(f) for f in self.fields)
+            empty = tuple(Missing for f in self.fields)
+            def parse(line):
+                if len(line) == 0:
+                    return empty
+                tweet = json.loads(line)
+                return tuple(get(tweet) for get in getters)
+            # projections onto the same fields parse alike
+            parse.fingerprint = json.dumps(["projection", self.fields])
+            self._parser = parse
+        return self._parser
 
 def parse_input(i):
     return json.loads(i) if len(i) > 0 else {}
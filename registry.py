@@ -0,0 +1,99 @@
+import time
+
+from pymongo import MongoClient
+
+import queryparser
+
+class QueryRegistry(object):
+
+    def __init__(self, client=None, host='localhost', port=3001, db='meteor',
+                 interval=1.0, change_stream=True):
+        """
+        Long-lived, versioned snapshot of the active queries in MongoDB.
+        Instead of connecting and re-reading every query for each input file,
+        the registry keeps one client (pymongo pools its connections) and the
+        parsed SimpleQuery objects, and only looks for changes:
+
+            registry = QueryRegistry()
+            version, queries = registry.active()
+
+        version increases whenever the set of queries changes, so callers can
+        keep anything they derived from the queries until it does.
+
+        Changes are picked up from a change stream where the server supports
+        one, and otherwise by polling the query ids, at most every interval
+        seconds: new queries are loaded, removed ones dropped. Pass client to
+        use an existing (or a mongomock) client.
+        """
+        self.client = client if client is not None else MongoClient(host, port)
+        self.collection = self.client[db].queries
+        self.interval = interval
+
+        self.version = 0
+        self.queries = []
+        self.last_refresh = None
+
+        self.stream = None
+        if change_stream:
+            try:
+                self.stream = self.collection.watch()
+            except Exception as e:
+                # standalone servers and mongomock have no change streams
+                print("WARNING: no change stream for queries (%s), polling" % e)
+
+    def active(self):
+        """
+        Returns (version, list of active SimpleQuery objects).
+        """
+        self.refresh()
+        return self.version, list(self.queries)
+
+    def refresh(self, force=False):
+        """
+        Brings the snapshot up to date. Returns True if the queries changed.
+        """
+        now = time.time()
+        if self.last_refresh is None:
+            force = True
+        elif not force and now - self.last_refresh < self.interval:
+            return False
+        self.last_refresh = now
+
+        if self.stream is not None and not force:
+            changed = False
+            while self.stream.try_next() is not None:
+                changed = True
+            if not changed:
+                return False
+            return self._reload()
+        return self._poll()
+
+    def _reload(self):
+        self.queries = [to_query(q) for q in self.collection.find({})]
+        self.version += 1
+        return True
+
+    def _poll(self):
+        ids = [q['_id'] for q in self.collection.find({}, {'_id': 1})]
+        known = dict((q._id, q) for q in self.queries)
+        added = [i for i in ids if i not in known]
+        if not added and len(ids) == len(known):
+            return False
+        loaded = {}
+        if added:
+            for q in self.collection.find({'_id': {'$in': added}}):
+                loaded[q['_id']] = to_query(q)
+        self.queries = [known.get(i) or loaded[i] for i in ids
+                        if i in known or i in loaded]
+        self.version += 1
+        return True
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+        self.client.close()
+
+def to_query(doc):
+    return queryparser.SimpleQuery(
+        doc['_id'], doc['select'], doc['where'], doc.get('from'),
+        doc.get('group_by'), doc.get('priority'))
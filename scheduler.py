@@ -1,66 +1,647 @@
 import collections
+import functools
+import json
+import multiprocessing.pool
 import os
+import tempfile
+import threading
 import time
 
 import pyspark
 
+import batch
+import cachemanager
 import dirwatcher
+import fused
+import grouped
+import localrdd
+import microbatch
+import optimizer
+import panes
 import queryparser
+import registry
+import sinks
+import stats
+import tokenindex
+import tracing
 import wrapper
 
+# Execution modes: "wrapper" evaluates each query through an AggregateWrapper
+# tree, "fused" compiles all queries into one pass per file (fused.FusedPlan),
+# "batch" does the same with NumPy column batches (batch.BatchPlan) and "auto"
+# lets the optimizer pick one of optimizer.STRATEGIES per batch of files.
+MODES = ("wrapper", "fused", "batch", "auto")
+PLANS = {"fused": fused.FusedPlan, "batch": batch.BatchPlan}
+WRAPPERS = {
+    "plain": wrapper.Wrapper,
+    "scan": wrapper.ScanSharingWrapper,
+    "subquery": wrapper.CommonSubqueryWrapper,
+    "aggregate": wrapper.AggregateWrapper,
+}
+
+# Sidecar indexes of the input files (see tokenindex) are kept in this
+# subdirectory of the watch directory.
+INDEX_DIR = "index"
+
+# Files in the watch directory that are not input (yet): TweetDownloader writes
+# into tmp and renames it when the window is complete.
+IGNORE = ("tmp", INDEX_DIR)
+
+# Weights of the FAIR scheduler pools, one per query priority (see
+# queryparser.SimpleQuery.pool): while jobs of several pools run, each pool
+# gets cores in proportion to its weight.
+POOL_WEIGHTS = {"low": 1, "normal": 2, "high": 4}
+
+def write_pools(path):
+    """
+    Writes the Spark FAIR scheduler allocation file defining POOL_WEIGHTS.
+    """
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0"?>\n<allocations>\n')
+        for name in queryparser.PRIORITIES:
+            f.write('  <pool name="%s">\n'
+                    '    <schedulingMode>FAIR</schedulingMode>\n'
+                    '    <weight>%d</weight>\n'
+                    '    <minShare>0</minShare>\n'
+                    '  </pool>\n' % (name, POOL_WEIGHTS[name]))
+        f.write('</allocations>\n')
+    return path
+
+def pinned_threads(context):
+    """
+    Tells whether PySpark pins each Python thread to a JVM thread of its own
+    (PYSPARK_PIN_THREAD), so that local properties like the scheduler pool and
+    the job group are kept apart per thread.
+    """
+    try:
+        from py4j.clientserver import ClientServer
+    except ImportError:
+        return False
+    return isinstance(getattr(context, "_gateway", None), ClientServer)
+
+def subtree_key(result):
+    """
+    Returns what a result of a wrapper tree (a wrapper, or a
+    queryparser.Finished) is computed from: aggregates of one parent, which
+    its megaquery computes in one job, have the same key. Results with
+    different keys are independent subtrees, except for the ancestors they
+    share.
+    """
+    w = getattr(result, "result", result)
+    if (isinstance(w, wrapper.ScanSharingWrapper) and w._deferred and
+            w._deferred[0] == "aggregate"):
+        return id(w._wrapped)
+    return id(w)
+
+def pool_of(queries):
+    """
+    Returns the scheduler pool of the highest priority among queries.
+    """
+    pools = [q.pool() for q in queries] or ["normal"]
+    return max(pools, key=queryparser.PRIORITIES.index)
+
+def result_files(filenames, results):
+    """
+    Returns the input files each result of process covers: one file each in
+    the fused and batch modes, and the whole batch for the single result of
+    wrapper mode.
+    """
+    if len(results) == len(filenames):
+        return [[f] for f in filenames]
+    return [filenames] * len(results)
+
+def evaluate_all(results):
+    return [result.__eval__() for result in results]
+
 class FlexibleStreamingScheduler():
 
-    def __init__(self, watch_dir, test_queries=None):
+    def __init__(self, watch_dir, test_queries=None, mode="wrapper",
+                 prefilter=False, projection=False, max_batch_files=8,
+                 max_batch_bytes=64 * 1024 * 1024, target_latency=10.0,
+                 sink=None, stats_file=None, trace_dir=None, trace_rows=False,
+                 storage_level="MEMORY_ONLY", cache_budget=None,
+                 local_max_bytes=None, local_max_backlog=2, local_processes=None,
+                 concurrency=4, index=False):
+        if mode not in MODES:
+            raise ValueError("Unknown execution mode: %s" % mode)
         self.watch_dir = watch_dir
-        self.inputs = collections.deque()  # is thread-safe
+        self.inputs = dirwatcher.FileQueue()
         self.test_queries = test_queries
+        self.mode = mode
+        # drop raw lines that cannot match any query before parsing them
+        self.prefilter = prefilter
+        # parse only the fields the queries read, into compact cached rows
+        self.projection = projection
+        # index each new file in the background, so that queries registered
+        # later are backfilled over it reading only the lines that may match
+        self.index = index
+        self.index_dir = os.path.join(watch_dir, INDEX_DIR)
+        self.indexer = None
+        if index:
+            self.indexer = tokenindex.IndexBuilder(self.index_dir)
+        # (id, fingerprint) of the queries active at the last batch, to find
+        # the ones to backfill
+        self.known = None
+        # sliding window state of windowed queries, one pane per input file
+        self.panes = panes.PaneStore()
+        # sizes batches of backlogged files to about target_latency seconds
+        self.batcher = microbatch.MicroBatcher(
+            max_batch_files, max_batch_bytes, target_latency)
+        self.optimizer = optimizer.Optimizer() if mode == "auto" else None
+        # pass rates and costs of predicates, used to order shared filters;
+        # kept across restarts in stats_file
+        self.stats = stats.PredicateStats(stats_file)
+        # if set, a trace of each batch (see tracing.Tracer) is written there
+        self.trace_dir = trace_dir
+        # traces also count the rows in and out of each step (see
+        # tracing.Tracer), at some cost
+        self.trace_rows = trace_rows
+
+        self.dw = dirwatcher.create(
+            self.watch_dir, self.register_new_input_files, ignore=IGNORE)
+        # independent parts of a batch are submitted from up to concurrency
+        # threads at once, into FAIR scheduler pools by query priority
+        self.concurrency = concurrency
+        self.threads = None
+        self.pools_file = None
+        if concurrency > 1:
+            # only read when the gateway is launched, i.e. outside spark-submit
+            os.environ.setdefault("PYSPARK_PIN_THREAD", "true")
+            handle, self.pools_file = tempfile.mkstemp(prefix="pools-", suffix=".xml")
+            os.close(handle)
+            conf = pyspark.SparkConf()
+            conf.set("spark.scheduler.mode", "FAIR")
+            conf.set("spark.scheduler.allocation.file", write_pools(self.pools_file))
+            self.sc = pyspark.SparkContext(appName="FlexibleStreaming", conf=conf)
+            if not pinned_threads(self.sc):
+                print("WARNING: PySpark threads are not pinned to JVM threads "
+                      "(PYSPARK_PIN_THREAD), submitting jobs from one thread")
+                self.concurrency = 1
+        else:
+            self.sc = pyspark.SparkContext(appName="FlexibleStreaming")
+        # persists the megaresults of each batch, within cache_budget bytes,
+        # and unpersists them when the batch is done
+        self.cache_manager = cachemanager.CacheManager(
+            self.sc, storage_level, cache_budget)
+        # batches of at most local_max_bytes, while at most local_max_backlog
+        # files wait behind them, run in-process instead of as Spark jobs
+        self.local = None
+        if local_max_bytes is not None:
+            self.local = localrdd.LocalContext(local_processes)
+        self.local_max_bytes = local_max_bytes
+        self.local_max_backlog = local_max_backlog
 
-        self.dw = dirwatcher.DirWatcher(
-            self.watch_dir, self.register_new_input_files)
-        self.sc = pyspark.SparkContext(appName="FlexibleStreaming")
+        # active queries, kept up to date from MongoDB
+        self.registry = None
+        if not test_queries:
+            self.registry = registry.QueryRegistry()
+        # results are persisted on a background thread, so that the next file
+        # can be evaluated meanwhile
+        if sink is None and self.registry is not None:
+            sink = sinks.MongoResultSink(self.registry.client)
+        self.sink = sinks.AsyncResultSink(sink) if sink is not None else None
+        # (query ids, strategy, queries, prefilter, projection, plan) of the
+        # last file
+        self.compiled = None
 
     def register_new_input_files(self, changes):
-        if changes['added']:
-            self.inputs.extend(changes['added'])
+        for name in changes['added']:
+            self.inputs.put(name)
+
+    def input_size(self, name):
+        try:
+            return os.path.getsize(os.path.join(self.watch_dir, name))
+        except OSError:
+            return 0
 
     def start(self):
         # START DIRECTORY WATCHER
         self.dw.start()
+        if self.sink is not None:
+            self.sink.start()
 
         # RUN LOOP
+        pending = collections.deque()
         while True:
-            if self.inputs:
-                filename = os.path.abspath(
-                    os.path.join(self.watch_dir, self.inputs.popleft()))
-                print("Detected new file: %s" % filename)
+            # blocks until the watcher reports a new file, unless some are
+            # still pending from a previous batch
+            pending.extend(self.inputs.get(block=not pending))
+            if self.inputs.closed:
+                return
+            if pending:
+                # coalesce backlogged files into one batch
+                names = self.batcher.take(pending, self.input_size)
+                filenames = [os.path.abspath(os.path.join(self.watch_dir, name))
+                             for name in names]
+                print("Detected new file(s): %s" % ", ".join(filenames))
                 if self.test_queries:
                     queries = self.test_queries
                 else:
-                    queries = queryparser.get_active_queries()
+                    version, queries = self.registry.active()
                 print 'queries:', queries
+                if self.index:
+                    self.report_indexes()
+                    self.backfill_new(queries)
 
                 start = time.time()
-                lines = wrapper.AggregateWrapper(self.sc.textFile(filename))
-                #     no minimum line param in case of empty file
-                total = lines.count()
-
-                # Loads all URLs from input file and initialize their neighbors.
-                results = [q.apply(lines) for q in queries]
-
-                total = total.__eval__()
-                counts = [rdd.__eval__() for rdd in results]
+                results = self.process(filenames, queries, len(pending))
                 end = time.time()
+                self.batcher.observe(
+                    sum(self.input_size(name) for name in names), end - start)
 
-                for i,c in enumerate(counts):
-                    print(">>> %s of %s tweets match the filter: %s." % (c, total, queries[i].where))
-
+                self.write_results(filenames, queries, results)
+                if self.index:
+                    self.indexer.submit(filenames)
                 if self.test_queries:
                     print("TIME: %.2f seconds" % (end - start))
                     return
+
+    def strategy(self, filenames, queries):
+        """
+        Returns the strategy to run the queries with: fixed by the mode, or
+        chosen by the optimizer from a sample of the first file.
+        """
+        if self.optimizer is not None:
+            nbytes = sum(self.input_size(f) for f in filenames)
+            return self.optimizer.choose(filenames[0], queries, nbytes)
+        if self.mode == "wrapper":
+            return "aggregate"
+        return self.mode
+
+    def write_results(self, filenames, queries, results):
+        for total, counts in results:
+            for i,c in enumerate(counts):
+                print(">>> %s of %s tweets match the filter: %s." % (c, total, queries[i].where))
+
+        if self.sink is not None:
+            t = time.time()
+            for (total, counts), files in zip(
+                    results, result_files(filenames, results)):
+                self.sink.write(sinks.result_documents(
+                    queries, counts, t, files))
+
+    def report_indexes(self, wait=False):
+        """
+        Prints and returns the reports of the indexes built in the background
+        since the last call (see tokenindex.IndexBuilder).
+        """
+        reports = self.indexer.finished(wait)
+        for report in reports:
+            print("INDEX: %s, %d lines, %d terms, %d bytes in %.2f seconds" % (
+                report["file"], report["lines"], report["terms"],
+                report["bytes"], report["seconds"]))
+        return reports
+
+    def indexed_files(self):
+        """
+        Returns the input files that have been indexed, i.e. processed with
+        index set, oldest first.
+        """
+        if not os.path.isdir(self.index_dir):
+            return []
+        files = []
+        for name in os.listdir(self.index_dir):
+            if not name.endswith(tokenindex.SUFFIX):
+                continue
+            f = os.path.abspath(os.path.join(
+                self.watch_dir, name[:-len(tokenindex.SUFFIX)]))
+            if os.path.exists(f):
+                files.append(f)
+        return sorted(files, key=panes.file_timestamp)
+
+    def backfill_new(self, queries):
+        """
+        Backfills the queries registered or changed since the last call (see
+        backfill). The first call only takes note of the active queries, whose
+        results over earlier files were stored when those were processed.
+        """
+        keys = set((q._id, q.fingerprint()) for q in queries)
+        known, self.known = self.known, keys
+        if known is None:
+            return []
+        # windows are shared by fingerprint (see panes.PaneStore), and
+        # those of known queries are full already
+        windows = set(key for _, key in known)
+        new = [q for q in queries if (q._id, q.fingerprint()) not in known and
+               not (q.window() and q.fingerprint() in windows)]
+        if not new:
+            return []
+        return self.backfill(new)
+
+    def backfill(self, queries):
+        """
+        Evaluates queries over all the input files indexed so far, oldest
+        first, and writes their results as if the queries had been active when
+        the files came in; windowed queries thus start with full windows.
+        Selective queries read only the lines that may match (see
+        indexed_inputs). Returns the (files, results) of each batch.
+        """
+        self.report_indexes(wait=True)
+        files = self.indexed_files()
+        if not files:
+            return []
+        print("Backfilling %d queries over %d file(s)" % (len(queries), len(files)))
+        done = []
+        pending = collections.deque(files)
+        while pending:
+            batch = self.batcher.take(pending, self.input_size)
+            results = self.process(batch, queries, len(pending), backfill=True)
+            self.write_results(batch, queries, results)
+            done.append((batch, results))
+        return done
+
+    def indexed_inputs(self, context, filenames, queries):
+        """
+        Returns the inputs of a batch read through the sidecar indexes of its
+        files, with the number of lines of each file, or None if any file has
+        no up-to-date index or the queries are not selective enough for
+        seeking to their candidate lines to beat reading the whole file (see
+        tokenindex.MAX_CANDIDATES). Lines that are not candidates cannot match
+        any query, so only totals need the indexes' line counts.
+        """
+        if not self.index:
+            return None
+        trees = [q.normalized() for q in queries]
+        selected = []
+        for f in filenames:
+            index = tokenindex.TokenIndex.load(
+                tokenindex.sidecar(f, self.index_dir), f)
+            if index is None:
+                return None
+            lines = index.candidates_any(trees)
+            if lines is None or len(lines) > tokenindex.MAX_CANDIDATES * index.count():
+                return None
+            selected.append((f, index, lines))
+        inputs = [context.parallelize(index.read_lines(f, lines),
+                                      context.defaultParallelism)
+                  for f, index, lines in selected]
+        return inputs, [index.count() for f, index, lines in selected]
+
+    def compile(self, queries, strategy):
+        """
+        Returns the prefilter, projection, fused plan and grouped plan for a
+        list of queries, reusing them for as long as the same queries are
+        active. The fused plan covers the ungrouped queries; for wrapper
+        strategies, only the windowed ones (or is None). The grouped plan runs
+        all grouped queries in one pass (or is None).
+        """
+        key = ([id(q) for q in queries], strategy)
+        if self.compiled is None or self.compiled[:2] != key:
+            prefilter = None
+            if self.prefilter:
+                prefilter = queryparser.make_prefilter(queries)
+            projection = None
+            if self.projection:
+                projection = queryparser.Projection.from_queries(queries)
+
+            ungrouped = [q for q in queries if q.group_field() is None]
+            if strategy in PLANS:
+                plan = PLANS[strategy](ungrouped, prefilter, projection,
+                                       self.stats)
+            else:
+                # windows are merged from partial aggregates, which only the
+                # fused pass exposes
+                windowed = [q for q in ungrouped if q.window()]
+                plan = None
+                if windowed:
+                    plan = fused.FusedPlan(windowed, prefilter, projection,
+                                           self.stats)
+            groups = [q for q in queries if q.group_field() is not None]
+            grouped_plan = None
+            if groups:
+                grouped_plan = grouped.GroupedPlan(groups, prefilter, projection,
+                                                   self.stats)
+            # keep the queries alive so that their ids stay unique
+            self.compiled = key + (queries, prefilter, projection, plan,
+                                   grouped_plan)
+        return self.compiled[3:]
+
+    def context_for(self, filenames, backlog=0):
+        """
+        Returns the context to run a batch of files on: the local backend
+        (see localrdd.LocalContext) for small batches while the backlog of
+        files waiting behind them is short, so that they are not slowed down by
+        Spark's job overhead, and Spark for everything else.
+        """
+        if self.local is None or backlog > self.local_max_backlog:
+            return self.sc
+        if sum(self.input_size(f) for f in filenames) > self.local_max_bytes:
+            return self.sc
+        return self.local
+
+    def process(self, filenames, queries, backlog=0, backfill=False):
+        """
+        Runs all queries against a batch of input files, with backlog more
+        files waiting. Returns a list of (total number of lines, list of query
+        results) pairs: one per file in the fused and batch modes, which
+        attribute results to files within a single pass, and one for the whole
+        batch in wrapper mode.
+
+        Unless backfilling a few queries (see backfill), the queries are all
+        the active ones: the windows of any others are dropped.
+        """
+        start = time.time()
+        if not backfill:
+            self.panes.retain(queries)
+        # duplicates are evaluated once (see run)
+        strategy = self.strategy(filenames, queryparser.dedupe(queries)[0])
+        context = self.context_for(filenames, backlog)
+        tracer = tracing.NULL
+        if self.trace_dir is not None:
+            tracer = tracing.Tracer(context, label=", ".join(filenames),
+                                    rows=self.trace_rows)
+        results = self.run(strategy, filenames, queries, tracer, context)
+        cache = self.cache_manager.end_file()
+        if cache:
+            print("CACHE: %d RDDs, %d bytes in memory, %d on disk (%s)" % (
+                len(cache), sum(c["memory"] for c in cache),
+                sum(c["disk"] for c in cache),
+                ", ".join("%s: %d" % (c["label"], c["memory"]) for c in cache)))
+        self.stats.update()
+        # the optimizer models Spark jobs
+        if self.optimizer is not None and context is self.sc:
+            self.optimizer.observe(strategy, time.time() - start)
+        if self.trace_dir is not None:
+            self.write_trace(tracer, strategy, cache)
+        return results
+
+    def write_trace(self, tracer, strategy, cache):
+        trace = tracer.to_json()
+        trace["strategy"] = strategy
+        trace["cache"] = cache
+        path = os.path.join(self.trace_dir, "trace-%d.json" % int(tracer.started * 1000))
+        with open(path, "w") as f:
+            json.dump(trace, f, indent=1)
+        print(tracer.explain())
+
+    def run(self, strategy, filenames, queries, tracer=tracing.NULL,
+            context=None):
+        if context is None:
+            context = self.sc
+        distinct, index = queryparser.dedupe(queries)
+        if len(distinct) < len(queries):
+            # queries with the same fingerprint are evaluated once, and their
+            # results fanned out to all of them
+            results = self.run(strategy, filenames, distinct, tracer, context)
+            return [(total, [values[i] for i in index])
+                    for total, values in results]
+        prefilter, projection, plan, grouped_plan = self.compile(queries, strategy)
+
+        timestamps = [panes.file_timestamp(f) for f in filenames]
+        ungrouped = [q for q in queries if q.group_field() is None]
+        groups = [q for q in queries if q.group_field() is not None]
+
+        indexed = self.indexed_inputs(context, filenames, queries)
+        if strategy in PLANS:
+            if indexed is not None:
+                inputs = indexed[0]
+            else:
+                inputs = [context.textFile(f) for f in filenames]
+            with tracer.span(None, "run", "%s pass" % strategy):
+                if len(filenames) == 1:
+                    partials = [plan.partials(inputs[0])]
                 else:
-                    queryparser.write_results_to_mongodb( queries, counts )
-            time.sleep(0.1)
+                    partials = plan.partials_by_input(inputs)
+            grouped_values = [[] for _ in inputs]
+            if grouped_plan is not None:
+                with tracer.span(None, "run", "grouped pass"):
+                    grouped_values = grouped_plan.run_by_input(inputs)
+            if indexed is not None:
+                partials = [(total, acc) for total, (_, acc) in
+                            zip(indexed[1], partials)]
+            results = []
+            for timestamp, (total, acc), group_values in zip(
+                    timestamps, partials, grouped_values):
+                values = dict(zip(ungrouped, plan.finish((total, acc))[1]))
+                for i, q in enumerate(ungrouped):
+                    if q.window():
+                        values[q] = self.panes.update(q, timestamp, acc[i])
+                values.update(zip(groups, group_values))
+                results.append((total, [values[q] for q in queries]))
+            return results
+
+        # The wrapper tree reads the whole batch as one input.
+        source = ",".join(filenames)
+        timestamp = max(timestamps)
+        windowed = [q for q in ungrouped if q.window()]
+        plain = [q for q in ungrouped if not q.window()]
+
+        def read():
+            if indexed is None:
+                return context.textFile(source)
+            inputs = indexed[0]
+            return inputs[0] if len(inputs) == 1 else context.union(inputs)
+
+        cls = WRAPPERS[strategy]
+        if issubclass(cls, wrapper.ScanSharingWrapper):
+            lines = cls(read(), stats=self.stats,
+                        tracer=tracer, cache_manager=self.cache_manager)
+        else:
+            lines = cls(read(), tracer=tracer, cache_manager=self.cache_manager)
+        #     no minimum line param in case of empty file
+        total = lines.count() if indexed is None else sum(indexed[1])
+        counted = [(total, None)] if indexed is None else []
+
+        # Loads all URLs from input file and initialize their neighbors.
+        # Conjuncts common to several queries become shared, cached filters.
+        shared = queryparser.shared_conjuncts(plain)
+        results = [q.apply(lines, prefilter, projection, shared[i], self.stats)
+                   for i, q in enumerate(plain)]
+
+        # Results reading the same megaresult are evaluated together; the
+        # independent subtrees and the windowed and grouped passes run
+        # concurrently (see evaluate).
+        subtrees = collections.OrderedDict()
+        for result, q in counted + zip(results, plain):
+            subtrees.setdefault(subtree_key(result), []).append((result, q))
+        tasks = []
+        for members in subtrees.values():
+            tasks.append((pool_of([q for _, q in members if q is not None]),
+                          functools.partial(evaluate_all, [r for r, _ in members])))
+        if windowed:
+            def windowed_pass():
+                with tracer.span(None, "run", "windowed pass"):
+                    return [plan.partials(read())[1]]
+            tasks.append((pool_of(windowed), windowed_pass))
+        if grouped_plan is not None:
+            def grouped_pass():
+                with tracer.span(None, "run", "grouped pass"):
+                    return [grouped_plan.run(read())]
+            tasks.append((pool_of(groups), grouped_pass))
+        outputs = self.evaluate(context, tasks)
+
+        evaluated = dict((id(r), v) for members, output in
+                         zip(subtrees.values(), outputs)
+                         for (r, _), v in zip(members, output))
+        values = dict((q, evaluated[id(r)]) for q, r in zip(plain, results))
+        rest = outputs[len(subtrees):]
+        if windowed:
+            acc = rest.pop(0)[0]
+            for i, q in enumerate(windowed):
+                values[q] = self.panes.update(q, timestamp, acc[i])
+        if grouped_plan is not None:
+            values.update(zip(groups, rest.pop(0)[0]))
+
+        if indexed is None:
+            total = evaluated[id(total)]
+        return [(total, [values[q] for q in queries])]
+
+    def evaluate(self, context, tasks):
+        """
+        Runs tasks, a list of (scheduler pool, function) pairs, and returns
+        the results of the functions in order. Each function triggers the jobs
+        of an independent part of a batch (see run): they are called from up
+        to concurrency threads at once, so that Spark runs their jobs side by
+        side and a batch takes about as long as its longest chain of jobs
+        instead of the sum of all of them. Ancestors shared by several parts
+        are evaluated once, by the first thread to reach them, while the
+        others wait (see wrapper.ScanSharingWrapper).
+
+        The jobs of each function run in its FAIR scheduler pool (see
+        POOL_WEIGHTS). PySpark only keeps local properties apart per Python
+        thread if its threads are pinned to JVM threads (PYSPARK_PIN_THREAD):
+        without pinning, the scheduler runs with a concurrency of 1.
+
+        On the local backend, jobs run in the interpreter (or wait for its
+        process pool), so threads would only contend for the GIL: tasks are
+        called one after another.
+        """
+        # jobs still count towards the job group of the caller (e.g. of
+        # benchmark.Benchmark.timed), which is a thread-local property too
+        group = context.getLocalProperty("spark.jobGroup.id")
+        def call(task):
+            pool, f = task
+            threaded = threading.current_thread() is not caller
+            if threaded and group is not None:
+                context.setLocalProperty("spark.jobGroup.id", group)
+            context.setLocalProperty("spark.scheduler.pool", pool)
+            try:
+                return f()
+            finally:
+                context.setLocalProperty("spark.scheduler.pool", None)
+                if threaded and group is not None:
+                    context.setLocalProperty("spark.jobGroup.id", None)
+        caller = threading.current_thread()
+        if self.concurrency > 1 and len(tasks) > 1 and context is not self.local:
+            if self.threads is None:
+                self.threads = multiprocessing.pool.ThreadPool(self.concurrency)
+            return self.threads.map(call, tasks, chunksize=1)
+        return map(call, tasks)
 
     def stop(self):
+        self.inputs.close()
         self.dw.stop()
+        if self.sink is not None:
+            # flushes everything that is still queued
+            self.sink.close()
+        if self.threads is not None:
+            self.threads.close()
+        if self.indexer is not None:
+            self.indexer.stop()
         self.sc.stop()
+        if self.pools_file is not None:
+            os.remove(self.pools_file)
+        if self.local is not None:
+            self.local.stop()
+        if self.registry is not None:
+            self.registry.close()
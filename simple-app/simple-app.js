@@ -4,10 +4,17 @@ var Queries = new Meteor.Collection('queries');
  * {
  *  _id: query id, automatically assigned by mongodb
  *  select: { agg: 'max', field: 'retweets' }, // select is just one field for now. can be array later maybe.
- *  from: { start: 0, end: 0}, // we don't do range queries yet, so this field is ignored
+ *  // agg is one of count, sum, min, max, avg, variance (sample variance), stddev, and the approximate ones:
+ *  //   { agg: 'percentiles', field: 'retweet_count', percentiles: [ 50, 90, 99 ] } estimates percentiles (~1% relative error)
+ *  //   { agg: 'count', field: '*', sample: 0.01 } counts a 1% sample of the tweets (by id) and scales it up
+ *  //   { agg: 'count_distinct', field: 'user.id' } estimates the number of distinct values (HyperLogLog, ~2% error)
+ *  //   { agg: 'top_k', field: 'entities.hashtags', k: 10 } estimates the 10 most frequent values; list elements
+ *  //     count separately (hashtags by their text), split: true counts the words of a string field
+ *  from: { start: -60000, end: 0}, // sliding window over the last 60s (in ms). omit or use 0 for per-file results
  *  where: { _and: [ { text: { _contains: 'abc' } }, { lang: { _eq: 'en' } } ] } // _and and _or can be nested
  *  // we only support _contains and _eq (equals) for now
- *  group_by: 0 //let's not do this for now, we can implement it later.
+ *  group_by: { field: 'lang', top: 10 }, // optional. aggregate per value of field (dotted paths like 'user.name' work), keeping the 10 largest groups. omit top to keep all. grouped queries ignore from
+ *  priority: 'high' // optional. 'high', 'normal' (default) or 'low': jobs of higher priority queries get more of the cluster while several run at once
  *
  */
 var Results = new Meteor.Collection('results');
@@ -18,7 +25,11 @@ var Results = new Meteor.Collection('results');
  *  query_id: x, //this references the query
  *  time: Date(), // a date object or other timestamp so we can sort on it
  *  values: [ 5 ], // an array with just one value for now. maybe more later.
- *  // when we support group_by, values will have to become an object.
+ *  files: [ 'tweets-1450000000000.txt' ], // the input files the value covers: one per result, or every file of a batch coalesced by the scheduler's wrapper mode
+ *  // for group_by queries, the value is a list of [ group, value ] pairs, largest value first: values: [ [ [ 'en', 12 ], [ 'fr', 3 ] ] ]
+ *  // sampled counts are { value: 1200, error: 67.9, sample: 0.01 }, error being the half-width of the 95% confidence interval
+ *  // percentiles values are lists of [ percentile, value ] pairs: values: [ [ [ 50, 3 ], [ 90, 41.6 ], [ 99, 302.5 ] ] ]
+ *  // top_k values are lists of [ value, count ] pairs, largest count first: values: [ [ [ 'tbt', 40 ], [ 'nyc', 12 ] ] ]
  *
  */
 
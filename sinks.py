@@ -0,0 +1,140 @@
+import json
+import os
+import Queue
+import time
+
+import safethread
+
+def result_documents(queries, values, t=None, files=None):
+    """
+    Returns the documents for the results collection (see simple-app.js) for
+    one evaluation of the queries, over the given input files (names only).
+    """
+    if t is None:
+        t = time.time()
+    documents = [{'query_id': q._id, 'time': t, 'values': [values[i]]}
+                 for i, q in enumerate(queries)]
+    if files is not None:
+        names = [os.path.basename(f) for f in files]
+        for doc in documents:
+            doc['files'] = names
+    return documents
+
+class ResultSink(object):
+    """
+    Destination for query results. write() takes a list of result documents;
+    sinks may buffer them until flush() or close().
+    """
+
+    def write(self, documents):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class MongoResultSink(ResultSink):
+
+    def __init__(self, client, db='meteor'):
+        self.collection = client[db].results
+
+    def write(self, documents):
+        if documents:
+            self.collection.insert_many(documents, ordered=False)
+            print('>>> %d values inserted into mongodb' % len(documents))
+
+class MemoryResultSink(ResultSink):
+
+    def __init__(self):
+        self.documents = []
+
+    def write(self, documents):
+        self.documents.extend(documents)
+
+class FileResultSink(ResultSink):
+
+    def __init__(self, path):
+        """
+        Appends result documents to a file, one JSON object per line.
+        """
+        self.f = open(path, 'a')
+
+    def write(self, documents):
+        for doc in documents:
+            self.f.write(json.dumps(doc, default=str) + '\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+# Queued by close() to tell the writer thread to finish.
+_CLOSE = object()
+
+class AsyncResultSink(safethread.SafeThread, ResultSink):
+
+    def __init__(self, sink, maxsize=64, batch_size=1000):
+        """
+        Moves writes off the caller's thread: write() only queues the documents,
+        and a background thread hands them to the wrapped sink, merging
+        everything that queued up meanwhile (up to batch_size documents) into
+        one write, e.g. one insert_many.
+
+        The queue holds at most maxsize writes. When it is full, write() blocks
+        until the writer catches up (counted in self.blocked), so a slow
+        database slows the scheduler down instead of growing memory. flush()
+        waits until everything queued so far has been written, close() also
+        stops the thread.
+        """
+        super(AsyncResultSink, self).__init__(name="ResultSink")
+        self.daemon = True
+        self.sink = sink
+        self.queue = Queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.blocked = 0
+        self.written = 0
+
+    def write(self, documents):
+        try:
+            self.queue.put_nowait(documents)
+        except Queue.Full:
+            self.blocked += 1
+            self.queue.put(documents)
+
+    def action(self):
+        items = [self.queue.get()]
+        size = len(items[0]) if items[0] is not _CLOSE else 0
+        while size < self.batch_size and items[-1] is not _CLOSE:
+            try:
+                items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+            if items[-1] is not _CLOSE:
+                size += len(items[-1])
+
+        batch = [doc for item in items if item is not _CLOSE for doc in item]
+        try:
+            self.sink.write(batch)
+            self.written += len(batch)
+        finally:
+            for item in items:
+                self.queue.task_done()
+        if items[-1] is _CLOSE:
+            self.sink.close()
+            super(AsyncResultSink, self).stop()
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(_CLOSE)
+            self.join()
+        else:
+            self.sink.close()
+
+    def stop(self):
+        self.close()
@@ -0,0 +1,300 @@
+import hashlib
+import heapq
+import json
+import math
+import struct
+
+# Registers of a HyperLogLog are 2 ** precision bytes; the standard error of
+# its estimates is about 1.04 / sqrt(2 ** precision), 1.6% by default.
+HLL_PRECISION = 12
+
+# Most terms a top_k query may return, so that its result stays small.
+MAX_TOP_K = 1000
+
+# z-score of the error bounds of sampled counts (95% confidence).
+Z = 1.96
+
+# Relative error of the values a QuantileSketch returns, and the most buckets
+# it keeps.
+QUANTILE_ACCURACY = 0.01
+QUANTILE_MAX_BINS = 2048
+
+def canonical(value):
+    """
+    Returns a byte string identifying a field value, the same in every
+    process (unlike hash(), which may be randomized).
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    return repr(value)
+
+def hash64(value):
+    return struct.unpack('<Q', hashlib.md5(canonical(value)).digest()[:8])[0]
+
+def sampled(value, rate):
+    """
+    Tells whether a value (e.g. a tweet id) is in the sample of the given
+    rate. The decision only depends on the value, so all queries sampling at
+    the same rate sample the same tweets, on every executor.
+    """
+    return hash64(value) < rate * 2 ** 64
+
+def sample_estimate(count, rate):
+    """
+    Returns the estimate of a count from the count of a sample of the given
+    rate, with the half-width of its 95% confidence interval, as stored in the
+    results collection.
+    """
+    return {
+        'value': int(round(count / rate)),
+        'error': Z * math.sqrt(count * (1 - rate)) / rate,
+        'sample': rate,
+    }
+
+class HyperLogLog(object):
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        """
+        Sketch of the number of distinct values added to it, in 2 ** precision
+        bytes however many there are. Sketches of the same precision merge
+        into the sketch of the union of their values, so partial sketches can
+        be combined across partitions, files and window panes.
+        """
+        self.precision = precision
+        if registers is None:
+            registers = bytearray(1 << precision)
+        self.registers = registers
+
+    def add(self, value):
+        h = hash64(value)
+        bits = 64 - self.precision
+        rest = h & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        index = h >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Returns a new sketch of the values of both.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        return HyperLogLog(self.precision, bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers)))
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(bytearray(1))
+        if estimate <= 2.5 * m and zeros:
+            # small cardinalities: linear counting of the empty registers
+            estimate = m * math.log(m / float(zeros))
+        return int(round(estimate))
+
+class SpaceSaving(object):
+
+    def __init__(self, capacity, counts=None):
+        """
+        Sketch of the most frequent items added to it (Metwally et al.), in
+        space for capacity items. Each monitored item has a count that
+        overestimates its frequency by at most its error. An item that is not
+        monitored when the sketch is full replaces the one with the smallest
+        count, inheriting that count as its error; items more frequent than
+        1 / capacity of all additions are always monitored.
+
+        Sketches merge into a sketch of all their additions (Agarwal et al.,
+        "Mergeable summaries").
+        """
+        self.capacity = capacity
+        # item => [count, error]
+        self.counts = counts if counts is not None else {}
+
+    def add(self, item, count=1):
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [count, 0]
+        else:
+            smallest = min(self.counts, key=lambda x: self.counts[x][0])
+            floor = self.counts.pop(smallest)[0]
+            self.counts[item] = [floor + count, floor]
+
+    def floor(self):
+        """
+        Returns the most times an item that is not monitored may have been
+        added.
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(c for c, _ in self.counts.itervalues())
+
+    def merge(self, other):
+        """
+        Returns a new sketch of the additions to both.
+        """
+        floors = (self.floor(), other.floor())
+        merged = {}
+        for item in set(self.counts) | set(other.counts):
+            count = error = 0
+            for sketch, floor in zip((self, other), floors):
+                entry = sketch.counts.get(item)
+                if entry is None:
+                    count += floor
+                    error += floor
+                else:
+                    count += entry[0]
+                    error += entry[1]
+            merged[item] = [count, error]
+        capacity = max(self.capacity, other.capacity)
+        if len(merged) > capacity:
+            kept = heapq.nlargest(capacity, merged.iteritems(), key=lambda e: e[1][0])
+            merged = dict(kept)
+        return SpaceSaving(capacity, merged)
+
+    def top(self, k):
+        """
+        Returns the [item, count] pairs of the k items with the largest
+        counts, largest first.
+        """
+        top = heapq.nlargest(k, self.counts.iteritems(),
+                             key=lambda e: (e[1][0], e[0]))
+        return [[item, entry[0]] for item, entry in top]
+
+class QuantileSketch(object):
+
+    def __init__(self, accuracy=QUANTILE_ACCURACY, max_bins=QUANTILE_MAX_BINS,
+                 positive=None, negative=None, zeros=0):
+        """
+        Sketch of the distribution of the numbers added to it (DDSketch,
+        Masson et al.): numbers are counted in buckets of logarithmically
+        growing width, so every quantile it returns is within accuracy of the
+        true value, relative to that value. Its size only depends on the range
+        of the numbers, and is bounded by max_bins by collapsing the buckets of
+        the smallest magnitudes. Sketches of the same accuracy merge by adding
+        their bucket counts.
+        """
+        self.accuracy = accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # bucket index => count, for positive numbers and magnitudes of
+        # negative ones
+        self.positive = positive if positive is not None else {}
+        self.negative = negative if negative is not None else {}
+        self.zeros = zeros
+
+    def index(self, magnitude):
+        return int(math.ceil(math.log(magnitude) / self.log_gamma))
+
+    def add(self, value):
+        if value > 0:
+            bins = self.positive
+        elif value < 0:
+            bins = self.negative
+            value = -value
+        else:
+            self.zeros += 1
+            return
+        i = self.index(value)
+        bins[i] = bins.get(i, 0) + 1
+        if len(bins) > self.max_bins:
+            self.collapse(bins)
+
+    def collapse(self, bins):
+        """
+        Folds the buckets of the smallest magnitudes into one, until at most
+        max_bins remain.
+        """
+        indices = sorted(bins)
+        extra = len(indices) - self.max_bins
+        if extra <= 0:
+            return
+        target = indices[extra]
+        for i in indices[:extra]:
+            bins[target] += bins.pop(i)
+
+    def count(self):
+        return (sum(self.positive.itervalues()) +
+                sum(self.negative.itervalues()) + self.zeros)
+
+    def merge(self, other):
+        """
+        Returns a new sketch of the numbers of both.
+        """
+        if other.accuracy != self.accuracy:
+            raise ValueError("Cannot merge QuantileSketches of different accuracy")
+        merged = QuantileSketch(self.accuracy, max(self.max_bins, other.max_bins),
+                                dict(self.positive), dict(self.negative),
+                                self.zeros + other.zeros)
+        for mine, theirs in ((merged.positive, other.positive),
+                             (merged.negative, other.negative)):
+            for i, c in theirs.iteritems():
+                mine[i] = mine.get(i, 0) + c
+            merged.collapse(mine)
+        return merged
+
+    def value(self, i):
+        # the midpoint of bucket i, within accuracy of all the numbers in it
+        return 2 * self.gamma ** i / (self.gamma + 1)
+
+    def quantile(self, q):
+        """
+        Returns the q-quantile (0 <= q <= 1) of the numbers added, or None if
+        there are none.
+        """
+        n = self.count()
+        if not n:
+            return None
+        rank = q * (n - 1)
+        seen = 0
+        for i in sorted(self.negative, reverse=True):
+            seen += self.negative[i]
+            if seen > rank:
+                return -self.value(i)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for i in sorted(self.positive):
+            seen += self.positive[i]
+            if seen > rank:
+                return self.value(i)
+
+def merge(a, b):
+    """
+    combOp of sketch aggregates, whose accumulators are None until the first
+    value. Never modifies its arguments, which may be shared (e.g. by window
+    panes).
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a.merge(b)
+
+def items(value, split=False):
+    """
+    Returns the items a field value contributes to a top_k query: each
+    element of a list (the text of objects like hashtags), the lowercased
+    words of a string if split is set, or the value itself.
+    """
+    if isinstance(value, list):
+        values = value
+    elif split and isinstance(value, basestring):
+        return value.lower().split()
+    else:
+        values = [value]
+    result = []
+    for v in values:
+        if isinstance(v, dict):
+            v = v['text'] if 'text' in v else json.dumps(v, sort_keys=True)
+        elif isinstance(v, list):
+            v = json.dumps(v, sort_keys=True)
+        result.append(v)
+    return result
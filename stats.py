@@ -0,0 +1,149 @@
+import json
+import os
+import time
+
+class VectorParam(object):
+    """
+    AccumulatorParam for fixed-length lists of numbers, added element-wise.
+    """
+
+    def zero(self, value):
+        return [0] * len(value)
+
+    def addInPlace(self, a, b):
+        for i in xrange(len(b)):
+            a[i] += b[i]
+        return a
+
+class PredicateStats(object):
+
+    def __init__(self, path=None, half_life=3600.0, prior_rate=0.5,
+                 prior_weight=10.0, default_cost=1e-6, sample_every=64):
+        """
+        Pass rates and evaluation costs of predicates, measured across files.
+
+        Shared filters compiled with a PredicateStats (see
+        multimatch.compile_tasks) evaluate and time every predicate on one row
+        in sample_every, instead of short-circuiting, and add the counts to a
+        Spark accumulator; update() folds the accumulators of finished jobs
+        into the statistics.
+
+        Old observations decay with the given half life (in seconds), so the
+        statistics follow changes in the traffic mix. Until there are enough
+        observations, pass rates are pulled towards prior_rate (with the weight
+        of prior_weight evaluations). If a path is given, the statistics are
+        loaded from and saved to that JSON file.
+        """
+        self.path = path
+        self.half_life = half_life
+        self.prior_rate = prior_rate
+        self.prior_weight = prior_weight
+        self.default_cost = default_cost
+        self.sample_every = sample_every
+
+        # key => [evaluations, passes, seconds], decayed to self.updated
+        self.entries = {}
+        self.updated = time.time()
+        # (keys, accumulator) of jobs not yet folded in
+        self.pending = []
+
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.entries = state["entries"]
+            self.updated = state["updated"]
+
+    def key(self, f):
+        """
+        Returns the key of a predicate carrying a predicate attribute (see
+        SimpleQuery.predicate), or None if it has none.
+        """
+        spec = getattr(f, "predicate", None)
+        if spec is None:
+            return None
+        return json.dumps(list(spec))
+
+    def pass_rate(self, key):
+        e = self.entries.get(key)
+        if e is None:
+            return self.prior_rate
+        return ((e[1] + self.prior_rate * self.prior_weight) /
+                (e[0] + self.prior_weight))
+
+    def cost(self, key):
+        e = self.entries.get(key)
+        if e is None or e[0] <= 0:
+            return self.default_cost
+        return e[2] / e[0]
+
+    def rank_any(self, f):
+        """
+        Sort key placing the cheapest predicates that are most likely to pass
+        first, for disjunctions (any/_or): cost / pass rate.
+        """
+        key = self.key(f)
+        return self.cost(key) / max(self.pass_rate(key), 1e-9)
+
+    def rank_all(self, f):
+        """
+        Sort key placing the cheapest and most selective predicates first, for
+        conjunctions (_and): cost / fail rate.
+        """
+        key = self.key(f)
+        return self.cost(key) / max(1.0 - self.pass_rate(key), 1e-9)
+
+    def order_any(self, predicates):
+        return sorted(predicates, key=self.rank_any)
+
+    def order_all(self, predicates):
+        return sorted(predicates, key=self.rank_all)
+
+    def accumulator(self, context, keys):
+        """
+        Returns a new Spark accumulator of [evaluations, passes, seconds] for
+        each of the keys, to be folded in by the next update().
+        """
+        accumulator = context.accumulator([0.0] * (3 * len(keys)), VectorParam())
+        self.pending.append((list(keys), accumulator))
+        return accumulator
+
+    def record(self, key, evaluations, passes, seconds, now=None):
+        if now is None:
+            now = time.time()
+        self._decay(now)
+        e = self.entries.setdefault(key, [0.0, 0.0, 0.0])
+        e[0] += evaluations
+        e[1] += passes
+        e[2] += seconds
+
+    def update(self):
+        """
+        Folds the counts of all tracked accumulators into the statistics and
+        saves them. Call after the jobs using them have run.
+        """
+        now = time.time()
+        for keys, accumulator in self.pending:
+            value = accumulator.value
+            for i, key in enumerate(keys):
+                if value[3 * i]:
+                    self.record(key, value[3 * i], value[3 * i + 1],
+                                value[3 * i + 2], now)
+        self.pending = []
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"entries": self.entries, "updated": self.updated}, f)
+        os.rename(tmp, self.path)
+
+    def _decay(self, now):
+        if now <= self.updated:
+            return
+        factor = 0.5 ** ((now - self.updated) / self.half_life)
+        for e in self.entries.values():
+            for i in xrange(3):
+                e[i] *= factor
+        self.updated = now
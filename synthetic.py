@@ -0,0 +1,123 @@
+import bisect
+import json
+import os
+import random
+import threading
+
+WORDS = ['happy', 'sad', 'and', 'the', 'I', 'One Direction', '1D', 'Trump',
+         'Hillary', 'Sanders', 'lol', 'today', 'love', 'new', 'game', 'music',
+         'rt', 'just', 'good', 'night']
+LANGS = ['en', 'es', 'ja', 'pt', 'fr']
+# Optional top-level fields of a tweet; id, created_at and text are always set.
+FIELDS = ('lang', 'user', 'retweet_count', 'entities')
+
+def vocabulary(size):
+    """
+    Returns a vocabulary of size words: WORDS, then made-up ones.
+    """
+    return (WORDS + ['w%d' % i for i in xrange(len(WORDS), size)])[:size]
+
+def zipf(rnd, words, skew):
+    """
+    Returns a function drawing words from rnd, the k-th word with probability
+    proportional to 1 / k ** skew: uniformly if skew is 0, and the more
+    concentrated on the first words the larger skew is.
+    """
+    if not skew:
+        return lambda: rnd.choice(words)
+    cumulative = []
+    total = 0.0
+    for k in xrange(1, len(words) + 1):
+        total += 1.0 / k ** skew
+        cumulative.append(total)
+    return lambda: words[bisect.bisect(cumulative, rnd.random() * total)]
+
+def tweets(seed=0, vocabulary=WORDS, length=12, skew=0.0, fields=FIELDS):
+    """
+    Deterministic, endless generator of tweet-like dicts with the fields the
+    queries use (text, lang, user, retweet_count, entities.hashtags).
+
+    Words are drawn from vocabulary with the given Zipf skew (see zipf). Only
+    the optional fields listed in fields are kept; the other values are still
+    drawn, so that the same seed gives the same texts whatever the fields.
+    """
+    rnd = random.Random(seed)
+    draw = zipf(rnd, vocabulary, skew)
+    i = 0
+    while True:
+        words = [draw() for _ in xrange(rnd.randint(1, length))]
+        tweet = {
+            'id': i,
+            'created_at': i,
+            'text': ' '.join(words),
+            'lang': rnd.choice(LANGS),
+            'user': {'name': 'user%d' % rnd.randint(0, 999),
+                     'followers_count': rnd.randint(0, 10000)},
+            'retweet_count': rnd.randint(0, 100),
+            'entities': {'hashtags': [{'text': w} for w in words if rnd.random() < 0.1]},
+        }
+        for field in FIELDS:
+            if field not in fields:
+                del tweet[field]
+        yield tweet
+        i += 1
+
+def lines(seed=0, **kwargs):
+    """
+    Like tweets, but yields the raw JSON strings as sent by the stream.
+    """
+    for t in tweets(seed, **kwargs):
+        yield json.dumps(t)
+
+def write_files(directory, files, count, seed=0, **kwargs):
+    """
+    Writes files files of count synthetic tweets each (one JSON line per
+    tweet, as TweetDownloader does) into directory, and returns their paths.
+    The tweets of file k are lines(seed + k, **kwargs), so every file is
+    reproducible on its own.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for k in xrange(files):
+        path = os.path.join(directory, 'tweets-%d.txt' % k)
+        with open(path, 'w') as f:
+            for i, line in enumerate(lines(seed + k, **kwargs)):
+                if i >= count:
+                    break
+                f.write(line + '\n')
+        paths.append(path)
+    return paths
+
+class SyntheticStream(object):
+
+    def __init__(self, listener, count=None, seed=0):
+        """
+        Stands in for tweepy.Stream: sample() feeds count synthetic tweets (or
+        an endless stream) to listener.on_data, as fast as it takes them.
+        """
+        self.listener = listener
+        self.count = count
+        self.seed = seed
+        self.running = threading.Event()
+        self.thread = None
+
+    def sample(self, async=False):
+        self.running.set()
+        if async:
+            self.thread = threading.Thread(target=self._run, name="SyntheticStream")
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self._run()
+
+    def _run(self):
+        for i, line in enumerate(lines(self.seed)):
+            if not self.running.is_set() or (self.count is not None and i >= self.count):
+                break
+            self.listener.on_data(line + '\r\n')
+
+    def disconnect(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,425 @@
+import array
+import json
+import multiprocessing
+import numbers
+import os
+import time
+import zlib
+
+import queryparser
+
+# Fields whose string values are indexed by trigram, for _contains, and
+# fields whose string values are indexed as a whole, for _eq.
+TEXT_FIELDS = ('text',)
+VALUE_FIELDS = ('lang', 'user.lang', 'user.name', 'user.screen_name')
+
+# Length of the substrings indexed for _contains; shorter literals cannot be
+# looked up.
+GRAM = 3
+
+# Above this fraction of candidate lines, reading the whole file sequentially
+# is faster than seeking to each of them.
+MAX_CANDIDATES = 0.25
+
+# Version of the sidecar format, stored in its header.
+VERSION = 2
+
+# Extension of the sidecar files.
+SUFFIX = ".idx"
+
+def sidecar(path, directory):
+    """
+    Returns where the index of an input file is stored.
+    """
+    return os.path.join(directory, os.path.basename(path) + SUFFIX)
+
+def grams(value):
+    return set(value[i:i + GRAM] for i in xrange(len(value) - GRAM + 1))
+
+def text_term(field, gram):
+    return ("t:%s:%s" % (field, gram)).encode("utf-8")
+
+def value_term(field, value):
+    return ("v:%s:%s" % (field, value)).encode("utf-8")
+
+def other_term(field):
+    # lines whose field is not a string: kept as candidates of any lookup of
+    # the field, since e.g. _contains also tests list membership
+    return "o:%s" % field
+
+# lines that are not valid JSON, kept as candidates of every lookup
+UNPARSED = "u"
+
+def encode(line_numbers):
+    """
+    Compresses an increasing list of line numbers into variable-length bytes
+    of the differences between neighbors.
+    """
+    out = bytearray()
+    previous = -1
+    for n in line_numbers:
+        delta = n - previous
+        previous = n
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return str(out)
+
+def decode(data):
+    line_numbers = []
+    n = -1
+    delta = shift = 0
+    for byte in bytearray(data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            n += delta
+            line_numbers.append(n)
+            delta = shift = 0
+    return line_numbers
+
+def flatten(tweet, prefix=""):
+    """
+    Yields the (dotted field, value) pairs of the leaves of a parsed tweet,
+    except inside lists.
+    """
+    for key, value in tweet.iteritems():
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + "."):
+                yield item
+        else:
+            yield prefix + key, value
+
+class TokenIndex(object):
+
+    def __init__(self, size, mtime, offsets, postings, stats,
+                 text_fields=TEXT_FIELDS, value_fields=VALUE_FIELDS):
+        """
+        Sidecar index of one input file, built once (see build) and stored
+        next to the other indexes (see save and load), so that evaluations of
+        _contains and _eq queries over the file later on read only the lines
+        that may match (see candidates and read_lines) instead of the whole
+        file.
+
+        offsets holds the byte offset of each line, and the file size at the
+        end. postings maps each term (a trigram of a text field, or the value
+        of a value field) to the numbers of the lines containing it,
+        compressed (see encode). stats maps each numeric field to the [min,
+        max] of its values (booleans included), so that _eq tests of numbers
+        out of range rule out the whole file. size and mtime are those of the
+        file when it was indexed; an index of a changed file is stale.
+        """
+        self.size = size
+        self.mtime = mtime
+        self.offsets = offsets
+        self.postings = postings
+        self.stats = stats
+        self.text_fields = tuple(text_fields)
+        self.value_fields = tuple(value_fields)
+
+    @classmethod
+    def build(cls, path, text_fields=TEXT_FIELDS, value_fields=VALUE_FIELDS):
+        """
+        Reads and parses every line of an input file into a new index.
+        """
+        info = os.stat(path)
+        text_getters = [(f, queryparser.make_getter(f)) for f in text_fields]
+        value_getters = [(f, queryparser.make_getter(f)) for f in value_fields]
+        offsets = array.array("l")
+        lines = {}
+        stats = {}
+        position = 0
+        with open(path, "rb") as f:
+            for n, line in enumerate(f):
+                offsets.append(position)
+                position += len(line)
+                line = line.rstrip("\r\n")
+                if not line:
+                    continue
+                try:
+                    tweet = json.loads(line)
+                except ValueError:
+                    lines.setdefault(UNPARSED, []).append(n)
+                    continue
+                if not isinstance(tweet, dict):
+                    lines.setdefault(UNPARSED, []).append(n)
+                    continue
+                terms = set()
+                for field, get in text_getters:
+                    v = get(tweet)
+                    if isinstance(v, basestring):
+                        terms.update(text_term(field, g) for g in grams(v))
+                    elif v is not queryparser.Missing:
+                        terms.add(other_term(field))
+                for field, get in value_getters:
+                    v = get(tweet)
+                    if isinstance(v, basestring):
+                        terms.add(value_term(field, v))
+                    elif v is not queryparser.Missing:
+                        terms.add(other_term(field))
+                for term in terms:
+                    lines.setdefault(term, []).append(n)
+                for field, v in flatten(tweet):
+                    if isinstance(v, numbers.Real):
+                        bounds = stats.get(field)
+                        if bounds is None:
+                            stats[field] = [v, v]
+                        elif v < bounds[0]:
+                            bounds[0] = v
+                        elif v > bounds[1]:
+                            bounds[1] = v
+        offsets.append(position)
+        postings = dict((term, encode(ns)) for term, ns in lines.iteritems())
+        return cls(position, info.st_mtime, offsets, postings, stats,
+                   text_fields, value_fields)
+
+    def count(self):
+        """
+        Returns the number of lines of the file.
+        """
+        return len(self.offsets) - 1
+
+    def lookup(self, term):
+        return decode(self.postings.get(term, ""))
+
+    def always(self, field=None):
+        """
+        Returns the lines that are candidates of every lookup (of field).
+        """
+        result = set(self.lookup(UNPARSED))
+        if field is not None:
+            result.update(self.lookup(other_term(field)))
+        return result
+
+    def candidates(self, node):
+        """
+        Returns the set of numbers of the lines that may match a normalized
+        predicate tree (see queryparser.normalize), or None if the index
+        cannot tell, i.e. any line may.
+        """
+        op = node[0]
+        if op == '_and':
+            known = [c for c in map(self.candidates, node[1]) if c is not None]
+            if not known:
+                return None
+            return set.intersection(*known)
+        if op == '_or':
+            children = map(self.candidates, node[1])
+            if any(c is None for c in children):
+                return None
+            return set().union(*children)
+
+        field, modifier, value = node
+        if (modifier == '_contains' and field in self.text_fields and
+                isinstance(value, basestring) and len(value) >= GRAM):
+            result = None
+            for g in grams(value):
+                lines = set(self.lookup(text_term(field, g)))
+                result = lines if result is None else result & lines
+                if not result:
+                    break
+            return result | self.always(field)
+        if modifier == '_eq':
+            if field in self.value_fields and isinstance(value, basestring):
+                return set(self.lookup(value_term(field, value))) | self.always(field)
+            if isinstance(value, numbers.Real):
+                # only numbers (and booleans) equal numbers, and stats has
+                # the range of all of them
+                bounds = self.stats.get(field)
+                if bounds is None or not bounds[0] <= value <= bounds[1]:
+                    return self.always()
+        return None
+
+    def candidates_any(self, nodes):
+        """
+        Returns the sorted numbers of the lines that may match any of the
+        predicate trees, or None if any line may.
+        """
+        result = set()
+        for node in nodes:
+            lines = self.candidates(node)
+            if lines is None:
+                return None
+            result |= lines
+        return sorted(result)
+
+    def read_lines(self, path, line_numbers):
+        """
+        Returns the given lines of the indexed file (sorted numbers), as
+        textFile would read them, seeking past the others. Runs of adjacent
+        lines are read at once.
+        """
+        lines = []
+        with open(path, "rb") as f:
+            i = 0
+            while i < len(line_numbers):
+                j = i + 1
+                while (j < len(line_numbers) and
+                       line_numbers[j] == line_numbers[j - 1] + 1):
+                    j += 1
+                start = self.offsets[line_numbers[i]]
+                f.seek(start)
+                data = f.read(self.offsets[line_numbers[j - 1] + 1] - start)
+                for line in data.split("\n")[:j - i]:
+                    if line.endswith("\r"):
+                        line = line[:-1]
+                    lines.append(line.decode("utf-8"))
+                i = j
+        return lines
+
+    def save(self, path):
+        """
+        Writes the index to path: a JSON header line, then the compressed
+        index, made of a JSON line with the fields, stats and the terms with
+        the lengths of their postings, the line offsets (see encode) and the
+        postings one after the other. Nothing in it is unpickled or otherwise
+        executed when loading. Replaces an older index atomically.
+        """
+        header = {"version": VERSION, "size": self.size, "mtime": self.mtime}
+        terms = sorted(self.postings)
+        offsets = encode(self.offsets)
+        layout = {
+            "text_fields": self.text_fields,
+            "value_fields": self.value_fields,
+            "stats": self.stats,
+            "offsets": len(offsets),
+            "terms": [[t.decode("utf-8"), len(self.postings[t])] for t in terms],
+        }
+        body = zlib.compress("".join(
+            [json.dumps(layout) + "\n", offsets] + [self.postings[t] for t in terms]))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(header) + "\n")
+            f.write(body)
+        os.rename(tmp, path)
+        return len(body)
+
+    @classmethod
+    def load(cls, path, source):
+        """
+        Returns the index stored at path, or None if there is none or the
+        source file changed since.
+        """
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                if not fresh(header, source):
+                    return None
+                body = zlib.decompress(f.read())
+            end = body.index("\n")
+            layout = json.loads(body[:end])
+            position = end + 1 + layout["offsets"]
+            offsets = array.array("l", decode(body[end + 1:position]))
+            postings = {}
+            for term, length in layout["terms"]:
+                postings[term.encode("utf-8")] = body[position:position + length]
+                position += length
+        except (IOError, OSError, ValueError, TypeError, KeyError, zlib.error):
+            return None
+        if (position != len(body) or not offsets or
+                offsets[-1] != header["size"]):
+            return None
+        return cls(header["size"], header["mtime"], offsets, postings,
+                   layout["stats"], layout["text_fields"], layout["value_fields"])
+
+def fresh(header, source):
+    try:
+        info = os.stat(source)
+    except OSError:
+        return False
+    return (header.get("version") == VERSION and
+            header.get("size") == info.st_size and
+            header.get("mtime") == info.st_mtime)
+
+def is_fresh(path, source):
+    """
+    Tells whether the index at path is up to date with its source file,
+    reading only its header.
+    """
+    try:
+        with open(path, "rb") as f:
+            return fresh(json.loads(f.readline()), source)
+    except (IOError, OSError, ValueError):
+        return False
+
+def build(source, directory):
+    """
+    Indexes an input file unless its index in directory is up to date.
+    Returns a report of the build ({'file', 'lines', 'terms', 'bytes',
+    'seconds'}), or None if the index was up to date or the file cannot be
+    indexed (compressed files cannot be seeked).
+    """
+    path = sidecar(source, directory)
+    if source.endswith(".gz") or is_fresh(path, source):
+        return None
+    start = time.time()
+    index = TokenIndex.build(source)
+    index.save(path)
+    return {
+        "file": source,
+        "lines": index.count(),
+        "terms": len(index.postings),
+        "bytes": os.path.getsize(path),
+        "seconds": time.time() - start,
+    }
+
+class IndexBuilder(object):
+
+    def __init__(self, directory, processes=1):
+        """
+        Builds the indexes of input files (see build) in the background, on a
+        pool of worker processes, so that neither the run loop nor the jobs of
+        the driver wait for the second parse of every line that indexing takes:
+
+            builder = IndexBuilder(directory)
+            builder.submit(filenames)
+            ...
+            for report in builder.finished():
+                print report
+        """
+        self.directory = directory
+        self.processes = processes
+        self.pool = None
+        # (file, AsyncResult) of the builds not reported yet
+        self.pending = []
+
+    def submit(self, filenames):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        for f in filenames:
+            self.pending.append(
+                (f, self.pool.apply_async(build, (f, self.directory))))
+
+    def finished(self, wait=False):
+        """
+        Returns the reports of the builds done since the last call, leaving
+        out indexes that were up to date. With wait, waits for all submitted
+        builds first.
+        """
+        reports = []
+        pending = []
+        for f, result in self.pending:
+            if not wait and not result.ready():
+                pending.append((f, result))
+                continue
+            try:
+                report = result.get()
+            except Exception as e:
+                print("WARNING: could not index %s (%s)" % (f, e))
+                continue
+            if report is not None:
+                reports.append(report)
+        self.pending = pending
+        return reports
+
+    def stop(self):
+        if self.pool is not None:
+            # indexes are renamed into place once complete (see
+            # TokenIndex.save), so unfinished builds leave no partial index
+            self.pool.terminate()
+            self.pool.join()
@@ -0,0 +1,291 @@
+import collections
+import itertools
+import json
+import threading
+import time
+
+# Serial numbers making job group ids unique across tracers.
+_serial = itertools.count()
+
+def describe(arg, width=40):
+    """
+    Returns a short description of an argument of a deferred call.
+    """
+    if hasattr(arg, "predicate"):
+        return json.dumps(arg.predicate)
+    if hasattr(arg, "__call__"):
+        return getattr(arg, "__name__", type(arg).__name__)
+    s = repr(arg)
+    return s if len(s) <= width else s[:width - 3] + "..."
+
+def describe_call(name, args=(), kwargs={}):
+    parts = [describe(a) for a in args]
+    parts.extend("%s=%s" % (k, describe(v)) for k, v in sorted(kwargs.items()))
+    return "%s(%s)" % (name, ", ".join(parts))
+
+class CountParam(object):
+    """
+    AccumulatorParam for the (rows in, rows out) pairs of traced functions.
+    """
+
+    def zero(self, value):
+        return (0, 0)
+
+    def addInPlace(self, a, b):
+        return (a[0] + b[0], a[1] + b[1])
+
+class Span(object):
+
+    def __init__(self, tracer, node, event):
+        self.tracer = tracer
+        self.node = node
+        self.event = event
+
+    def __enter__(self):
+        self.start = time.time()
+        self.group = self.tracer._begin(self.node, self.event)
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.time() - self.start
+        jobs, stages = self.tracer._end(self.group)
+        with self.tracer.lock:
+            self.node["events"].append({
+                "event": self.event,
+                "seconds": seconds,
+                "jobs": jobs,
+                "stages": stages,
+            })
+            self.node["seconds"] += seconds
+            self.node["jobs"].extend(jobs)
+            self.node["stages"].extend(stages)
+        return False
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullTracer(object):
+    """
+    Tracer that records nothing; the default for wrappers.
+    """
+
+    def span(self, wrapper, event, call=None):
+        return NullSpan()
+
+    def cache(self, wrapper, kind, hit):
+        pass
+
+    def instrument(self, wrapper, name, args, call=None):
+        return args
+
+NULL = NullTracer()
+
+class Tracer(NullTracer):
+
+    def __init__(self, context=None, label=None, rows=False):
+        """
+        Records how a wrapper tree (see wrapper.py) is evaluated, for one input
+        file or batch:
+
+            tracer = Tracer(sc, label=filename)
+            lines = AggregateWrapper(sc.textFile(filename), tracer=tracer)
+            ...
+            print tracer.explain()
+            json.dump(tracer.to_json(), f)
+
+        Wrappers report to the tracer of their parent. Each wrapper becomes a
+        node, with its parent, its deferred call, the hits and misses of the
+        evaluation, call and megaresult caches, and one event per evaluation
+        step (e.g. 'run', 'megaresult', 'run on megaresult') with its wall time.
+
+        If a SparkContext is given, each step runs in its own job group and
+        the ids of the Spark jobs and stages it triggered are recorded. With
+        rows=True, the functions passed to filter, map and flatMap, and the
+        megaqueries, also count the rows going in and out through an
+        accumulator, at the cost of some overhead.
+        """
+        self.context = context
+        self.label = label
+        self.rows = rows
+        self.serial = next(_serial)
+        self.started = time.time()
+        # (id(wrapper), call) => (wrapper, node); keeping the wrapper keeps its
+        # id from being reused
+        self.nodes = collections.OrderedDict()
+        # job groups of the open spans of each thread; job groups are
+        # thread-local properties of the context too
+        self.local = threading.local()
+        # numbers the job groups, which must be unique even for concurrent
+        # spans of one node
+        self.spans = itertools.count()
+        # guards nodes, as wrapper trees may be evaluated on several threads
+        self.lock = threading.RLock()
+
+    @property
+    def groups(self):
+        if not hasattr(self.local, "groups"):
+            self.local.groups = []
+        return self.local.groups
+
+    def node(self, wrapper, call=None):
+        """
+        Returns the record of a wrapper. If call is given, returns the record
+        of a step of that wrapper with its own description (e.g. computing a
+        megaresult) instead, or of a step outside any wrapper tree (e.g. a
+        fused pass) if wrapper is None.
+        """
+        key = (id(wrapper), call)
+        with self.lock:
+            return self._node(key, wrapper, call)
+
+    def _node(self, key, wrapper, call):
+        if key not in self.nodes:
+            if call is None:
+                parent = wrapper._wrapped
+                cls = type(wrapper).__name__
+                if wrapper._deferred:
+                    call = describe_call(*wrapper._deferred)
+                else:
+                    call = describe(wrapper._wrapped, 80)
+            else:
+                parent = wrapper
+                cls = None
+            parent_id = None
+            if parent is not None and hasattr(parent, "_deferred"):
+                parent_id = self.node(parent)["id"]
+            self.nodes[key] = (wrapper, {
+                "id": len(self.nodes),
+                "parent": parent_id,
+                "class": cls,
+                "call": call,
+                "events": [],
+                "seconds": 0.0,
+                "jobs": [],
+                "stages": [],
+                "cache": {},
+                "rows": None,
+            })
+        return self.nodes[key][1]
+
+    def span(self, wrapper, event, call=None):
+        """
+        Returns a context manager timing one evaluation step of node(wrapper,
+        call).
+        """
+        return Span(self, self.node(wrapper, call), event)
+
+    def cache(self, wrapper, kind, hit):
+        """
+        Counts a hit or miss of one of the caches of a wrapper.
+        """
+        with self.lock:
+            counts = self.node(wrapper)["cache"].setdefault(kind, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def instrument(self, wrapper, name, args, call=None):
+        """
+        Returns the arguments of a filter, map or flatMap call with the
+        function replaced by one counting rows in and out, if rows are traced.
+        The counts go to the record of node(wrapper, call).
+        """
+        if not self.rows or self.context is None or len(args) != 1:
+            return args
+        if name not in ("filter", "map", "flatMap"):
+            return args
+        f = args[0]
+        accumulator = self.context.accumulator((0, 0), CountParam())
+        self.node(wrapper, call)["rows"] = accumulator
+        if name == "filter":
+            def counted(item):
+                result = f(item)
+                accumulator.add((1, 1 if result else 0))
+                return result
+        elif name == "map":
+            def counted(item):
+                accumulator.add((1, 1))
+                return f(item)
+        else:
+            def counted(item):
+                result = list(f(item))
+                accumulator.add((1, len(result)))
+                return result
+        counted.__name__ = getattr(f, "__name__", "counted")
+        return (counted,)
+
+    def _begin(self, node, event):
+        if self.context is None:
+            return None
+        with self.lock:
+            group = "trace-%d-%d-%d" % (self.serial, node["id"], next(self.spans))
+        self.context.setJobGroup(group, "%s %s" % (event, node["call"]))
+        self.groups.append(group)
+        return group
+
+    def _end(self, group):
+        if group is None:
+            return [], []
+        self.groups.pop()
+        tracker = self.context.statusTracker()
+        jobs = sorted(tracker.getJobIdsForGroup(group))
+        stages = []
+        for job in jobs:
+            info = tracker.getJobInfo(job)
+            if info is not None:
+                stages.extend(info.stageIds)
+        # give the enclosing step its job group back
+        if self.groups:
+            self.context.setJobGroup(self.groups[-1], "")
+        else:
+            self.context.setLocalProperty("spark.jobGroup.id", None)
+        return jobs, sorted(stages)
+
+    def to_json(self):
+        """
+        Returns the trace as a JSON-serializable dict.
+        """
+        nodes = []
+        for _, node in self.nodes.values():
+            node = dict(node)
+            if node["rows"] is not None:
+                rows_in, rows_out = node["rows"].value
+                node["rows"] = {"in": rows_in, "out": rows_out}
+            nodes.append(node)
+        return {
+            "label": self.label,
+            "started": self.started,
+            "seconds": sum(n["seconds"] for n in nodes),
+            "nodes": nodes,
+        }
+
+    def explain(self):
+        """
+        Returns the trace as an indented text tree, one line per node.
+        """
+        trace = self.to_json()
+        children = collections.defaultdict(list)
+        for node in trace["nodes"]:
+            children[node["parent"]].append(node)
+
+        lines = ["%s: %.3fs" % (trace["label"], trace["seconds"])]
+        def visit(node, depth):
+            parts = ["  " * depth + node["call"]]
+            if node["events"]:
+                parts.append("%s %.3fs" % (
+                    "+".join(e["event"] for e in node["events"]), node["seconds"]))
+            if node["jobs"]:
+                parts.append("jobs %s stages %s" % (node["jobs"], node["stages"]))
+            if node["rows"] is not None:
+                parts.append("rows %(in)d -> %(out)d" % node["rows"])
+            for kind, (hits, misses) in sorted(node["cache"].items()):
+                parts.append("%s cache %d/%d" % (kind, hits, hits + misses))
+            lines.append("  ".join(parts))
+            for child in children[node["id"]]:
+                visit(child, depth + 1)
+        for root in children[None]:
+            visit(root, 0)
+        return "\n".join(lines)
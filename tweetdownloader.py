@@ -1,12 +1,17 @@
 import collections
-import json
+import gzip
 import os
 import thread
 import threading
 import time
 
-from tweepy import Stream, OAuthHandler
-from tweepy.streaming import StreamListener
+try:
+    from tweepy import Stream, OAuthHandler
+    from tweepy.streaming import StreamListener
+except ImportError:
+    # Offline use, e.g. with a synthetic stream (see bench_downloader.py).
+    Stream = OAuthHandler = None
+    StreamListener = object
 
 import safethread
 
@@ -20,8 +25,8 @@ class TweetListener(StreamListener):
         self.writer = writer
 
     def on_data(self, data):
-        vals = json.loads(data)
-        self.writer.write(vals)
+        # Keep the raw payload: the scheduler parses it anyway.
+        self.writer.write(data)
         return True
 
     def on_error(self, status):
@@ -44,46 +49,126 @@ class TweetDownloader(safethread.SafeThread, StreamListener):
                  access_token,
                  access_secret,
                  window = 10000,
-                 verbose = False):
+                 verbose = False,
+                 max_bytes = None,
+                 compress = None,
+                 buffer_size = 100000,
+                 batch_size = 1000,
+                 block = 0.0,
+                 stream = None):
+        """
+        Downloads tweets into destpath. Tweets are written to destpath + 'tmp',
+        which is renamed to tweets-<start in ms>-<number>.txt once it covers
+        window ms or holds max_bytes bytes, whichever comes first. With
+        compress='gzip' the files are gzipped (and named .txt.gz), which
+        Spark's textFile reads natively.
+
+        Incoming tweets wait in a buffer of at most buffer_size tweets, and are
+        written batch_size at a time with one buffered write. When the buffer
+        is full, the stream waits up to block seconds for room (counted in
+        self.backpressured) and then drops the tweet (counted in self.dropped).
+
+        stream, if given, replaces the Twitter stream: it is called with the
+        listener and must return an object with sample(async) and
+        disconnect() methods.
+        """
         super(TweetDownloader, self).__init__(name="TweetDownloader")
+        if compress not in (None, 'gzip'):
+            raise ValueError("Unsupported compression: %s" % compress)
         self.destpath = destpath
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
         self.access_token = access_token
         self.access_secret = access_secret
         self.prefix = 'tweets'
-        self.suffix = 'txt'
+        self.suffix = 'txt.gz' if compress == 'gzip' else 'txt'
         self.window = window
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.batch_size = batch_size
+        self.block = block
+        self.stream_factory = stream
         self.buf = collections.deque()
+        self.cond = threading.Condition()
         self.stopped = True
 
-    # Write the tweet text to the current file. May throw an error if the file
-    # is currently being switched out (i.e. writing at the end of a window).
-    def write(self, vals):
-        self.buf.appendleft(json.dumps(vals))
+        # counters
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.backpressured = 0
+        self.files = 0
+
+    # Queue the raw tweet for writing. Called from the stream's thread.
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        data = data.rstrip('\r\n')
+        if not data:
+            return  # keep-alive
+        with self.cond:
+            self.received += 1
+            if len(self.buf) >= self.buffer_size and self.block > 0:
+                self.backpressured += 1
+                self.cond.wait(self.block)
+            if len(self.buf) >= self.buffer_size:
+                self.dropped += 1
+                return
+            self.buf.append(data)
+            self.cond.notify_all()
 
     def action(self):
-        if len(self.buf) > 0:
-            self.f.write(self.buf.pop() + '\n')
-
-        if ((time.time() * 1000) - self.begin > self.window):
-            self.f.close()
-            fname = self.destpath + self.prefix + '-' + str(self.begin) + \
-                    '.' + self.suffix
-            os.rename(self.destpath + 'tmp', fname)
-
-            self.begin = int(time.time() * 1000)
-            self.f = open(self.destpath + 'tmp', 'w')
+        deadline = self.begin + self.window
+        with self.cond:
+            if not self.buf:
+                remaining = deadline - time.time() * 1000
+                if remaining > 0:
+                    self.cond.wait(remaining / 1000.0)
+            lines = []
+            while self.buf and len(lines) < self.batch_size:
+                lines.append(self.buf.popleft())
+            # wake up a stream waiting for room
+            self.cond.notify_all()
+
+        if lines:
+            chunk = '\n'.join(lines) + '\n'
+            self.f.write(chunk)
+            self.nbytes += len(chunk)
+            self.written += len(lines)
+
+        if ((time.time() * 1000) - self.begin > self.window or
+                (self.max_bytes is not None and self.nbytes >= self.max_bytes)):
+            self.rotate()
+
+    def open(self):
+        self.begin = int(time.time() * 1000)
+        self.nbytes = 0
+        if self.compress == 'gzip':
+            self.f = gzip.open(self.destpath + 'tmp', 'wb')
+        else:
+            self.f = open(self.destpath + 'tmp', 'wb', 1 << 20)
+
+    def rotate(self):
+        self.f.close()
+        # files rotated by size within the same ms differ by their number
+        fname = self.destpath + self.prefix + '-' + str(self.begin) + \
+                '-' + str(self.files) + '.' + self.suffix
+        os.rename(self.destpath + 'tmp', fname)
+        self.files += 1
+        self.open()
 
     def start(self):
         # Setup the stream
-        auth = OAuthHandler(self.consumer_key, self.consumer_secret)
-        auth.set_access_token(self.access_token, self.access_secret)
-        self.stream = Stream(auth, TweetListener(self))
+        if self.stream_factory is not None:
+            self.stream = self.stream_factory(TweetListener(self))
+        else:
+            auth = OAuthHandler(self.consumer_key, self.consumer_secret)
+            auth.set_access_token(self.access_token, self.access_secret)
+            self.stream = Stream(auth, TweetListener(self))
 
         # Create the first file
-        self.begin = int(time.time() * 1000)
-        self.f = open(self.destpath + 'tmp', 'w')
+        self.open()
 
         # Start the threads
         self.stream.sample(async=True)
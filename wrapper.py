@@ -1,10 +1,30 @@
+import collections
+import copy
 import inspect
+import itertools
+import threading
+
+import columnar
+import multimatch
+import tracing
 
 def make_hashkey(name, args, kwargs):
     hn = name
     ha = []
     for arg in args:
-        if hasattr(arg, "__call__"):
+        if hasattr(arg, "fingerprint"):
+            # compiled where clauses (see queryparser.compile_predicate) are
+            # equal if their normalized trees are, however they were compiled;
+            # their canonical string is computed once, when compiling
+            ha.append(("fingerprint", arg.fingerprint))
+        elif getattr(arg, "__self__", None) is not None and hasattr(arg, "__func__"):
+            # methods, e.g. of aggregates (see aggregates.py), are equal if
+            # their objects are
+            ha.append((arg.__func__.__code__.co_code, arg.__self__))
+        elif hasattr(arg, "__call__") and not hasattr(arg, "__code__"):
+            # builtins, e.g. operator.add, are their own key
+            ha.append(arg)
+        elif hasattr(arg, "__call__"):
             c = [x.cell_contents for x in arg.__closure__] if arg.__closure__ else ()
             key = (arg.__code__.co_code, tuple(c))
             ha.append(key)
@@ -17,7 +37,7 @@ def make_hashkey(name, args, kwargs):
 
 class Wrapper(object):
 
-    def __init__(self, wrapped, deferred=None):
+    def __init__(self, wrapped, deferred=None, tracer=None, cache_manager=None):
         """
         Wraps an object for the purpose of lazy evaluation and optimization. To
         create a wrapper:
@@ -51,9 +71,23 @@ class Wrapper(object):
         Here, x is the parent Wrapper and y is its child. By recursively
         following ._wrapper, we can trace the lineage of y to x to real_x (its
         ancestors).
+
+        If a tracing.Tracer is given, the evaluation of this wrapper and its
+        descendants is recorded in it. Children inherit the tracer of their
+        parent.
+
+        If a cachemanager.CacheManager is given, cache() and persist() calls
+        are persisted through it, so that they are unpersisted when the file
+        is done. Children inherit the manager of their parent.
         """
         self._wrapped = wrapped
         self._deferred = deferred
+        if tracer is None:
+            tracer = wrapped._tracer if isinstance(wrapped, Wrapper) else tracing.NULL
+        self._tracer = tracer
+        if cache_manager is None and isinstance(wrapped, Wrapper):
+            cache_manager = wrapped._cache_manager
+        self._cache_manager = cache_manager
 
     def __getattr__(self, name):
         """
@@ -112,20 +146,46 @@ class Wrapper(object):
             parent = self._wrapped.__eval__()
             # then apply the deferred action
             name, args, kwargs = self._deferred
-            print "RUNNING", name
-            return getattr(parent, name)(*args, **kwargs)
+            if name in ("cache", "persist") and self._cache_manager is not None:
+                with self._tracer.span(self, "run"):
+                    return self._cache_manager.persist(parent, self.__label__())
+            args = self._tracer.instrument(self, name, args)
+            with self._tracer.span(self, "run"):
+                return getattr(parent, name)(*args, **kwargs)
+
+    def __label__(self):
+        """
+        Describes what a cache() or persist() call caches: the call that
+        produced its parent.
+        """
+        if getattr(self._wrapped, "_deferred", None):
+            return tracing.describe_call(*self._wrapped._deferred)
+        return self._deferred[0]
 
 class ScanSharingWrapper(Wrapper):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, wrapped, deferred=None, stats=None, tracer=None,
+                 cache_manager=None):
         """
         Wraps an object and performs scan sharing on a limited set of queries,
         e.g. map. The wrapper records all deferred map actions called on it. At
         evaluation time, the first child performs a mega-map consisting of the
         union of all these map actions. Then each child runs their individual
         map on this result, which should be an efficiency gain.
+
+        If a stats.PredicateStats is given, shared filters try the predicates
+        that are cheapest and most likely to pass first, and report what they
+        measure back to it. Children inherit the stats of their parent.
+
+        If a cachemanager.CacheManager is given, megaresults and cache() or
+        persist() calls are persisted through it, so that they are unpersisted
+        when the file is done. Children inherit the manager of their parent.
         """
-        super(ScanSharingWrapper, self).__init__(*args, **kwargs)
+        super(ScanSharingWrapper, self).__init__(
+            wrapped, deferred, tracer, cache_manager)
+        if stats is None and isinstance(wrapped, ScanSharingWrapper):
+            stats = wrapped._stats
+        self._stats = stats
 
         # For each optimized action, a list of arguments to be computed, e.g.
         # self._tasks["map"] is a list of map actions to run.
@@ -139,6 +199,20 @@ class ScanSharingWrapper(Wrapper):
         # megaquery with the actions in the list above.
         self._results = {}
 
+        # All children created by calls on this wrapper, in order.
+        self._children = []
+
+        # If this wrapper is a map whose children only aggregate it, and the
+        # map megaquery of its parent computed those aggregates, a dict with
+        # the parent ("owner"), the position of this wrapper among the fused
+        # maps of the parent ("index") and its aggregate tasks ("tasks").
+        self._fused = None
+
+        # Guards the megaresults (and, in subclasses, the cached result) of
+        # this wrapper, so that subtrees evaluated on several threads compute
+        # each of them once (see scheduler.FlexibleStreamingScheduler.evaluate).
+        self._lock = threading.RLock()
+
     def __getcall__(self, name):
         fn = super(ScanSharingWrapper, self).__getcall__(name)
         def ffn(*args, **kwargs):
@@ -154,7 +228,9 @@ class ScanSharingWrapper(Wrapper):
                 if len(kwargs) != 0:
                     raise ValueError("%s does not take keyword arguments" % name)
                 self._tasks[name].append(v)
-            return fn(*args, **kwargs)
+            child = fn(*args, **kwargs)
+            self._children.append(child)
+            return child
         return ffn
 
     def __eval__(self):
@@ -167,53 +243,174 @@ class ScanSharingWrapper(Wrapper):
         # Bind to a local variable to prevent Spark from trying to pickle self.
         tasks = self._wrapped._tasks.get(name)
 
+        fused = self._wrapped._fused
+        if name == "aggregate" and fused is not None and args in fused["tasks"]:
+            # computed by the map megaquery of the grandparent
+            results = fused["owner"].__getfusedresult__()
+            with self._tracer.span(self, "run on megaresult"):
+                return results[fused["index"]][fused["tasks"].index(args)]
+
         if len(self._wrapped._tasks.get(name, "")) <= 1:
             # disable optimizations
             pass
         elif name == "filter":
-            megaresult = self.__getmegaresult__(
-                name, parent, lambda item: any(task(item) for task in tasks))
-            print "RUN ON MEGARESULT:", name, args, kwargs
-            return megaresult.filter(*args, **kwargs)
+            megaresult = self.__getmegaresult__(name, parent, tasks)
+            args = self._tracer.instrument(self, name, args)
+            with self._tracer.span(self, "run on megaresult"):
+                return megaresult.filter(*args, **kwargs)
         elif name == "map":
-            megaresult = self.__getmegaresult__(
-                name, parent, lambda item: [task(item) for task in tasks])
+            megaresult = self.__getmegaresult__(name, parent, tasks)
             index = self._wrapped._tasks[name].index(args[0])
-            print "RUN ON MEGARESULT:", name, index
-            return megaresult.map(lambda item: item[index])
+            if self._fused is None:
+                k = self._wrapped._columns[index]
+                with self._tracer.span(self, "run on megaresult"):
+                    return megaresult.flatMap(
+                        lambda part: columnar.column(part[0], k))
+            # The megaquery aggregated this map instead of storing it; any
+            # other use recomputes it.
         elif name == "aggregate":
-            if name not in self._wrapped._results:
-                zeroValues = [v[0] for v in tasks]
-                def seqOp(a, b):
-                    result = [None] * len(tasks)
-                    for i in xrange(len(tasks)):
-                        result[i] = tasks[i][1](a[i], b)
-                    return result
-                def combOp(a, b):
-                    result = [None] * len(tasks)
-                    for i in xrange(len(tasks)):
-                        result[i] = tasks[i][2](a[i], b[i])
-                    return result
-                self._wrapped._results[name] = parent.aggregate(
-                    zeroValues, seqOp, combOp)
-            megaresult = self._wrapped._results[name]
-            index = self._wrapped._tasks[name].index(v)
-            print "RUN ON MEGARESULT (BYPASSES SPARK):", name, index
-            return megaresult[index]
-
-        print "RUN:", name, args, kwargs
-        return getattr(parent, name)(*args, **kwargs)
-
-    def __getmegaresult__(self, name, parent, megaquery):
+            with self._wrapped._lock:
+                self._tracer.cache(self._wrapped, "megaresult",
+                                   name in self._wrapped._results)
+                if name not in self._wrapped._results:
+                    zeroValues = [v[0] for v in tasks]
+                    def seqOp(a, b):
+                        result = [None] * len(tasks)
+                        for i in xrange(len(tasks)):
+                            result[i] = tasks[i][1](a[i], b)
+                        return result
+                    def combOp(a, b):
+                        result = [None] * len(tasks)
+                        for i in xrange(len(tasks)):
+                            result[i] = tasks[i][2](a[i], b[i])
+                        return result
+                    call = "aggregate megaquery (%d tasks)" % len(tasks)
+                    with self._tracer.span(self._wrapped, "megaresult", call):
+                        self._wrapped._results[name] = parent.aggregate(
+                            zeroValues, seqOp, combOp)
+                megaresult = self._wrapped._results[name]
+            index = self._wrapped._tasks[name].index(args)
+            # bypasses Spark
+            with self._tracer.span(self, "run on megaresult"):
+                return megaresult[index]
+
+        if name in ("cache", "persist") and self._cache_manager is not None:
+            # expected reuse: the calls recorded on this wrapper so far
+            reuse = sum(len(v) for v in self._tasks.values()) or 1
+            with self._tracer.span(self, "run"):
+                return self._cache_manager.persist(parent, self.__label__(), reuse)
+
+        args = self._tracer.instrument(self, name, args)
+        with self._tracer.span(self, "run"):
+            return getattr(parent, name)(*args, **kwargs)
+
+    def __getmegaresult__(self, name, parent, tasks):
         """
         Gets the cached megaresult from the parent. If it hasn't been computed
         yet, compute, cache and return it.
+
+        The megaquery is compiled from the tasks only once per parent, so that
+        shared _contains filters are answered by one multi-pattern matcher
+        (see multimatch.compile_tasks) that is shipped to executors once.
+
+        The map megaresult holds one compact record per partition instead of a
+        list of outputs per row (see __mapmegaquery__).
+        """
+        with self._wrapped._lock:
+            self._tracer.cache(self._wrapped, "megaresult",
+                               name in self._wrapped._results)
+            if name not in self._wrapped._results:
+                evaluate_all, evaluate_any = multimatch.compile_tasks(
+                    tasks, getattr(parent, "context", None), self._wrapped._stats)
+                call = "%s megaquery (%d tasks)" % (name, len(tasks))
+                with self._tracer.span(self._wrapped, "megaresult", call):
+                    if name == "filter":
+                        args = self._tracer.instrument(
+                            self._wrapped, name, (evaluate_any,), call)
+                        megaresult = parent.filter(*args)
+                    else:
+                        megaresult = parent.mapPartitions(
+                            self._wrapped.__mapmegaquery__(tasks, evaluate_all))
+                    if self._wrapped._cache_manager is not None:
+                        self._wrapped._cache_manager.persist(megaresult, call, len(tasks))
+                    else:
+                        megaresult.cache()
+                    self._wrapped._results[name] = megaresult
+            return self._wrapped._results[name]
+
+    def __mapmegaquery__(self, tasks, evaluate_all):
+        """
+        Returns the map megaquery over the map tasks of this wrapper, to run on
+        each partition with mapPartitions. It yields a single record per
+        partition, (columns, aggregates):
+
+        columns holds the outputs of the tasks, one compact column per task
+        (see columnar.compact), instead of a list of all outputs per row.
+
+        Children mapping a task that are only aggregated (e.g. counted) are
+        fused into the pass: the task's outputs are folded into the children's
+        aggregates right away, and not stored at all. aggregates holds these
+        per-partition accumulators; see __getfusedresult__.
+        """
+        by_task = collections.defaultdict(list)
+        for child in self._children:
+            if child._deferred[0] == "map":
+                by_task[tasks.index(child._deferred[1][0])].append(child)
+
+        # (task index, aggregate tasks) per fused child
+        fused = []
+        for i, children in sorted(by_task.items()):
+            if all(c._children and all(g._deferred[0] == "aggregate"
+                                       for g in c._children)
+                   for c in children):
+                for c in children:
+                    c._fused = {
+                        "owner": self,
+                        "index": len(fused),
+                        "tasks": list(c._tasks["aggregate"]),
+                    }
+                    fused.append((i, c._fused["tasks"]))
+        self._fusedtasks = [aggregates for _, aggregates in fused]
+
+        fused_indices = set(i for i, _ in fused)
+        stored = [i for i in xrange(len(tasks)) if i not in fused_indices]
+        # task index => column
+        self._columns = dict((i, k) for k, i in enumerate(stored))
+
+        def megaquery(iterator):
+            columns = [[] for _ in stored]
+            accs = [[copy.deepcopy(t[0]) for t in aggregates]
+                    for _, aggregates in fused]
+            for item in iterator:
+                values = evaluate_all(item)
+                for k, i in enumerate(stored):
+                    columns[k].append(values[i])
+                for acc, (i, aggregates) in itertools.izip(accs, fused):
+                    for a, task in enumerate(aggregates):
+                        acc[a] = task[1](acc[a], values[i])
+            yield (columnar.compact(columns), accs)
+        return megaquery
+
+    def __getfusedresult__(self):
+        """
+        Returns the results of the aggregates fused into the map megaquery, one
+        list per fused child, combining the accumulators of all partitions.
         """
-        if name not in self._wrapped._results:
-            print "CALCULATING MEGARESULT:", name, megaquery
-            self._wrapped._results[name] = getattr(parent, name)(megaquery)
-            self._wrapped._results[name].cache()
-        return self._wrapped._results[name]
+        with self._lock:
+            self._tracer.cache(self, "fused", "fused" in self._results)
+            if "fused" not in self._results:
+                fused = self._fusedtasks
+                call = "fused aggregates (%d maps)" % len(fused)
+                with self._tracer.span(self, "megaresult", call):
+                    parts = self._results["map"].map(lambda part: part[1]).collect()
+                results = [[copy.deepcopy(t[0]) for t in aggregates]
+                           for aggregates in fused]
+                for accs in parts:
+                    for k, aggregates in enumerate(fused):
+                        for a, task in enumerate(aggregates):
+                            results[k][a] = task[2](results[k][a], accs[k][a])
+                self._results["fused"] = results
+            return self._results["fused"]
 
 class CachingWrapper(ScanSharingWrapper):
 
@@ -233,10 +430,13 @@ class CachingWrapper(ScanSharingWrapper):
         self._cache_present = False
 
     def __eval__(self):
-        if not self._cache_present:
-            self._cached = super(CachingWrapper, self).__eval__()
-            self._cache_present = True
-        return self._cached
+        # concurrent evaluations of this wrapper wait for the first one
+        with self._lock:
+            self._tracer.cache(self, "eval", self._cache_present)
+            if not self._cache_present:
+                self._cached = super(CachingWrapper, self).__eval__()
+                self._cache_present = True
+            return self._cached
 
 class CommonSubqueryWrapper(CachingWrapper):
 
@@ -270,6 +470,7 @@ class CommonSubqueryWrapper(CachingWrapper):
             # Like deferred, hashkey represents a method call performed on the
             # parent object. Unlike deferred, hashkey is hashable.
             hashkey = make_hashkey(name, args, kwargs)
+            self._tracer.cache(self, "call", hashkey in self._call_cache)
             if hashkey not in self._call_cache:
                 self._call_cache[hashkey] = super(CommonSubqueryWrapper, self).__getcall__(name)(*args, **kwargs)
             return self._call_cache[hashkey]